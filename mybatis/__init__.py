@@ -1,4 +1,11 @@
+from .version import __version__
 from .mapper_manager import MapperManager
 from .mybatis import Mybatis
-from .cache import Cache, CacheKey
+from .cache import Cache, CacheKey, ShardedCache
+from .cache_backend import CacheBackend
+from .cache_policy import EvictionPolicy, LruPolicy, WTinyLfuPolicy, GdsfPolicy
+from .binary_codec import BinaryCodec
+from .codec import Codec, JsonCodec, FrozenCodec
+from .disk_cache import DiskCache
+from .tiered_cache import TieredCache
 from .connection import AbstractConnection, AbstractCursor, MySQLConnection, MySQLCursor, ConnectionFactory
\ No newline at end of file
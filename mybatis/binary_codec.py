@@ -0,0 +1,361 @@
+import datetime
+import itertools
+import math
+import operator
+import pickle
+import struct
+import uuid
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Tuple
+
+import orjson as json
+
+from .codec import Codec
+
+BINARY_VERSION = 1
+HEADER = struct.Struct("<BBI")
+
+# shapes of an encoded value
+SHAPE_VALUE = 0
+SHAPE_ROW = 1
+SHAPE_TABLE = 2
+
+# column types; the values of a C_JSON column are stored as JSON as they are,
+# those of the byte and tagged columns as lengths in the JSON part and bytes after it
+C_JSON = 0
+C_DECIMAL = 1
+C_DATETIME = 2
+C_DATE = 3
+C_TIME = 4
+C_TIMEDELTA = 5
+C_BYTES = 6
+C_BYTEARRAY = 7
+C_MEMORYVIEW = 8
+C_UUID = 9
+C_TAGGED = 10
+
+# what JSON keeps exactly, provided floats are finite and integers fit in 64 bits
+_JSON_CLASSES = frozenset([int, float, str, bool, type(None)])
+_COLUMN_TYPES: Dict[type, int] = {
+    Decimal: C_DECIMAL, datetime.datetime: C_DATETIME, datetime.date: C_DATE, datetime.time: C_TIME,
+    datetime.timedelta: C_TIMEDELTA, bytes: C_BYTES, bytearray: C_BYTEARRAY, memoryview: C_MEMORYVIEW,
+    uuid.UUID: C_UUID,
+}
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# tags of single values, in tagged columns and values that are not rows
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_BYTES = 6
+T_BYTEARRAY = 7
+T_MEMORYVIEW = 8
+T_DECIMAL = 9
+T_DATETIME = 10
+T_DATE = 11
+T_TIME = 12
+T_TIMEDELTA = 13
+T_UUID = 14
+T_LIST = 15
+T_TUPLE = 16
+T_DICT = 17
+T_SET = 18
+T_FROZENSET = 19
+T_PICKLE = 20
+
+FLOAT64 = struct.Struct("<d")
+TIMEDELTA = struct.Struct("<iiI")
+
+
+def _write_varint(out: bytearray, n: int):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+class _Reader(object):
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data: bytes, pos: int=0):
+        self.data = data
+        self.pos = pos
+
+    def byte(self) -> int:
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def varint(self) -> int:
+        data = self.data
+        value = data[self.pos]
+        self.pos += 1
+        if value < 0x80:
+            return value
+        value &= 0x7F
+        shift = 7
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def take(self, length: int) -> bytes:
+        start = self.pos
+        self.pos += length
+        return bytes(self.data[start:self.pos])
+
+    def unpack(self, unpacker: struct.Struct) -> tuple:
+        values = unpacker.unpack_from(self.data, self.pos)
+        self.pos += unpacker.size
+        return values
+
+
+def _write_text(out: bytearray, tag: int, text: str):
+    data = text.encode("utf-8", "surrogatepass")
+    out.append(tag)
+    _write_varint(out, len(data))
+    out += data
+
+
+def _write_value(out: bytearray, value: Any):
+    cls = value.__class__
+    if value is None:
+        out.append(T_NONE)
+    elif cls is bool:
+        out.append(T_TRUE if value else T_FALSE)
+    elif cls is int:
+        # zigzag, so that small negative numbers take few bytes too
+        out.append(T_INT)
+        _write_varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)
+    elif cls is float:
+        out.append(T_FLOAT)
+        out += FLOAT64.pack(value)
+    elif cls is str:
+        _write_text(out, T_STR, value)
+    elif cls is list or cls is tuple or cls is set or cls is frozenset:
+        out.append(T_LIST if cls is list else T_TUPLE if cls is tuple else T_SET if cls is set else T_FROZENSET)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    elif cls is dict:
+        out.append(T_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _write_value(out, key)
+            _write_value(out, item)
+    elif cls is bytes or cls is bytearray or cls is memoryview:
+        data = bytes(value)
+        out.append(T_BYTES if cls is bytes else T_BYTEARRAY if cls is bytearray else T_MEMORYVIEW)
+        _write_varint(out, len(data))
+        out += data
+    elif cls is Decimal:
+        _write_text(out, T_DECIMAL, str(value))
+    elif cls is datetime.datetime or cls is datetime.date or cls is datetime.time:
+        _write_text(out, T_DATETIME if cls is datetime.datetime else T_DATE if cls is datetime.date else T_TIME,
+                    value.isoformat())
+    elif cls is datetime.timedelta:
+        out.append(T_TIMEDELTA)
+        out += TIMEDELTA.pack(value.days, value.seconds, value.microseconds)
+    elif cls is uuid.UUID:
+        out.append(T_UUID)
+        out += value.bytes
+    else:
+        # whatever else a driver returns, such as psycopg2 ranges
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        out.append(T_PICKLE)
+        _write_varint(out, len(data))
+        out += data
+
+
+def _unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _read_text(reader: _Reader) -> str:
+    return reader.take(reader.varint()).decode("utf-8", "surrogatepass")
+
+
+_VALUE_READERS: Dict[int, Callable[[_Reader], Any]] = {
+    T_NONE: lambda reader: None,
+    T_FALSE: lambda reader: False,
+    T_TRUE: lambda reader: True,
+    T_INT: lambda reader: _unzigzag(reader.varint()),
+    T_FLOAT: lambda reader: reader.unpack(FLOAT64)[0],
+    T_STR: _read_text,
+    T_BYTES: lambda reader: reader.take(reader.varint()),
+    T_BYTEARRAY: lambda reader: bytearray(reader.take(reader.varint())),
+    T_MEMORYVIEW: lambda reader: memoryview(reader.take(reader.varint())),
+    T_DECIMAL: lambda reader: Decimal(_read_text(reader)),
+    T_DATETIME: lambda reader: datetime.datetime.fromisoformat(_read_text(reader)),
+    T_DATE: lambda reader: datetime.date.fromisoformat(_read_text(reader)),
+    T_TIME: lambda reader: datetime.time.fromisoformat(_read_text(reader)),
+    T_TIMEDELTA: lambda reader: datetime.timedelta(*reader.unpack(TIMEDELTA)),
+    T_UUID: lambda reader: uuid.UUID(bytes=reader.take(16)),
+    T_LIST: lambda reader: [_read_value(reader) for _ in range(reader.varint())],
+    T_TUPLE: lambda reader: tuple([_read_value(reader) for _ in range(reader.varint())]),
+    T_SET: lambda reader: set([_read_value(reader) for _ in range(reader.varint())]),
+    T_FROZENSET: lambda reader: frozenset([_read_value(reader) for _ in range(reader.varint())]),
+    T_DICT: lambda reader: {_read_value(reader): _read_value(reader) for _ in range(reader.varint())},
+    T_PICKLE: lambda reader: pickle.loads(reader.take(reader.varint())),
+}
+
+
+def _read_value(reader: _Reader) -> Any:
+    tag = reader.byte()
+    read = _VALUE_READERS.get(tag)
+    if read is None:
+        raise Exception("Invalid cached value: unknown type %d" % tag)
+    return read(reader)
+
+
+def _column_type(values: List[Any]) -> int:
+    classes = set(map(type, values))
+    if classes <= _JSON_CLASSES:
+        # JSON would turn these into null
+        if float in classes and not all(map(math.isfinite, [value for value in values if value.__class__ is float])):
+            return C_TAGGED
+        return C_JSON
+    classes.discard(type(None))
+    if len(classes) == 1:
+        return _COLUMN_TYPES.get(classes.pop(), C_TAGGED)
+    return C_TAGGED
+
+
+def _encode_column(column_type: int, values: List[Any], blobs: bytearray) -> List[Any]:
+    '''
+    :return: what the JSON part holds for the column
+    '''
+    if column_type == C_DECIMAL:
+        return [None if value is None else str(value) for value in values]
+    if column_type == C_TIMEDELTA:
+        return [None if value is None else value // ONE_MICROSECOND for value in values]
+    if column_type == C_DATETIME or column_type == C_DATE or column_type == C_TIME:
+        return [None if value is None else value.isoformat() for value in values]
+    lengths = []
+    for value in values:
+        if value is None:
+            lengths.append(None)
+            continue
+        start = len(blobs)
+        if column_type == C_TAGGED:
+            _write_value(blobs, value)
+        elif column_type == C_UUID:
+            blobs += value.bytes
+        else:
+            blobs += value
+        lengths.append(len(blobs) - start)
+    return lengths
+
+
+def _decode_column(column_type: int, values: List[Any], blobs: _Reader) -> List[Any]:
+    if column_type == C_DECIMAL:
+        return [None if value is None else Decimal(value) for value in values]
+    if column_type == C_TIMEDELTA:
+        return [None if value is None else datetime.timedelta(microseconds=value) for value in values]
+    if column_type == C_DATETIME or column_type == C_DATE or column_type == C_TIME:
+        parse = (datetime.datetime if column_type == C_DATETIME else datetime.date if column_type == C_DATE
+                 else datetime.time).fromisoformat
+        return [None if value is None else parse(value) for value in values]
+    if column_type == C_TAGGED:
+        return [None if length is None else _read_value(blobs) for length in values]
+    convert = {C_BYTES: bytes, C_BYTEARRAY: bytearray, C_MEMORYVIEW: memoryview,
+               C_UUID: lambda data: uuid.UUID(bytes=data)}.get(column_type)
+    if convert is None:
+        raise Exception("Invalid cached value: unknown column type %d" % column_type)
+    return [None if length is None else convert(blobs.take(length)) for length in values]
+
+
+def _table_columns(value: Any) -> Tuple[str, ...]:
+    '''
+    :return: the column names when value is a row or a list of rows with the same columns, else ()
+    '''
+    cls = value.__class__
+    if cls is dict:
+        rows = [value]
+    elif cls is list and value and value[0].__class__ is dict:
+        rows = value
+    else:
+        return ()
+    keys = rows[0].keys()
+    if not keys or set(map(type, keys)) != {str} or set(map(type, rows)) != {dict} \
+            or not all(map(keys.__eq__, map(dict.keys, rows))):
+        return ()
+    # rows with the same columns in another order decode in the order of the first row
+    return tuple(keys)
+
+
+class BinaryCodec(Codec):
+    '''
+    Stores results as compact bytes that keep the Python types the database
+    drivers return: Decimal, datetime, date, time, timedelta, UUID, bytes,
+    bytearray and memoryview come back as such, and anything else, such as
+    integers beyond 64 bits or psycopg2 ranges, goes through pickle. Every
+    hit decodes a fresh copy.
+
+    A row, or a list of rows with the same columns, is stored by column: a
+    header, then a JSON part with the column names (once, not once per row),
+    a type per column and the values of each column, then the raw bytes of
+    the byte, UUID and mixed columns. Columns of numbers and strings, the
+    bulk of most results, are read back by orjson about as fast as JsonCodec
+    reads them; only typed columns are converted in Python. Other values are
+    stored with a type tag per value.
+    '''
+    def encode(self, value: Any) -> bytes:
+        columns = _table_columns(value)
+        if columns:
+            rows = [value] if value.__class__ is dict else value
+            column_types = []
+            column_values = []
+            blobs = bytearray()
+            for column in columns:
+                values = list(map(operator.itemgetter(column), rows))
+                column_type = _column_type(values)
+                column_types.append(column_type)
+                column_values.append(values if column_type == C_JSON else
+                                     _encode_column(column_type, values, blobs))
+            if value.__class__ is dict:
+                # a single row keeps its values, not columns of one value
+                column_values = [values[0] for values in column_values]
+            try:
+                data = json.dumps([columns, column_types, column_values])
+            except TypeError:
+                # integers beyond 64 bits, unpaired surrogates in strings
+                data = None
+            if data is not None:
+                shape = SHAPE_ROW if value.__class__ is dict else SHAPE_TABLE
+                return HEADER.pack(BINARY_VERSION, shape, len(data)) + data + blobs
+
+        out = bytearray(HEADER.pack(BINARY_VERSION, SHAPE_VALUE, 0))
+        _write_value(out, value)
+        return bytes(out)
+
+    def decode(self, stored: bytes) -> Any:
+        version, shape, length = HEADER.unpack_from(stored, 0)
+        if version != BINARY_VERSION:
+            raise Exception("Invalid cached value: format version %d" % version)
+        if shape == SHAPE_VALUE:
+            return _read_value(_Reader(stored, HEADER.size))
+
+        end = HEADER.size + length
+        names, column_types, columns = json.loads(memoryview(stored)[HEADER.size:end])
+        if any(column_types):
+            blobs = _Reader(stored, end)
+            for i, column_type in enumerate(column_types):
+                if column_type == C_JSON:
+                    continue
+                if shape == SHAPE_ROW:
+                    columns[i] = _decode_column(column_type, [columns[i]], blobs)[0]
+                else:
+                    columns[i] = _decode_column(column_type, columns[i], blobs)
+        if shape == SHAPE_ROW:
+            return dict(zip(names, columns))
+        return list(map(dict, map(zip, itertools.repeat(names), zip(*columns))))
+
+    def size(self, stored: bytes) -> int:
+        return len(stored)
@@ -1,130 +1,494 @@
+import hashlib
+import math
 import orjson as json
+import threading
 import time
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Optional, Iterable, List, Set, Tuple
+
+from .cache_backend import CacheBackend
+from .cache_policy import EvictionPolicy, LruPolicy
+from .binary_codec import BinaryCodec
+from .codec import Codec
+from .timing_wheel import TimingWheel
+
+# parameter lists longer than this are kept as a fingerprint
+LARGE_KEY_PARAMS = 64
+
+
+def _freeze(value):
+    cls = value.__class__
+    if cls is list or cls is tuple:
+        return tuple([_freeze(item) for item in value])
+    if cls is dict:
+        return ("__dict__",) + tuple([(key, _freeze(item)) for key, item in value.items()])
+    if cls is set or cls is frozenset:
+        return frozenset([_freeze(item) for item in value])
+    if cls is bytearray:
+        return bytes(value)
+    return value
+
+
+_PLAIN_CLASSES = (str, int, float, bool, type(None))
+
+
+def _params_bytes(params) -> bytes:
+    # orjson writes a datetime like its isoformat string, a UUID like its str
+    # and NaN like None, so only plain values go through it and the others
+    # are told apart by their repr
+    if all(param.__class__ in _PLAIN_CLASSES and (param.__class__ is not float or math.isfinite(param))
+           for param in params):
+        try:
+            return json.dumps(params)
+        except TypeError:
+            pass
+    return repr(_freeze(params)).encode()
+
+
+def _fingerprint(params) -> tuple:
+    # a 128 bit blake2b digest plus the length: collisions cannot be crafted,
+    # and unlike hash() it is the same in every process, so key_digest is too
+    data = _params_bytes(params)
+    return ("__fingerprint__", len(data), hashlib.blake2b(data, digest_size=16).digest())
 
-from pympler import asizeof
 
 class CacheKey(object):
-    def __init__(self, sql, param_list):
+    '''
+    Hashable cache key. The SQL text already encodes the shape of the
+    statement; parameters are frozen into a tuple, or fingerprinted when
+    there are many of them, and the hash is computed once.
+    '''
+    __slots__ = ('id', 'sql', 'params', 'hash')
+
+    def __init__(self, sql: str, param_list, id: Optional[str]=None):
+        self.id = id
         self.sql = sql
-        self.param_list = param_list
+        if len(param_list) > LARGE_KEY_PARAMS:
+            params = _fingerprint(param_list)
+        else:
+            params = tuple(param_list)
+        try:
+            self.hash = hash((id, sql, params))
+        except TypeError:
+            params = _freeze(params)
+            try:
+                self.hash = hash((id, sql, params))
+            except TypeError:
+                # parameters without a hash are compared by their repr
+                params = _fingerprint(params)
+                self.hash = hash((id, sql, params))
+        self.params = params
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__ and self.hash == other.hash and self.sql == other.sql
+                and self.params == other.params and self.id == other.id)
+
+    def __repr__(self):
+        return "CacheKey(%r, %r, id=%r)" % (self.sql, self.params, self.id)
+
+class _EmptyResult(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "EMPTY_RESULT"
+
+    def __reduce__(self):
+        return "EMPTY_RESULT"
+
+
+# stored for a query that found nothing, which get tells apart from a miss (None)
+EMPTY_RESULT = _EmptyResult()
+
+
+def now_ms() -> int:
+    return int(time.monotonic() * 1000)
+
+
+def key_digest(key: CacheKey) -> bytes:
+    '''
+    :return: 16 bytes identifying the key in every process, unlike its hash
+    '''
+    data = _params_bytes((key.id, key.sql) + key.params)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def key_size(key: CacheKey) -> int:
+    size = len(key.sql)
+    for param in key.params:
+        cls = param.__class__
+        size += len(param) + 8 if cls is str or cls is bytes else 8
+    return size
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'memory_usage', 'expires_at', 'tags', 'cost', 'stale_at', 'created_at')
+
+    def __init__(self, value: Any, memory_usage: int, expires_at: int, tags: tuple, cost: Optional[float]=None,
+                 stale_at: Optional[int]=None, created_at: Optional[int]=None):
+        self.value = value
+        self.memory_usage = memory_usage
+        self.expires_at = expires_at
+        self.tags = tags
+        self.cost = cost
+        # past this the value is still served but should be refreshed
+        self.stale_at = expires_at if stale_at is None else stale_at
+        self.created_at = now_ms() if created_at is None else created_at
+
+
+# counters kept per statement id, in this order; entries and memory_used
+# describe what is cached now, the others count events since the last reset
+STAT_NAMES = ("hits", "stale_hits", "misses", "puts", "rejected", "evicted_capacity", "evicted_expired",
+              "evicted_invalidated", "entries", "memory_used")
+HITS, STALE_HITS, MISSES, PUTS, REJECTED, EVICTED_CAPACITY, EVICTED_EXPIRED, EVICTED_INVALIDATED, ENTRIES, MEMORY_USED = \
+    range(len(STAT_NAMES))
+
+
+def _stats_dict(counters: List[int]) -> Dict[str, int]:
+    stats = dict(zip(STAT_NAMES, counters))
+    stats["evictions"] = counters[EVICTED_CAPACITY] + counters[EVICTED_EXPIRED] + counters[EVICTED_INVALIDATED]
+    stats["average_entry_size"] = counters[MEMORY_USED] // counters[ENTRIES] if counters[ENTRIES] else 0
+    return stats
+
 
-class Cache(object):
-    def __init__(self, memory_limit:int, max_live_ms:int):
+def stats_snapshot(statement_stats: Iterable[Dict[Optional[str], List[int]]], memory_limit: int) -> Dict[str, Any]:
+    '''
+    Sums the counters of one or more caches into a plain dict: the totals, memory_limit and under
+    "statements" the counters of each statement id ("" for keys without one).
+    '''
+    total = [0] * len(STAT_NAMES)
+    per_id: Dict[str, List[int]] = {}
+    for counters_by_id in statement_stats:
+        for id, counters in counters_by_id.items():
+            merged = per_id.setdefault("" if id is None else id, [0] * len(STAT_NAMES))
+            for i, value in enumerate(counters):
+                merged[i] += value
+                total[i] += value
+    snapshot: Dict[str, Any] = _stats_dict(total)
+    snapshot["memory_limit"] = memory_limit
+    snapshot["statements"] = {id: _stats_dict(counters) for id, counters in per_id.items()}
+    return snapshot
+
+
+class Cache(CacheBackend):
+    '''
+    Cache bounded by an estimate of its memory use: the key and value sizes
+    reported by key_size and the codec plus ENTRY_OVERHEAD per entry. The
+    policy chooses the entries dropped when it is full, LRU by default.
+    All methods are thread safe; values are encoded and decoded outside the lock.
+    Expired entries are dropped by a timing wheel that every put and get moves
+    forward, or expire(), so they stop counting against the limit even when
+    they are never read again.
+    '''
+    # the entry, the key object and its ordered dict slot
+    ENTRY_OVERHEAD = 320
+
+    def __init__(self, memory_limit:int, max_live_ms:int, codec: Optional[Codec]=None, expiry_tick_ms:int=100,
+                 policy: Optional[EvictionPolicy]=None):
+        '''
+        :param codec: how results are stored, BinaryCodec by default; FrozenCodec keeps them as read-only structures
+        :param expiry_tick_ms: resolution of the timing wheel; a get never returns an expired entry either way
+        :param policy: LruPolicy by default, or WTinyLfuPolicy or GdsfPolicy; one instance per cache
+        '''
+        self.codec = BinaryCodec() if codec is None else codec
         self.memory_limit = memory_limit
         self.memory_used = 0
         self.max_live_ms = max_live_ms
-        self.table : Dict[str, CacheNode] = {}
-        self.list = CacheList()
+        self.policy = LruPolicy() if policy is None else policy
+        self.policy.bind(memory_limit)
+        self.on_evict: Optional[Callable[[CacheKey, CacheEntry], None]] = None
+        # least recently used first
+        self.table : OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        # tag -> keys of the entries carrying it
+        self.tag_index : Dict[str, Set[CacheKey]] = {}
+        self.wheel = TimingWheel(expiry_tick_ms, now_ms=now_ms())
+        self.lock = threading.Lock()
+        # statement id -> counters, see STAT_NAMES
+        self.statement_stats : Dict[Optional[str], List[int]] = {}
+
+    def __len__(self):
+        return len(self.table)
 
     def empty(self):
-        # assert self.list.head.next is self.list.tail
         return len(self.table) == 0
 
     def clear(self):
-        self.table.clear()
-        head = self.list.head
-        tail = self.list.tail
-
-        head.next = tail
-        tail.prev = head
-
-    def put(self, raw_key:CacheKey, value: Any):
-        key = json.dumps(raw_key.__dict__)
-        if key in self.table:
-            node = self.table[key]
-            del self.table[key]
-            self.list.remove(node)
-            self.memory_used -= node.memory_usage
-            node.value = json.dumps(value)
-            node.memory_usage = asizeof.asizeof(node.key) + asizeof.asizeof(node.value)
-            # print("++++>", node.memory_usage)
+        with self.lock:
+            self.table.clear()
+            self.tag_index.clear()
+            self.wheel.clear()
+            self.policy.clear()
+            self.memory_used = 0
+            for counters in self.statement_stats.values():
+                counters[EVICTED_INVALIDATED] += counters[ENTRIES]
+                counters[ENTRIES] = 0
+                counters[MEMORY_USED] = 0
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        :return: a snapshot of the counters, see stats_snapshot
+        '''
+        return stats_snapshot([self.copy_stats()], self.memory_limit)
+
+    def copy_stats(self) -> Dict[Optional[str], List[int]]:
+        with self.lock:
+            return {id: list(counters) for id, counters in self.statement_stats.items()}
+
+    def reset_stats(self):
+        '''
+        Sets the event counters to zero; entries and memory_used keep describing the cached entries.
+        '''
+        with self.lock:
+            for id, counters in list(self.statement_stats.items()):
+                if counters[ENTRIES] == 0:
+                    del self.statement_stats[id]
+                else:
+                    counters[:ENTRIES] = [0] * ENTRIES
+
+    def set_on_evict(self, on_evict: Optional[Callable[[CacheKey, CacheEntry], None]]):
+        self.on_evict = on_evict
+
+    def _counters(self, id: Optional[str]) -> List[int]:
+        counters = self.statement_stats.get(id)
+        if counters is None:
+            counters = self.statement_stats[id] = [0] * len(STAT_NAMES)
+        return counters
+
+    def put(self, key:CacheKey, value: Any, tags: Iterable[str]=(), max_live_ms: Optional[int]=None,
+            cost: Optional[float]=None, refresh_after_ms: Optional[int]=None) -> Any:
+        '''
+        :param tags: labels such as "id:<statement id>" by which the entry can be dropped with invalidate_tags
+        :param max_live_ms: lifetime of this entry, defaults to the max_live_ms of the cache
+        :param cost: what producing the value cost, such as the query time in ms, for policies that weigh it
+        :param refresh_after_ms: age after which get_stale reports the entry as stale, while it is still
+            served until max_live_ms
+        :return: the value to hand to the caller, which is the stored structure when the codec shares it,
+            so that a miss returns the same kind of result as a hit
+        '''
+        if value is EMPTY_RESULT:
+            stored = value
+            memory_usage = self.ENTRY_OVERHEAD + key_size(key)
         else:
-            node = CacheNode(key, json.dumps(value))
-            node.memory_usage = asizeof.asizeof(node.key) + asizeof.asizeof(node.value)
-
-        while self.memory_used + node.memory_usage >= self.memory_limit:
-            to_remove_node = self.list.tail.prev
-            if to_remove_node is not self.list.head:
-                del self.table[to_remove_node.key]
-                self.list.remove(to_remove_node)
-                self.memory_used -= to_remove_node.memory_usage
-            else:
-                break
-
-        if self.memory_used + node.memory_usage > self.memory_limit:
+            stored = self.codec.encode(value)
+            if self.codec.shared:
+                value = stored
+            memory_usage = self.ENTRY_OVERHEAD + key_size(key) + self.codec.size(stored)
+
+        tags = tuple(tags)
+        now = now_ms()
+        entry = CacheEntry(stored, memory_usage, now + (self.max_live_ms if max_live_ms is None else max_live_ms),
+                           tags, cost, None if refresh_after_ms is None else now + refresh_after_ms, now)
+        # entries that did not fit, handed to on_evict once the lock is released
+        evicted = []
+        with self.lock:
+            self._expire(now)
+            self._insert(key, entry, evicted)
+        if evicted and self.on_evict is not None:
+            for evicted_key, evicted_entry in evicted:
+                self.on_evict(evicted_key, evicted_entry)
+        return value
+
+    def _insert(self, key: CacheKey, entry: CacheEntry, evicted: List):
+        table = self.table
+        old_entry = table.get(key)
+        if old_entry is not None:
+            self._remove(key, old_entry, None)
+
+        counters = self._counters(key.id)
+        memory_usage = entry.memory_usage
+        if memory_usage > self.memory_limit:
+            counters[REJECTED] += 1
+            evicted.append((key, entry))
             return
 
-        node.timestamp = int(time.time() * 1000)
-        self.table[node.key] = node
+        table[key] = entry
+        self.wheel.schedule(key, entry.expires_at)
+        for tag in entry.tags:
+            self.tag_index.setdefault(tag, set()).add(key)
+        self.memory_used += memory_usage
+        counters[ENTRIES] += 1
+        counters[MEMORY_USED] += memory_usage
+        self.policy.on_insert(key, entry)
+
+        while len(table) > 1 and self.memory_used >= self.memory_limit:
+            victim = self.policy.victim(table)
+            if victim == key:
+                # not admitted by the policy
+                self._remove(key, entry, REJECTED)
+                evicted.append((key, entry))
+                return
+            victim_entry = table[victim]
+            self._remove(victim, victim_entry, EVICTED_CAPACITY)
+            evicted.append((victim, victim_entry))
+        counters[PUTS] += 1
 
-        self.list.move_to_head(node)
+    def get(self, key: CacheKey, record_stats: bool=True) -> Optional[Any]:
+        '''
+        :param record_stats: False to leave the hit and miss counters alone, for a second look at a key
+        :return: the value, EMPTY_RESULT when it was stored for an empty result, or None when the key is not cached
+        '''
+        return self.get_stale(key, record_stats)[0]
 
-        self.memory_used += node.memory_usage
+    def get_stale(self, key: CacheKey, record_stats: bool=True) -> Tuple[Optional[Any], bool]:
+        '''
+        :return: the value as for get, and whether it is past the refresh_after_ms it was put with
+        '''
+        now = now_ms()
+        with self.lock:
+            self._expire(now)
+            entry = self.table.get(key)
+            # the wheel drops entries on the tick after their deadline
+            if entry is not None and now > entry.expires_at:
+                self._remove(key, entry, EVICTED_EXPIRED)
+                entry = None
+            stale = entry is not None and now >= entry.stale_at
+            if record_stats:
+                counters = self.statement_stats.get(key.id) or self._counters(key.id)
+                counters[MISSES if entry is None else HITS] += 1
+                if stale:
+                    counters[STALE_HITS] += 1
+                self.policy.on_get(key, entry)
+            if entry is None:
+                return None, False
 
-    def get(self, raw_key: CacheKey) -> Optional[Any]:
-        key = json.dumps(raw_key.__dict__)
-        if key not in self.table:
-            return None
+            self.table.move_to_end(key)
+            stored = entry.value
+        if stored is EMPTY_RESULT:
+            return stored, stale
+        return self.codec.decode(stored), stale
 
-        node = self.table[key]
-        current_time_ms = int(time.time() * 1000)
-        # print("delta:",current_time_ms - node.timestamp, "self.max_live_ms:", self.max_live_ms)
-        if current_time_ms - node.timestamp > self.max_live_ms:
-            del self.table[key]
-            self.list.remove(node)
-            self.memory_used -= node.memory_usage
-            return None
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        '''
+        Drops every entry carrying one of the tags.
+        :return: number of entries dropped
+        '''
+        count = 0
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tag_index.get(tag, ())):
+                    entry = self.table.get(key)
+                    if entry is not None:
+                        self._remove(key, entry, EVICTED_INVALIDATED)
+                        count += 1
+        return count
 
-        self.list.move_to_head(node)
-        # print ("====>", node.value, type(node.value))
-        return json.loads(node.value)
+    def expire(self) -> int:
+        '''
+        Drops the entries whose lifetime has passed.
+        :return: number of entries dropped
+        '''
+        with self.lock:
+            return self._expire(now_ms())
+
+    def _expire(self, now: int) -> int:
+        count = 0
+        for key in self.wheel.advance(now):
+            entry = self.table.get(key)
+            if entry is not None:
+                self._remove(key, entry, EVICTED_EXPIRED)
+                count += 1
+        return count
+
+    def _remove(self, key: CacheKey, entry: CacheEntry, cause: Optional[int]):
+        '''
+        :param cause: counter of the reason, None when the entry is replaced
+        '''
+        del self.table[key]
+        self.wheel.cancel(key)
+        self.memory_used -= entry.memory_usage
+        self.policy.on_remove(key, entry)
+        counters = self.statement_stats[key.id]
+        counters[ENTRIES] -= 1
+        counters[MEMORY_USED] -= entry.memory_usage
+        if cause is not None:
+            counters[cause] += 1
+        for tag in entry.tags:
+            keys = self.tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_index[tag]
 
-    # def dump(self):
-    #     for node in self.list.traverse():
-    #         print(node.key, node.value, node.memory_usage, asizeof.asizeof(node.key) + asizeof.asizeof(node.value))
     def traverse(self):
-        node = self.list.head.next
-        while node is not self.list.tail:
-            yield node.key, json.loads(node.value), node.memory_usage
-            node = node.next
-
-class CacheNode:
-    def __init__(self, key : Any, value : Any):
-        self.prev = None
-        self.next = None
-        self.memory_usage = asizeof.asizeof(key) + asizeof.asizeof(value)
-        self.key = key
-        self.value = value
-        self.timestamp = int(time.time() * 1000)
-
-class CacheList:
-    def __init__(self):
-        self.head = CacheNode(None, None)
-        self.tail = CacheNode(None, None)
-        self.head.next = self.tail
-        self.tail.prev = self.head
-
-    @staticmethod
-    def remove(node:CacheNode):
-        if node.prev is None:
-            return
+        # most recently used first, over a snapshot taken under the lock
+        with self.lock:
+            items = [(key, entry.value, entry.memory_usage) for key, entry in reversed(self.table.items())]
+        for key, stored, memory_usage in items:
+            yield key, stored if stored is EMPTY_RESULT else self.codec.decode(stored), memory_usage
 
-        prev = node.prev
-        next = node.next
 
-        prev.next = next
-        next.prev = prev
+class ShardedCache(CacheBackend):
+    '''
+    Splits the entries over several Cache shards by key hash. Each shard has
+    its own lock, LRU order and an equal share of the memory limit, so threads
+    working on different keys rarely wait for each other. An entry larger than
+    one share is not cached.
+    '''
+    def __init__(self, memory_limit:int, max_live_ms:int, codec: Optional[Codec]=None, shards:int=16,
+                 expiry_tick_ms:int=100, policy_factory: Optional[Callable[[], EvictionPolicy]]=None):
+        '''
+        :param policy_factory: makes the eviction policy of each shard, such as WTinyLfuPolicy; LRU by default
+        '''
+        if shards < 1:
+            raise Exception("Invalid shards: %s" % shards)
+        self.codec = BinaryCodec() if codec is None else codec
+        self.memory_limit = memory_limit
+        self.max_live_ms = max_live_ms
+        self.shards = [Cache(memory_limit // shards, max_live_ms, self.codec, expiry_tick_ms,
+                             None if policy_factory is None else policy_factory()) for _ in range(shards)]
+
+    @property
+    def max_entry_size(self) -> int:
+        return self.shards[0].memory_limit
+
+    def _shard(self, key: CacheKey) -> Cache:
+        return self.shards[hash(key) % len(self.shards)]
+
+    @property
+    def memory_used(self) -> int:
+        return sum([shard.memory_used for shard in self.shards])
 
-        node.prev = None
-        node.next = None
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+    def empty(self):
+        return all([shard.empty() for shard in self.shards])
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
 
-    def insert_after_head(self, node:CacheNode):
-        node.next = self.head.next
-        self.head.next = node
-        node.next.prev = node
-        node.prev = self.head
+    def stats(self) -> Dict[str, Any]:
+        return stats_snapshot([shard.copy_stats() for shard in self.shards], self.memory_limit)
 
-    def move_to_head(self, node:CacheNode):
-        CacheList.remove(node)
-        self.insert_after_head(node)
+    def reset_stats(self):
+        for shard in self.shards:
+            shard.reset_stats()
+
+    def put(self, key: CacheKey, value: Any, tags: Iterable[str]=(), max_live_ms: Optional[int]=None,
+            cost: Optional[float]=None, refresh_after_ms: Optional[int]=None) -> Any:
+        return self._shard(key).put(key, value, tags, max_live_ms, cost, refresh_after_ms)
+
+    def get(self, key: CacheKey, record_stats: bool=True) -> Optional[Any]:
+        return self._shard(key).get_stale(key, record_stats)[0]
+
+    def get_stale(self, key: CacheKey, record_stats: bool=True) -> Tuple[Optional[Any], bool]:
+        return self._shard(key).get_stale(key, record_stats)
+
+    def expire(self) -> int:
+        return sum([shard.expire() for shard in self.shards])
+
+    def set_on_evict(self, on_evict: Optional[Callable[[CacheKey, CacheEntry], None]]):
+        for shard in self.shards:
+            shard.set_on_evict(on_evict)
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        tags = tuple(tags)
+        return sum([shard.invalidate_tags(tags) for shard in self.shards])
+
+    def traverse(self):
+        # most recently used first within each shard
+        for shard in self.shards:
+            yield from shard.traverse()
@@ -0,0 +1,86 @@
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from .codec import Codec
+
+
+class CacheBackend(object):
+    '''
+    What Mybatis needs from a cache: Cache, ShardedCache, SharedMemoryCache,
+    DiskCache and TieredCache implement it, and Mybatis(cache=...) accepts
+    any other implementation.
+
+    get returns None for a key that is not cached and EMPTY_RESULT for a key
+    stored with EMPTY_RESULT, the marker of an empty query result. Entries
+    carry tags, "id:<statement id>" and "table:<table>", by which
+    invalidate_tags drops them.
+    '''
+    # bytes the cache may hold; 0 turns caching off
+    memory_limit: int = 0
+    # lifetime of entries put without max_live_ms
+    max_live_ms: int = 0
+    # how values are stored; when codec.shared is True get hands out the stored value itself
+    codec: Codec
+
+    @property
+    def max_entry_size(self) -> int:
+        '''
+        Bytes above which an entry is not stored.
+        '''
+        return self.memory_limit
+
+    def get(self, key: Any, record_stats: bool=True) -> Optional[Any]:
+        '''
+        :param record_stats: False to leave the hit and miss counters alone, for a second look at a key
+        '''
+        raise NotImplementedError # pragma: no cover
+
+    def get_stale(self, key: Any, record_stats: bool=True) -> Tuple[Optional[Any], bool]:
+        '''
+        :return: the value as for get, and whether it is past the refresh_after_ms it was put with,
+            in which case Mybatis refreshes it in the background
+        '''
+        return self.get(key, record_stats), False
+
+    def put(self, key: Any, value: Any, tags: Iterable[str]=(), max_live_ms: Optional[int]=None,
+            cost: Optional[float]=None, refresh_after_ms: Optional[int]=None) -> Any:
+        '''
+        :param cost: what producing the value cost, such as the query time in ms
+        :param refresh_after_ms: age after which get_stale reports the value as stale; backends without
+            soft expiry ignore it
+        :return: the value to hand to the caller
+        '''
+        raise NotImplementedError # pragma: no cover
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        '''
+        :return: number of entries dropped, when the backend knows it
+        '''
+        raise NotImplementedError # pragma: no cover
+
+    def clear(self):
+        raise NotImplementedError # pragma: no cover
+
+    def expire(self) -> int:
+        '''
+        Drops the entries whose lifetime has passed, for backends that do not do it as they go.
+        '''
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        :return: plain dict with at least hits, misses, puts, entries and memory_used
+        '''
+        raise NotImplementedError # pragma: no cover
+
+    def reset_stats(self):
+        pass
+
+    def empty(self) -> bool:
+        return self.stats()["entries"] == 0
+
+    def set_on_evict(self, on_evict: Optional[Callable[[Any, Any], None]]):
+        '''
+        Registers a function called with (key, CacheEntry) for each entry dropped for lack of room,
+        including values too large to be stored, so that a TieredCache can keep them in its second tier.
+        '''
+        raise Exception("%s does not report evicted entries" % self.__class__.__name__)
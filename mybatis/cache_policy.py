@@ -0,0 +1,232 @@
+import heapq
+import itertools
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# byte -> byte >> 1, to halve a whole row of the sketch with bytes.translate
+_HALVE = bytes([value >> 1 for value in range(256)])
+
+
+class EvictionPolicy(object):
+    '''
+    Chooses which entries a Cache drops when it is full. The cache calls the
+    hooks under its lock; the entries passed to them are CacheEntry objects
+    with memory_usage and cost.
+    '''
+    def bind(self, memory_limit: int):
+        '''
+        Called once by the cache the policy belongs to.
+        '''
+        pass
+
+    def on_get(self, key: Hashable, entry: Optional[Any]):
+        '''
+        :param entry: None on a miss
+        '''
+        pass
+
+    def on_insert(self, key: Hashable, entry: Any):
+        pass
+
+    def on_remove(self, key: Hashable, entry: Any):
+        pass
+
+    def clear(self):
+        pass
+
+    def victim(self, table: 'OrderedDict[Hashable, Any]') -> Hashable:
+        '''
+        :param table: the entries of the cache, least recently used first; there are at least two
+        :return: key of the entry to drop, which may be the one just inserted when the policy does not admit it
+        '''
+        raise NotImplementedError # pragma: no cover
+
+
+class LruPolicy(EvictionPolicy):
+    '''
+    Drops the least recently used entry.
+    '''
+    def victim(self, table: 'OrderedDict[Hashable, Any]') -> Hashable:
+        return next(iter(table))
+
+
+class CountMinSketch(object):
+    '''
+    Approximate access counts in four rows of byte counters capped at 15. All counters are halved after 10 * width increments, so counts of
+    keys that stopped being used fade away.
+    '''
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+
+    def __init__(self, width: int):
+        self.width = 1 << max(4, (width - 1).bit_length())
+        self.mask = self.width - 1
+        self.rows = [bytearray(self.width) for _ in self.SEEDS]
+        self.additions = 0
+        self.sample_size = 10 * self.width
+
+    def _indexes(self, key: Hashable) -> List[int]:
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [(((h ^ seed) * seed) >> 29) & self.mask for seed in self.SEEDS]
+
+    def frequency(self, key: Hashable) -> int:
+        return min([row[index] for row, index in zip(self.rows, self._indexes(key))])
+
+    def increment(self, key: Hashable):
+        added = False
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.rows = [bytearray(row.translate(_HALVE)) for row in self.rows]
+                self.additions //= 2
+
+
+class WTinyLfuPolicy(EvictionPolicy):
+    '''
+    W-TinyLFU: new entries go to a small LRU window; entries leaving the
+    window join the probation part of a segmented LRU, and entries hit there
+    move to its protected part. When the cache is full an entry that left the
+    window is kept only if its key was asked for more often, by the estimate
+    of a count-min sketch, than the probation entry it would replace. A scan
+    of keys read once therefore passes through the window without pushing out
+    entries that are read again and again.
+
+    :param window_ratio: share of the memory limit for the window
+    :param protected_ratio: share of the rest for the protected segment
+    :param average_entry_size: expected bytes per entry, to size the sketch
+    '''
+    def __init__(self, window_ratio: float=0.01, protected_ratio: float=0.8, average_entry_size: int=1024):
+        self.window_ratio = window_ratio
+        self.protected_ratio = protected_ratio
+        self.average_entry_size = average_entry_size
+        self.bind(0)
+
+    def bind(self, memory_limit: int):
+        self.window_limit = int(memory_limit * self.window_ratio)
+        self.protected_limit = int((memory_limit - self.window_limit) * self.protected_ratio)
+        self.sketch = CountMinSketch(max(256, memory_limit // self.average_entry_size))
+        self.clear()
+
+    def clear(self):
+        # key -> memory usage, least recently used first
+        self.window: 'OrderedDict[Hashable, int]' = OrderedDict()
+        self.probation: 'OrderedDict[Hashable, int]' = OrderedDict()
+        self.protected: 'OrderedDict[Hashable, int]' = OrderedDict()
+        # keys that left the window and have not been through admission, oldest first
+        self.candidates: 'OrderedDict[Hashable, None]' = OrderedDict()
+        self.window_used = 0
+        self.protected_used = 0
+
+    def on_get(self, key: Hashable, entry: Optional[Any]):
+        self.sketch.increment(key)
+        if entry is None:
+            return
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+        elif key in self.probation:
+            size = self.probation.pop(key)
+            self.candidates.pop(key, None)
+            self.protected[key] = size
+            self.protected_used += size
+            while self.protected_used > self.protected_limit and len(self.protected) > 1:
+                demoted, demoted_size = self.protected.popitem(last=False)
+                self.protected_used -= demoted_size
+                self.probation[demoted] = demoted_size
+
+    def on_insert(self, key: Hashable, entry: Any):
+        self.sketch.increment(key)
+        # only the entries this insert pushes out of the window go through admission;
+        # earlier ones joined the main segments while there was room
+        self.candidates.clear()
+        self.window[key] = entry.memory_usage
+        self.window_used += entry.memory_usage
+        while self.window_used > self.window_limit and len(self.window) > 1:
+            candidate, size = self.window.popitem(last=False)
+            self.window_used -= size
+            self.probation[candidate] = size
+            self.candidates[candidate] = None
+
+    def on_remove(self, key: Hashable, entry: Any):
+        if key in self.window:
+            self.window_used -= self.window.pop(key)
+        elif key in self.protected:
+            self.protected_used -= self.protected.pop(key)
+        else:
+            self.probation.pop(key, None)
+            self.candidates.pop(key, None)
+
+    def victim(self, table: 'OrderedDict[Hashable, Any]') -> Hashable:
+        # the newest candidate competes with the oldest entry of the main segments
+        # that is not a candidate itself
+        victim = None
+        for key in self.probation:
+            if key not in self.candidates:
+                victim = key
+                break
+        if victim is None and self.protected:
+            victim = next(iter(self.protected))
+
+        if self.candidates:
+            candidate = next(reversed(self.candidates))
+            if victim is None or self.sketch.frequency(candidate) <= self.sketch.frequency(victim):
+                return candidate
+            del self.candidates[candidate]
+            return victim
+        if victim is not None:
+            return victim
+        return next(iter(self.window))
+
+
+class GdsfPolicy(EvictionPolicy):
+    '''
+    GreedyDual-Size-Frequency: each entry has the priority
+    L + hits * cost / memory usage, where cost is what the cache was told the
+    result cost to produce (the query time in ms for Mybatis, 1 when not
+    given) and L is the priority of the last entry dropped. The entry with
+    the lowest priority is dropped, so large results of cheap queries go
+    first and results of slow queries stay; L rising with every eviction
+    lets entries that stopped being read age out.
+    '''
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.inflation = 0.0
+        # key -> (priority, hits)
+        self.priorities: Dict[Hashable, Tuple[float, int]] = {}
+        # (priority, sequence, key), with stale items skipped on pop
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        self.sequence = itertools.count()
+
+    def _push(self, key: Hashable, entry: Any, hits: int):
+        cost = 1.0 if entry.cost is None else entry.cost
+        priority = self.inflation + hits * cost / max(1, entry.memory_usage)
+        self.priorities[key] = (priority, hits)
+        heapq.heappush(self.heap, (priority, next(self.sequence), key))
+        if len(self.heap) > 2 * len(self.priorities) + 64:
+            self.heap = [(priority, next(self.sequence), key) for key, (priority, _) in self.priorities.items()]
+            heapq.heapify(self.heap)
+
+    def on_get(self, key: Hashable, entry: Optional[Any]):
+        if entry is not None:
+            self._push(key, entry, self.priorities[key][1] + 1)
+
+    def on_insert(self, key: Hashable, entry: Any):
+        self._push(key, entry, 1)
+
+    def on_remove(self, key: Hashable, entry: Any):
+        del self.priorities[key]
+
+    def victim(self, table: 'OrderedDict[Hashable, Any]') -> Hashable:
+        while True:
+            priority, _, key = self.heap[0]
+            current = self.priorities.get(key)
+            if current is not None and current[0] == priority:
+                self.inflation = priority
+                return key
+            heapq.heappop(self.heap)
@@ -0,0 +1,101 @@
+from types import MappingProxyType
+from typing import Any
+
+import orjson as json
+
+
+class Codec(object):
+    '''
+    Converts results to the form kept in the cache and back.
+    '''
+    # True when decode hands out the stored object itself
+    shared = False
+
+    def encode(self, value: Any) -> Any:
+        raise NotImplementedError # pragma: no cover
+
+    def decode(self, stored: Any) -> Any:
+        raise NotImplementedError # pragma: no cover
+
+    def size(self, stored: Any) -> int:
+        '''
+        :return: estimated bytes held by a stored value
+        '''
+        raise NotImplementedError # pragma: no cover
+
+
+class JsonCodec(Codec):
+    '''
+    Stores results as JSON bytes; every hit parses a fresh copy. Values JSON
+    has no type for (datetime, Decimal) come back as strings.
+    '''
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value)
+
+    def decode(self, stored: bytes) -> Any:
+        return json.loads(stored)
+
+    def size(self, stored: bytes) -> int:
+        return len(stored)
+
+
+def freeze(value: Any) -> Any:
+    cls = value.__class__
+    if cls is dict:
+        return MappingProxyType(dict(value))
+    if cls is list or cls is tuple:
+        return tuple([freeze(item) for item in value])
+    return value
+
+
+def frozen_size(value: Any) -> int:
+    # rough shallow estimate: container headers, 8 bytes per reference and
+    # the length of strings, without walking into other objects
+    cls = value.__class__
+    if cls is MappingProxyType:
+        size = 48 + 104 + 40 * len(value)
+        for item in value.values():
+            item_cls = item.__class__
+            size += len(item) + 49 if item_cls is str or item_cls is bytes else 32
+        return size
+    if cls is tuple:
+        return 40 + sum([8 + frozen_size(item) for item in value])
+    if cls is str or cls is bytes:
+        return 49 + len(value)
+    return 32
+
+
+def thaw(value: Any) -> Any:
+    cls = value.__class__
+    if cls is MappingProxyType:
+        return dict(value)
+    if cls is tuple:
+        return [thaw(item) for item in value]
+    return value
+
+
+class FrozenCodec(Codec):
+    '''
+    Stores results as read-only structures: rows become mappingproxy views
+    and lists become tuples. A hit returns the stored structure as is, so it
+    costs the same for one row or a million. Column values themselves are
+    not copied, so treat them as read-only too.
+
+    :param copy_on_read: hand out a fresh list of dicts on every hit instead,
+        for callers that modify results
+    '''
+    def __init__(self, copy_on_read: bool=False):
+        self.copy_on_read = copy_on_read
+        self.shared = not copy_on_read
+
+    def encode(self, value: Any) -> Any:
+        return freeze(value)
+
+    def decode(self, stored: Any) -> Any:
+        if not self.copy_on_read:
+            return stored
+        return thaw(stored)
+
+    def size(self, stored: Any) -> int:
+        return frozen_size(stored)
+
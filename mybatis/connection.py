@@ -83,6 +83,19 @@ class AbstractConnection(ABC):
     def reconnect(self, attempts, delay):
         pass # pragma: no cover
 
+    def supports_array_binding(self):
+        '''
+        :return: whether a Python list can be bound as a single array parameter
+        '''
+        return False
+
+    def set_statement_timeout(self, timeout_ms: Optional[int]):
+        '''
+        Limits how long the statements executed from now on may run; None removes the limit.
+        Connections that cannot enforce a limit ignore it.
+        '''
+        pass
+
 
 class MySQLCursor(AbstractCursor):
     def __init__(self, cursor: MySQLCursorAbstract, *args, **kwargs):
@@ -140,6 +153,7 @@ class MySQLCursor(AbstractCursor):
 class MySQLConnection(AbstractConnection):
     def __init__(self, conn: MySQLConnectionAbstract):
         self.conn = conn
+        self.statement_timeout_ms = None
 
     def cursor(self, *args, **kwargs) -> AbstractCursor:
         try:
@@ -171,7 +185,16 @@ class MySQLConnection(AbstractConnection):
     def need_returning_id(self):
         return False
 
+    def set_statement_timeout(self, timeout_ms: Optional[int]):
+        # MAX_EXECUTION_TIME only applies to SELECT statements
+        if timeout_ms == self.statement_timeout_ms:
+            return
+        with self.cursor() as cursor:
+            cursor.execute("SET SESSION MAX_EXECUTION_TIME = %s", (timeout_ms or 0,))
+        self.statement_timeout_ms = timeout_ms
+
     def reconnect(self, attempts, delay):
+        self.statement_timeout_ms = None
         try:
             self.conn.reconnect(attempts, delay)
         except mysql.connector.Error as err:
@@ -241,6 +264,7 @@ class PostgreSQLCursor(AbstractCursor):
 class PostgreSQLConnection(AbstractConnection):
     def __init__(self, conn: PostgreSQLConnectionRaw):
         self.conn = conn
+        self.statement_timeout_ms = None
         # self.prepared = False
 
     def cursor(self, *args, **kwargs) -> AbstractCursor:
@@ -269,6 +293,8 @@ class PostgreSQLConnection(AbstractConnection):
             raise DatabaseError(str(err))
 
     def rollback(self):
+        # a SET inside the rolled back transaction is undone too
+        self.statement_timeout_ms = -1
         try:
             self.conn.rollback()
         except psycopg2.errors.Error as err:
@@ -277,7 +303,18 @@ class PostgreSQLConnection(AbstractConnection):
     def need_returning_id(self):
         return True
 
+    def supports_array_binding(self):
+        return True
+
+    def set_statement_timeout(self, timeout_ms: Optional[int]):
+        if timeout_ms == self.statement_timeout_ms:
+            return
+        with self.cursor() as cursor:
+            cursor.execute("SELECT set_config('statement_timeout', ?, false)", (str(timeout_ms or 0),))
+        self.statement_timeout_ms = timeout_ms
+
     def reconnect(self, attempts, delay):
+        self.statement_timeout_ms = -1
         for i in range(attempts):
             try:
                 if self.conn.closed:
@@ -292,17 +329,34 @@ class PostgreSQLConnection(AbstractConnection):
             raise DatabaseError(str("Reconnecting failed."))
 
 class Sqlite3Cursor(AbstractCursor):
-    def __init__(self, cursor: Sqlite3CursorRaw, *args, **kwargs):
+    def __init__(self, cursor: Sqlite3CursorRaw, connection: Optional["Sqlite3Connection"]=None, *args, **kwargs):
         self.cursor = cursor
+        self.connection = connection
+        # whether this cursor installed the statement timeout handler
+        self.timed = False
 
     def execute(self, query: str, param_list: Sequence = None):
+        if self.connection is not None:
+            self.timed = self.connection.start_statement_timeout()
+        done = False
         try:
             if param_list is None:
-                return self.cursor.execute(query)
+                ret = self.cursor.execute(query)
             else:
-                return self.cursor.execute(query, param_list)
+                ret = self.cursor.execute(query, param_list)
+            done = True
+            return ret
         except sqlite3.Error as err:
             raise DatabaseError(str(err))
+        finally:
+            if not done:
+                self._end_statement_timeout()
+
+    def _end_statement_timeout(self):
+        # the deadline also covers the fetches, up to the closing of the cursor
+        if self.timed:
+            self.timed = False
+            self.connection.end_statement_timeout()
 
     def rowcount(self):
         return self.cursor.rowcount
@@ -336,12 +390,17 @@ class Sqlite3Cursor(AbstractCursor):
             self.cursor.close()
         except sqlite3.Error as err:
             raise DatabaseError(str(err))
+        finally:
+            self._end_statement_timeout()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cursor.close()
+        try:
+            self.cursor.close()
+        finally:
+            self._end_statement_timeout()
         if exc_type:
             print(f"An exception occurred: {exc_val}")
         return False
@@ -349,13 +408,14 @@ class Sqlite3Cursor(AbstractCursor):
 class Sqlite3Connection(AbstractConnection):
     def __init__(self, conn: Sqlite3ConnectionRaw):
         self.conn = conn
+        self.statement_timeout_ms = None
 
     def cursor(self, *args, **kwargs) -> AbstractCursor:
         prepared = False
         if 'prepared' in kwargs:
             prepared = kwargs['prepared']
             del kwargs['prepared']
-        return Sqlite3Cursor(cursor=self.conn.cursor(*args, **kwargs))
+        return Sqlite3Cursor(self.conn.cursor(*args, **kwargs), self)
 
     def close(self):
         self.conn.close()
@@ -381,6 +441,22 @@ class Sqlite3Connection(AbstractConnection):
     def need_returning_id(self):
         return False
 
+    def set_statement_timeout(self, timeout_ms: Optional[int]):
+        self.statement_timeout_ms = timeout_ms
+
+    def start_statement_timeout(self) -> bool:
+        # SQLite has no server side limit; a progress handler aborts the
+        # statement with "interrupted" once the deadline has passed. Each
+        # statement gets its own deadline and the handler goes with its cursor.
+        if self.statement_timeout_ms is None:
+            return False
+        deadline = time.monotonic() + self.statement_timeout_ms / 1000
+        self.conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        return True
+
+    def end_statement_timeout(self):
+        self.conn.set_progress_handler(None, 0)
+
     def reconnect(self, attempts, delay):
         pass
 
@@ -0,0 +1,259 @@
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import orjson as json
+
+from .cache import CacheKey, EMPTY_RESULT, key_digest, HITS, MISSES, PUTS, REJECTED, EVICTED_CAPACITY, \
+    EVICTED_EXPIRED, EVICTED_INVALIDATED, ENTRIES, MEMORY_USED, STAT_NAMES, stats_snapshot
+from .cache_backend import CacheBackend
+from .binary_codec import BinaryCodec
+from .codec import Codec
+
+# stored instead of the codec bytes for EMPTY_RESULT
+EMPTY_VALUE = b"\x00EMPTY_RESULT"
+# bytes counted per row on top of the value, for the key, the tags and the indexes
+ROW_OVERHEAD = 128
+# kept in PRAGMA user_version; bump whenever the tables or the default codec change
+DISK_VERSION = 1
+
+
+class DiskCache(CacheBackend):
+    '''
+    Cache kept in a SQLite file: larger than memory, slower than Cache, and
+    still there after a restart. Entries are dropped least recently used
+    first once memory_limit bytes are stored. It is meant as the second tier
+    of a TieredCache, but works on its own as well.
+
+    The codec must encode to bytes. Expiry uses the wall clock, as the file
+    outlives the process.
+
+    :param path: file of the cache, created when missing
+    :param memory_limit: bytes of values the file may hold
+    '''
+    def __init__(self, path: str, memory_limit: int, max_live_ms: int, codec: Optional[Codec]=None):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.max_live_ms = max_live_ms
+        self.codec = BinaryCodec() if codec is None else codec
+        if not isinstance(self.codec.encode([{"id": 1}]), bytes):
+            raise Exception("Invalid codec: DiskCache needs a codec that encodes to bytes")
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS cache_entries (
+            digest BLOB PRIMARY KEY,
+            id TEXT,
+            value BLOB,
+            size INTEGER,
+            expires_at INTEGER,
+            last_used INTEGER,
+            tags TEXT)''')
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_entries_last_used ON cache_entries (last_used)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_entries_expires_at ON cache_entries (expires_at)")
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS cache_tags (
+            tag TEXT,
+            digest BLOB,
+            PRIMARY KEY (tag, digest)) WITHOUT ROWID''')
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_tags_digest ON cache_tags (digest)")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != DISK_VERSION:
+            # rows written by another version may not decode, they are only a cache
+            self.connection.execute("DELETE FROM cache_entries")
+            self.connection.execute("DELETE FROM cache_tags")
+            self.connection.execute("PRAGMA user_version = %d" % DISK_VERSION)
+        self.memory_used = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        # statement id -> counters of this process, see STAT_NAMES
+        self.statement_stats: Dict[Optional[str], List[int]] = {}
+        # last_used only orders the rows, a counter avoids ties within a millisecond
+        self.clock = self.connection.execute("SELECT COALESCE(MAX(last_used), 0) FROM cache_entries").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _counters(self, id: Optional[str]) -> List[int]:
+        counters = self.statement_stats.get(id)
+        if counters is None:
+            counters = self.statement_stats[id] = [0] * len(STAT_NAMES)
+        return counters
+
+    def _tick(self) -> int:
+        self.clock += 1
+        return self.clock
+
+    def lookup(self, key: CacheKey, record_stats: bool=True) -> Optional[Tuple[Any, Tuple[str, ...], int, int]]:
+        '''
+        :return: (value, tags, remaining lifetime in ms, size of the encoded value) or None when the key
+            is not cached
+        '''
+        digest = key_digest(key)
+        now = int(time.time() * 1000)
+        with self.lock:
+            row = self.connection.execute("SELECT value, expires_at, tags FROM cache_entries WHERE digest = ?",
+                                          (digest,)).fetchone()
+            if row is not None and row[1] < now:
+                self._delete([digest], key.id, EVICTED_EXPIRED)
+                row = None
+            if row is not None:
+                self.connection.execute("UPDATE cache_entries SET last_used = ? WHERE digest = ?",
+                                        (self._tick(), digest))
+            if record_stats:
+                self._counters(key.id)[MISSES if row is None else HITS] += 1
+        if row is None:
+            return None
+        stored, expires_at, tags = row
+        value = EMPTY_RESULT if stored == EMPTY_VALUE else self.codec.decode(stored)
+        return value, tuple(json.loads(tags)), expires_at - now, len(stored)
+
+    def get(self, key: CacheKey, record_stats: bool=True) -> Optional[Any]:
+        found = self.lookup(key, record_stats)
+        return None if found is None else found[0]
+
+    def put(self, key: CacheKey, value: Any, tags: Iterable[str]=(), max_live_ms: Optional[int]=None,
+            cost: Optional[float]=None, refresh_after_ms: Optional[int]=None) -> Any:
+        '''
+        :param cost: ignored; entries are dropped least recently used first
+        :param refresh_after_ms: ignored; entries are served until they expire
+        :return: value
+        '''
+        self.put_encoded(key, EMPTY_VALUE if value is EMPTY_RESULT else self.codec.encode(value), tags, max_live_ms)
+        return value
+
+    def put_encoded(self, key: CacheKey, encoded: bytes, tags: Iterable[str]=(), max_live_ms: Optional[int]=None):
+        '''
+        Stores a value already encoded by a codec of the same class, such as a value spilled by a TieredCache
+        whose first tier uses it, without decoding and encoding it again.
+        '''
+        tags = list(tags)
+        digest = key_digest(key)
+        size = ROW_OVERHEAD + len(encoded)
+        expires_at = int(time.time() * 1000) + (self.max_live_ms if max_live_ms is None else max_live_ms)
+
+        with self.lock:
+            counters = self._counters(key.id)
+            if size > self.memory_limit:
+                counters[REJECTED] += 1
+                return
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete([digest], key.id, None)
+                connection.execute("INSERT INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (digest, key.id, encoded, size, expires_at, self._tick(),
+                                    json.dumps(tags).decode()))
+                connection.executemany("INSERT OR IGNORE INTO cache_tags VALUES (?, ?)",
+                                       [(tag, digest) for tag in tags])
+                self.memory_used += size
+                if self.memory_used > self.memory_limit:
+                    self._evict()
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                self.memory_used = connection.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+                raise
+            counters[PUTS] += 1
+
+    def _evict(self):
+        # expired rows go first, then the least recently used ones
+        self._delete_where("expires_at < ?", (int(time.time() * 1000),), EVICTED_EXPIRED)
+        used = self.memory_used
+        victims = []
+        for digest, id, size in self.connection.execute(
+                "SELECT digest, id, size FROM cache_entries ORDER BY last_used"):
+            if used <= self.memory_limit:
+                break
+            victims.append((digest, id))
+            used -= size
+        for digest, id in victims:
+            self._delete([digest], id, EVICTED_CAPACITY)
+
+    def _delete(self, digests: List[bytes], id: Optional[str], cause: Optional[int]) -> int:
+        connection = self.connection
+        deleted = 0
+        for digest in digests:
+            row = connection.execute("SELECT size FROM cache_entries WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                continue
+            connection.execute("DELETE FROM cache_entries WHERE digest = ?", (digest,))
+            connection.execute("DELETE FROM cache_tags WHERE digest = ?", (digest,))
+            self.memory_used -= row[0]
+            deleted += 1
+            if cause is not None:
+                self._counters(id)[cause] += 1
+        return deleted
+
+    def _delete_where(self, condition: str, params: Tuple, cause: int) -> int:
+        rows = self.connection.execute("SELECT digest, id FROM cache_entries WHERE " + condition, params).fetchall()
+        for digest, id in rows:
+            self._delete([digest], id, cause)
+        return len(rows)
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        '''
+        :return: number of entries dropped
+        '''
+        tags = list(tags)
+        if not tags:
+            return 0
+        with self.lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                count = self._delete_where(
+                    "digest IN (SELECT digest FROM cache_tags WHERE tag IN (%s))" % ", ".join(["?"] * len(tags)),
+                    tuple(tags), EVICTED_INVALIDATED)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return count
+
+    def clear(self):
+        with self.lock:
+            for id, count in self.connection.execute("SELECT id, COUNT(*) FROM cache_entries GROUP BY id"):
+                self._counters(id)[EVICTED_INVALIDATED] += count
+            self.connection.execute("DELETE FROM cache_entries")
+            self.connection.execute("DELETE FROM cache_tags")
+            self.memory_used = 0
+
+    def expire(self) -> int:
+        with self.lock:
+            connection = self.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                count = self._delete_where("expires_at < ?", (int(time.time() * 1000),), EVICTED_EXPIRED)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return count
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        :return: a snapshot as for Cache; entries and memory_used count the rows in the file,
+            the other counters this process only
+        '''
+        with self.lock:
+            statement_stats = {id: list(counters) for id, counters in self.statement_stats.items()}
+            rows = self.connection.execute(
+                "SELECT id, COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries GROUP BY id").fetchall()
+        for counters in statement_stats.values():
+            counters[ENTRIES] = 0
+            counters[MEMORY_USED] = 0
+        for id, count, size in rows:
+            counters = statement_stats.setdefault(id, [0] * len(STAT_NAMES))
+            counters[ENTRIES] = count
+            counters[MEMORY_USED] = size
+        return stats_snapshot([statement_stats], self.memory_limit)
+
+    def reset_stats(self):
+        with self.lock:
+            self.statement_stats.clear()
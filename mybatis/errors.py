@@ -5,4 +5,8 @@ class Error(Exception):
 
 class DatabaseError(Error):
     def __init__(self, message):
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+class FlightTimeoutError(Error):
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,92 @@
+import ast
+from typing import Dict, Optional
+
+SAFE_BUILTINS = {
+    'len': len,
+    'isinstance': isinstance,
+    'list': list,
+    'tuple': tuple,
+    'dict': dict,
+    'set': set,
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'any': any,
+    'all': all,
+}
+
+SAFE_METHODS = {'get', 'keys', 'values', 'items', 'startswith', 'endswith', 'lower', 'upper', 'strip', 'count'}
+
+ALLOWED_NODES = tuple(node for node in (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Is, ast.IsNot, ast.In, ast.NotIn,
+    ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant, ast.Subscript, ast.Slice, getattr(ast, 'Index', None),
+    ast.Attribute, ast.Tuple, ast.List, ast.Set, ast.Dict,
+) if node is not None)
+
+
+class Expression:
+    __slots__ = ('source', 'code', 'name')
+
+    def __init__(self, source: str, code, name: Optional[str]):
+        self.source = source
+        self.code = code
+        # set when the expression is a bare identifier, which lets
+        # collection lookups skip eval entirely
+        self.name = name
+
+    def evaluate(self, namespace: dict):
+        return eval(self.code, namespace)
+
+    def evaluate_in(self, params: dict):
+        if self.name is not None:
+            return params.get(self.name)
+        return eval(self.code, {'__builtins__': SAFE_BUILTINS}, params)
+
+    def __reduce__(self):
+        # code objects do not pickle; recompiling also re-validates the source
+        return compile_expression, (self.source,)
+
+
+_expression_cache: Dict[str, Expression] = {}
+
+
+def _validate(tree: ast.AST, source: str):
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise Exception("Unsupported expression: " + source)
+        if isinstance(node, ast.Name) and node.id.startswith('__'):
+            raise Exception("Unsupported expression: " + source)
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise Exception("Unsupported expression: " + source)
+        if isinstance(node, ast.Call):
+            if node.keywords:
+                raise Exception("Unsupported expression: " + source)
+            func = node.func
+            if isinstance(func, ast.Name):
+                if func.id not in SAFE_BUILTINS:
+                    raise Exception("Unsupported expression: " + source)
+            elif not (isinstance(func, ast.Attribute) and func.attr in SAFE_METHODS):
+                raise Exception("Unsupported expression: " + source)
+
+
+def compile_expression(source: str) -> Expression:
+    expression = _expression_cache.get(source)
+    if expression is not None:
+        return expression
+
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError:
+        raise Exception("Invalid expression: " + source)
+    _validate(tree, source)
+
+    name = tree.body.id if isinstance(tree.body, ast.Name) else None
+    expression = Expression(source, compile(tree, '<expression>', 'eval'), name)
+    _expression_cache[source] = expression
+    return expression
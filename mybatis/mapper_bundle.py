@@ -0,0 +1,138 @@
+import hashlib
+import io
+import os
+import pickle
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from .sql_node import MappedStatement
+from .version import __version__
+
+BUNDLE_MAGIC = b"MYBATISB"
+# bump whenever the layout of the compiled SqlNode classes changes; bundles
+# written by another release of the package are rebuilt as well
+BUNDLE_VERSION = 5
+# magic, format version, package version, SHA-256 of the payload
+BUNDLE_HEADER = struct.Struct("<8sH32s32s")
+
+# below this many changed files a process pool costs more than it saves
+PARALLEL_PARSE_MIN_FILES = 8
+
+
+class BundleEntry:
+    __slots__ = ('mtime_ns', 'size', 'digest', 'statements')
+
+    def __init__(self, mtime_ns: int, size: int, digest: bytes, statements: List[MappedStatement]):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.statements = statements
+
+
+def _file_digest(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def _package_version() -> bytes:
+    # as struct pads the 32s field
+    return __version__.encode()[:32].ljust(32, b"\0")
+
+
+def _parse_file(path: str) -> Tuple[bytes, List[MappedStatement]]:
+    from .mapper_manager import MapperManager
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    return hashlib.sha256(data).digest(), MapperManager.parse_mapper_xml_file(io.BytesIO(data))
+
+
+class MapperBundle:
+    '''
+    On-disk cache of compiled mapper files: a header with a magic string, a
+    format version, the package version and the SHA-256 of the payload,
+    followed by the pickled
+    statements of every file. The bundle is trusted like the mapper files
+    themselves, so keep it somewhere only the application can write.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Dict[str, BundleEntry]:
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return {}
+
+        if len(data) < BUNDLE_HEADER.size:
+            return {}
+        magic, version, package_version, checksum = BUNDLE_HEADER.unpack_from(data)
+        payload = memoryview(data)[BUNDLE_HEADER.size:]
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION or package_version != _package_version() \
+                or hashlib.sha256(payload).digest() != checksum:
+            return {}
+        try:
+            return pickle.loads(payload)
+        except Exception:
+            return {}
+
+    def save(self, entries: Dict[str, BundleEntry]):
+        payload = pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+        header = BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, _package_version(), hashlib.sha256(payload).digest())
+
+        # several workers may rebuild at once; each writes its own file and
+        # the last rename wins
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".mybatis-bundle-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load_mapper_dir(self, mapper_path: str) -> List[Tuple[str, List[MappedStatement]]]:
+        '''
+        :return: (path, statements) of every *.xml file in mapper_path
+        '''
+        cached = self.load()
+        file_name_l = sorted([name for name in os.listdir(mapper_path) if name.endswith(".xml")])
+
+        entries = {}
+        to_parse = []
+        dirty = set(cached) != set(file_name_l)
+        for file_name in file_name_l:
+            full_path = os.path.join(mapper_path, file_name)
+            stat = os.stat(full_path)
+            entry = cached.get(file_name)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                entries[file_name] = entry
+                continue
+
+            dirty = True
+            if entry is not None and entry.size == stat.st_size and entry.digest == _file_digest(full_path):
+                # touched but not modified
+                entries[file_name] = BundleEntry(stat.st_mtime_ns, stat.st_size, entry.digest, entry.statements)
+                continue
+            to_parse.append((file_name, stat))
+
+        paths = [os.path.join(mapper_path, file_name) for file_name, _ in to_parse]
+        if len(paths) >= PARALLEL_PARSE_MIN_FILES and (os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor() as executor:
+                results = list(executor.map(_parse_file, paths, chunksize=4))
+        else:
+            results = [_parse_file(path) for path in paths]
+
+        for (file_name, stat), (digest, statements) in zip(to_parse, results):
+            entries[file_name] = BundleEntry(stat.st_mtime_ns, stat.st_size, digest, statements)
+
+        ret = [(os.path.join(mapper_path, file_name), entries[file_name].statements) for file_name in file_name_l]
+        if dirty:
+            self.save(entries)
+        return ret
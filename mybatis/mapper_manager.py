@@ -1,14 +1,36 @@
+import itertools
+import os
 import xml.etree.ElementTree as et
-from typing import Tuple, Set
-import re
+from collections import OrderedDict
+from typing import Tuple, List, Optional, Dict, Set
+
+from .sql_node import (bind_params, bucket_size, text_node, DynamicContext,
+                       SqlNode, MixedSqlNode, IncludeSqlNode, IfSqlNode, ChooseSqlNode, TrimSqlNode, SetSqlNode,
+                       WhereSqlNode, ForEachSqlNode, MappedStatement)
+from .expression import compile_expression
+from .sql_tables import UNKNOWN_TABLE, extract_tables, normalize_table
+from .mapper_bundle import MapperBundle
+
+_decorator_ids = itertools.count(1)
+_generations = itertools.count(1)
 
 class MapperManager:
-    def __init__(self):
-        self.id_2_element_map = {}
-        self.param_pattern = re.compile(r"#{([a-zA-Z0-9_\-]+)}")
-        self.replace_pattern = re.compile(r"\${([a-zA-Z0-9_\-]+)}")
+    def __init__(self, sql_cache_size: int=1024):
+        self.id_2_statement_map = {}
+        self.unresolved_statements = []
+        # (id, generation, shape) -> (sql, parameter getters), in LRU order
+        self.sql_cache = OrderedDict()
+        self.sql_cache_size = sql_cache_size
+        # absolute path -> (st_mtime_ns, st_size) / statement ids, for reloading
+        self.file_stats = {}
+        self.file_2_ids = {}
+        # compiled decorator SQL with <include>s
+        self.decorator_statements = []
+        # statement id -> (read tables, written tables), including included fragments
+        self.tables_cache = {}
 
-    def read_mapper_xml_file(self, mapper_xml_file_path):
+    @staticmethod
+    def parse_mapper_xml_file(mapper_xml_file_path) -> List[MappedStatement]:
         namespace = ""
         root = et.parse(mapper_xml_file_path).getroot()
         for child in root.iter():
@@ -18,346 +40,433 @@ class MapperManager:
                 root = child
                 break
 
+        statements = []
         for child in root:
-            child_id = child.attrib["id"]
+            if not isinstance(child.tag, str):
+                continue
+            child_id = child.attrib.get("id")
             if child_id is None:
                 raise Exception("Missing id")
-            if namespace == "":
-                self.id_2_element_map[child_id] = child
-            else:
-                self.id_2_element_map[namespace+"."+child_id] = child
-
-
-    # @staticmethod
-    # def _trim_prefix(s : str, prefixes : Set[str]):
-    #     l = [term.strip() for term in s.split()]
-    #     idx = 0
-    #     for term in l:
-    #         if term in prefixes:
-    #             idx += 1
-    #             continue
-    #         else:
-    #             break
-    #
-    #     return " ".join(l[idx:])
+            if namespace != "":
+                child_id = namespace + "." + child_id
+            includes = []
+            root_node = MapperManager._compile_contents(child, includes)
+            read_tables, write_tables = extract_tables("".join(child.itertext()))
+            statements.append(MappedStatement(child_id, namespace, child.tag, root_node, includes,
+                                              read_tables=read_tables, write_tables=write_tables,
+                                              **MapperManager._parse_options(child)))
+        return statements
 
     @staticmethod
-    def _trim_prefix(s: str, prefixes: Set[str]):
-        p = [term[0] for term in sorted([(prefix, len(prefix)) for prefix in prefixes], key=lambda x: x[1], reverse=True)]
-        l = [term.strip() for term in s.split()]
-        s = " ".join(l)
-        while True:
-            to_break = True
-            for prefix in p:
-                if s.startswith(prefix):
-                    s = s[len(prefix):].strip()
-                    to_break = False
-                    break
-            if to_break:
-                break
-
-        return s.strip()
+    def _parse_options(element: et.Element) -> dict:
+        attrib = element.attrib
+        options = {}
+        for name, key in (("fetchSize", "fetch_size"), ("timeout", "timeout_ms"), ("cacheMaxLiveMs", "cache_max_live_ms"),
+                          ("cacheRefreshAfterMs", "cache_refresh_after_ms")):
+            if name in attrib:
+                try:
+                    value = float(attrib[name]) if name == "timeout" else int(attrib[name])
+                except ValueError:
+                    raise Exception("Invalid " + name + ": " + attrib[name])
+                if value <= 0:
+                    raise Exception("Invalid " + name + ": " + attrib[name])
+                # timeout is in seconds as in MyBatis
+                options[key] = int(value * 1000) if name == "timeout" else value
+        for name, key in (("useCache", "use_cache"), ("flushCache", "flush_cache")):
+            if name in attrib:
+                value = attrib[name].strip().lower()
+                if value not in ("true", "false"):
+                    raise Exception("Invalid " + name + ": " + attrib[name])
+                options[key] = value == "true"
+        if "tables" in attrib:
+            options["tables"] = MapperManager._parse_tables(attrib["tables"])
+        return options
 
     @staticmethod
-    def _trim_suffix(s: str, suffixes: Set[str]):
-        suffixes = [term[0] for term in
-             sorted([(suffix, len(suffix)) for suffix in suffixes], key=lambda x: x[1], reverse=True)]
-        l = [term.strip() for term in s.split()]
-        s = " ".join(l)
-        while True:
-            to_break = True
-            for suffix in suffixes:
-                if s.endswith(suffix):
-                    s = s[:-1*len(suffix)].strip()
-                    to_break = False
-                    break
-            if to_break:
-                break
+    def _parse_tables(tables: str) -> List[str]:
+        return [normalize_table(table.strip()) for table in tables.split(",") if table.strip()]
 
-        return s.strip()
-
-    def parse_element(self, element : et.Element, param: dict) -> str:
-        # print ("++++>", element)
-        ret = ""
-        # if element.text is not None:
-        #     ret += element.text
-
-        if element.tag == "include":
-            refid = element.attrib['refid']
-            ref_element = self.id_2_element_map[refid]
-            ret = ""
-            ret += self.parse_element(ref_element, param)
-            return ret
-        elif element.tag == "sql":
-            ret += element.text
-            for child in element:
-                ret += self.parse_element(child, param)
-                ret += child.tail
-            return ret
-        elif element.tag == "if":
-            test_attribute = element.attrib['test']
-            ok = eval(test_attribute, param)
-            if ok:
-                ret += element.text
-                for child in element:
-                    ret += self.parse_element(child, param)
-                    ret += child.tail
-            return ret
-        elif element.tag == "where":
-            temp = ""
-            if element.text is not None:
-                temp += element.text
-            for child in element:
-                temp += self.parse_element(child, param)
-                if child.tail is not None:
-                    temp += child.tail
-
-            temp = temp.strip()
-            l = temp.split()
-            idx = 0
-            for _ in range(0, len(l)):
-                if l[idx].upper() == 'AND' or l[idx].upper() == 'OR':
-                    idx += 1
-                    continue
-                else:
-                    break
-
-            if len(l) == idx:
-                return ""
-            else:
-                return "WHERE " + ' '.join(l[idx:])
-        elif element.tag == "trim":
-            prefix = ""
-            if 'prefix' in element.attrib:
-                prefix = element.attrib['prefix']
-
-            suffix = ""
-            if 'suffix' in element.attrib:
-                suffix = element.attrib['suffix']
-
-            if 'prefixOverrides' in element.attrib:
-                prefix_overrides_set = set([term.strip() for term in element.attrib['prefixOverrides'].split("|")])
-            else:
-                prefix_overrides_set = set()
-
-            if 'suffixOverrides' in element.attrib:
-                suffix_overrides_set = set([term.strip() for term in element.attrib['suffixOverrides'].split("|")])
+    def read_mapper_xml_file(self, mapper_xml_file_path):
+        stat = os.stat(mapper_xml_file_path)
+        statements = MapperManager.parse_mapper_xml_file(mapper_xml_file_path)
+        self.add_statements(statements)
+        self._track_file(mapper_xml_file_path, stat, statements)
+
+    def read_mapper_dir(self, mapper_path: str, bundle_path: Optional[str]=None):
+        '''
+        Reads every *.xml file of a directory.
+        :param bundle_path: file caching the compiled statements between runs; only mapper files whose
+            modification time and content changed since it was written are parsed again
+        '''
+        if bundle_path is None:
+            for path in self._list_mapper_dir(mapper_path):
+                self.read_mapper_xml_file(path)
+            return
+
+        for path, statements in MapperBundle(bundle_path).load_mapper_dir(mapper_path):
+            self.add_statements(statements)
+            self._track_file(path, os.stat(path), statements)
+
+    def add_statements(self, statements: List[MappedStatement]):
+        for statement in statements:
+            statement.generation = next(_generations)
+            self.id_2_statement_map[statement.id] = statement
+
+        # a redefined fragment replaces the one linked into the statements already read
+        linked = [statement for statement in self.id_2_statement_map.values() if statement.includes]
+        self.unresolved_statements = self._link(self.id_2_statement_map, linked + self.decorator_statements)
+        # a redefined fragment can change the text of any statement including it
+        self._renew_generations(self.id_2_statement_map.values(), None)
+        self.sql_cache.clear()
+        self.tables_cache.clear()
+
+    def reload_mapper_dir(self, mapper_path: str) -> Set[str]:
+        '''
+        Parses again the mapper files of a directory that were added, modified or removed since they were read.
+        :return: ids of the statements whose SQL may have changed, including statements that include them
+        '''
+        paths = self._list_mapper_dir(mapper_path)
+        changes = {}
+        for path in paths:
+            key = os.path.abspath(path)
+            stat = os.stat(path)
+            if self.file_stats.get(key) != (stat.st_mtime_ns, stat.st_size):
+                changes[key] = (stat, MapperManager.parse_mapper_xml_file(path))
+
+        directory = os.path.abspath(mapper_path)
+        present = set(os.path.abspath(path) for path in paths)
+        for key in self.file_2_ids:
+            if os.path.dirname(key) == directory and key not in present:
+                changes[key] = None
+        return self._replace_files(changes)
+
+    def reload_mapper_xml_file(self, mapper_xml_file_path) -> Set[str]:
+        '''
+        :return: ids of the statements whose SQL may have changed, including statements that include them
+        '''
+        stat = os.stat(mapper_xml_file_path)
+        statements = MapperManager.parse_mapper_xml_file(mapper_xml_file_path)
+        return self._replace_files({os.path.abspath(mapper_xml_file_path): (stat, statements)})
+
+    def _replace_files(self, changes: Dict[str, Optional[Tuple[os.stat_result, List[MappedStatement]]]]) -> Set[str]:
+        if not changes:
+            return set()
+
+        # everything is built and linked on a copy, so a bad file leaves the loaded statements untouched
+        statement_map = dict(self.id_2_statement_map)
+        changed_ids = set()
+        for key in changes:
+            for id in self.file_2_ids.get(key, ()):
+                statement_map.pop(id, None)
+                changed_ids.add(id)
+        for key, change in changes.items():
+            if change is not None:
+                for statement in change[1]:
+                    statement.generation = next(_generations)
+                    statement_map[statement.id] = statement
+                    changed_ids.add(statement.id)
+
+        linked = [statement for statement in statement_map.values() if statement.includes]
+        unresolved_statements = self._link(statement_map, linked + self.decorator_statements)
+        affected_ids = self._dependent_ids(linked + self.decorator_statements, changed_ids)
+        # after linking, so that a render stamped with the new generation sees the new fragments
+        self._renew_generations(linked, affected_ids)
+
+        self.id_2_statement_map = statement_map
+        self.unresolved_statements = unresolved_statements
+        for key, change in changes.items():
+            if change is None:
+                self.file_stats.pop(key, None)
+                self.file_2_ids.pop(key, None)
             else:
-                suffix_overrides_set = set()
-
-            ret = ""
-            if element.text is not None:
-                ret += element.text
-            for child in element:
-                ret += self.parse_element(child, param)
-                ret += child.tail
-
-            if len(prefix_overrides_set) > 0:
-                ret = MapperManager._trim_prefix(ret, prefix_overrides_set)
-
-            if len(suffix_overrides_set) > 0:
-                ret = MapperManager._trim_suffix(ret, suffix_overrides_set)
-
-            return prefix + " " + ret + " " + suffix
-
-        elif element.tag == "set":
-            prefix_overrides_set = set()
-            prefix_overrides_set.add(",")
-
-            ret = ""
-            if element.text is not None:
-                ret += element.text
-            for child in element:
-                ret += self.parse_element(child, param)
-                ret += child.tail
-
-            ret = MapperManager._trim_prefix(ret, prefix_overrides_set)
-            return "SET " + ret
-
-        elif element.tag == "choose":
-            ok = False
-            for child in element:
-                if child.tag == "when":
-                    test_condition = child.attrib['test']
-                    ok = eval(test_condition, param)
-                    if ok:
-                        ret += self.parse_element(child, param)
-                        break
-
-            if ok:
-                return ret
-
-            otherwise_ele = None
-            for child in element:
-                if child.tag == "otherwise":
-                    otherwise_ele = child
-                    break
-
-            if otherwise_ele is None:
-                raise Exception("Missing otherwise element")
-
-            ret = self.parse_element(otherwise_ele, param)
-            return ret
-        elif element.tag == "when":
-            ret = ""
-            if element.text is not None:
-                ret += element.text
-            for child in element:
-                ret += self.parse_element(child, param)
-                ret += child.tail
-            return ret
-        elif element.tag == "otherwise":
-            ret = ""
-            if element.text is not None:
-                ret += element.text
-            for child in element:
-                ret += self.parse_element(child, param)
-                ret += child.tail
-            return ret
-        elif element.tag == "foreach":
-            item = element.attrib['item']
-            collection = element.attrib['collection']
-            open = element.attrib['open']
-            close = element.attrib['close']
-            separator = element.attrib['separator']
-
-            islist = eval("isinstance("+collection+",list)", param['params'])
-            if not islist:
-                raise Exception("Collection must be a list")
-
-            eval_string = f"[item for item in {collection}]"
-            l = eval(eval_string, param['params'])
-
-            child_ret_l = []
-            for index, _ in enumerate(l):
-                child_ret = ""
-                if element.text is not None:
-                    child_ret += element.text
-                for child in element:
-                    child_ret += self.parse_element(child, param)
-                    child_ret += child.tail
-
-                old_string = "#{" + item + "}"
-                new_string = "#{" + collection + "-" + str(index) + "}"
-                child_ret = child_ret.replace(old_string, new_string)
-                child_ret_l.append(child_ret)
-
-            ret = open + separator.join(child_ret_l) + close
-
-            return ret
+                self._track_file(key, change[0], change[1])
+
+        for cache_key in list(self.sql_cache):
+            if cache_key[0] in affected_ids:
+                self.sql_cache.pop(cache_key, None)
+        self.tables_cache.clear()
+        return affected_ids
+
+    def _renew_generations(self, statements, ids: Optional[Set[str]]):
+        # SQL rendered from a statement fetched before a reload is cached under
+        # its old generation, where later renders never look
+        for statement in itertools.chain(statements, self.decorator_statements):
+            if statement.includes and (ids is None or statement.id in ids):
+                statement.generation = next(_generations)
+
+    def _track_file(self, path: str, stat: os.stat_result, statements: List[MappedStatement]):
+        key = os.path.abspath(path)
+        self.file_stats[key] = (stat.st_mtime_ns, stat.st_size)
+        self.file_2_ids[key] = [statement.id for statement in statements]
 
     @staticmethod
-    def _format_sql(sql):
-        sql = sql.strip()
-        l = sql.split()
-        return ' '.join(l)
-
-    def _to_prepared_statement(self, ret, param) -> Tuple[str, list]:
-        ret_param = []
-        matches = self.param_pattern.findall(ret)
-        for match in matches:
-            if '-' in match:
-                container_name, index = match.split('-', 1)
-                # print("====>", param[container_name][int(index)])
-                ret_param.append(param[container_name][int(index)])
-            else:
-                if match in param:
-                    ret_param.append(param[match])
-                else:
-                    ret_param.append(None)
-
-        ret = self.param_pattern.sub("?", ret)
-
-        ret = MapperManager._format_sql(ret)
+    def _list_mapper_dir(mapper_path: str) -> List[str]:
+        file_name_l = sorted([name for name in os.listdir(mapper_path) if name.endswith(".xml")])
+        return [os.path.join(mapper_path, file_name) for file_name in file_name_l]
 
-        return (ret, ret_param)
-
-    def _to_replace(self, ret, param) -> str:
-        matches = self.replace_pattern.findall(ret)
-        for match in matches:
-            value = ""
-            if match in param:
-                value = param[match]
-            ret = ret.replace("${"+match+"}", value)
+    @staticmethod
+    def _find_statement(statement_map: dict, refid: str, namespace: str) -> Optional[MappedStatement]:
+        statement = statement_map.get(refid)
+        if statement is None and namespace != "":
+            statement = statement_map.get(namespace + "." + refid)
+        return statement
+
+    def _link(self, statement_map: dict, statements: List[MappedStatement]) -> List[MappedStatement]:
+        # Resolves <include> references once the fragments they point at are
+        # loaded; statements whose fragments live in a file that has not been
+        # read yet are returned and stay pending until the next call.
+        pending = []
+        targets = []
+        for statement in statements:
+            resolved = True
+            for include in statement.includes:
+                target = self._find_statement(statement_map, include.refid, statement.namespace)
+                if target is None:
+                    resolved = False
+                targets.append((include, target))
+            self._check_circular_include(statement_map, statement, [statement.id])
+            if not resolved:
+                pending.append(statement)
+
+        for include, target in targets:
+            include.target = None if target is None else target.root
+        return pending
+
+    def _check_circular_include(self, statement_map: dict, statement: MappedStatement, path: List[str]):
+        for include in statement.includes:
+            target = self._find_statement(statement_map, include.refid, statement.namespace)
+            if target is None:
+                continue
+            if target.id in path:
+                raise Exception("Circular include: " + " -> ".join(path + [target.id]))
+            self._check_circular_include(statement_map, target, path + [target.id])
+
+    def _dependent_ids(self, statements: List[MappedStatement], ids: Set[str]) -> Set[str]:
+        ret = set(ids)
+        grown = True
+        while grown:
+            grown = False
+            for statement in statements:
+                if statement.id in ret:
+                    continue
+                for include in statement.includes:
+                    refid = include.refid
+                    if refid in ret or (statement.namespace != "" and statement.namespace + "." + refid in ret):
+                        ret.add(statement.id)
+                        grown = True
+                        break
         return ret
 
-
-    def select(self, id: str, params: dict) -> Tuple[str, list]:
-        if id not in self.id_2_element_map:
-            raise Exception("Missing id")
-        element = self.id_2_element_map[id]
-        if element.tag != "select":
-            raise Exception("Not a select")
-
-        ret = ""
-        if element.text is not None:
-            ret += element.text
-        param0 = {'params': params}
+    @staticmethod
+    def _compile_contents(element: et.Element, includes: List[IncludeSqlNode]) -> MixedSqlNode:
+        contents = []
+        # text around comments and processing instructions is joined up
+        text = element.text or ""
         for child in element:
-            ret += self.parse_element(child, param0)
-            ret += child.tail
-
-        sql, sql_param = self._to_prepared_statement(ret, params)
-        sql = self._to_replace(sql, params)
-        return (sql, sql_param)
+            if isinstance(child.tag, str):
+                if text:
+                    contents.append(text_node(text))
+                    text = ""
+                contents.append(MapperManager._compile_element(child, includes))
+            text += child.tail or ""
+        if text:
+            contents.append(text_node(text))
+        return MixedSqlNode(contents)
 
-    def update(self, id: str, params: dict) -> Tuple[str, list]:
-        if id not in self.id_2_element_map:
+    @staticmethod
+    def _compile_element(element: et.Element, includes: List[IncludeSqlNode]) -> SqlNode:
+        tag = element.tag
+        if tag == "include":
+            node = IncludeSqlNode(element.attrib['refid'])
+            includes.append(node)
+            return node
+        elif tag == "if":
+            return IfSqlNode(compile_expression(element.attrib['test']), MapperManager._compile_contents(element, includes))
+        elif tag == "where":
+            return WhereSqlNode(MapperManager._compile_contents(element, includes))
+        elif tag == "set":
+            return SetSqlNode(MapperManager._compile_contents(element, includes))
+        elif tag == "trim":
+            prefix_overrides = []
+            if 'prefixOverrides' in element.attrib:
+                prefix_overrides = list(set([term.strip() for term in element.attrib['prefixOverrides'].split("|")]))
+            suffix_overrides = []
+            if 'suffixOverrides' in element.attrib:
+                suffix_overrides = list(set([term.strip() for term in element.attrib['suffixOverrides'].split("|")]))
+            return TrimSqlNode(MapperManager._compile_contents(element, includes),
+                               element.attrib.get('prefix', ""), element.attrib.get('suffix', ""),
+                               prefix_overrides, suffix_overrides)
+        elif tag == "choose":
+            whens = []
+            otherwise = None
+            for child in element:
+                if child.tag == "when":
+                    whens.append(IfSqlNode(compile_expression(child.attrib['test']), MapperManager._compile_contents(child, includes)))
+                elif child.tag == "otherwise" and otherwise is None:
+                    otherwise = MapperManager._compile_contents(child, includes)
+            return ChooseSqlNode(whens, otherwise)
+        elif tag == "foreach":
+            return ForEachSqlNode(MapperManager._compile_contents(element, includes),
+                                  compile_expression(element.attrib['collection']), element.attrib['item'],
+                                  element.attrib.get('open', ""), element.attrib.get('close', ""),
+                                  element.attrib.get('separator', ""), element.attrib.get('bind'))
+        elif tag in ("sql", "when", "otherwise"):
+            return MapperManager._compile_contents(element, includes)
+        else:
+            raise Exception("Unknown element: " + str(tag))
+
+    def get_statement(self, id: str) -> MappedStatement:
+        statement = self.id_2_statement_map.get(id)
+        if statement is None:
             raise Exception("Missing id")
-        element = self.id_2_element_map[id]
-        if element.tag != "update":
-            raise Exception("Not an update")
-
-        ret = ""
-        if element.text is not None:
-            ret += element.text
-        param0 = {'params': params}
-        for child in element:
-            ret += self.parse_element(child, param0)
-            ret += child.tail
-
-        sql, sql_param = self._to_prepared_statement(ret, params)
-        sql = self._to_replace(sql, params)
-        return (sql, sql_param)
+        return statement
+
+    def compile_sql(self, sql: str, tag: str, tables: Optional[List[str]]=None) -> MappedStatement:
+        '''
+        Compiles the SQL of a decorator. SQL wrapped in <script>...</script> may use the same dynamic elements
+        as mapper files, including <include> of fragments loaded by this manager. The statement is not
+        registered under an id; render it with render_statement.
+        '''
+        id = "<decorator-" + str(next(_decorator_ids)) + ">"
+        if tables is not None:
+            tables = [normalize_table(table) for table in tables]
+        stripped = sql.strip()
+        if not stripped.startswith("<script>"):
+            read_tables, write_tables = extract_tables(sql)
+            return MappedStatement(id, "", tag, MixedSqlNode([text_node(sql)]), [], tables=tables,
+                                   read_tables=read_tables, write_tables=write_tables)
+
+        try:
+            element = et.fromstring(stripped)
+        except et.ParseError as e:
+            raise Exception("Invalid script: " + str(e))
+        includes = []
+        read_tables, write_tables = extract_tables("".join(element.itertext()))
+        statement = MappedStatement(id, "", tag, MapperManager._compile_contents(element, includes), includes,
+                                    tables=tables, read_tables=read_tables, write_tables=write_tables)
+        statement.generation = next(_generations)
+        if includes:
+            # relinked with the mapper statements when their files are reloaded
+            self.decorator_statements.append(statement)
+            self._link(self.id_2_statement_map, [statement])
+        return statement
+
+    def get_tables(self, statement: MappedStatement) -> Tuple[frozenset, frozenset]:
+        '''
+        :return: the tables a statement reads and writes, taken from its tables attribute if it has one and
+            otherwise from its text and the text of the fragments it includes
+        '''
+        tables = self.tables_cache.get(statement.id)
+        if tables is not None:
+            return tables
+
+        if statement.tables is not None:
+            explicit = frozenset(statement.tables)
+            tables = (explicit, explicit if statement.tag != "select" else frozenset())
+        else:
+            read_tables = set(statement.read_tables)
+            write_tables = set(statement.write_tables)
+            for include in statement.includes:
+                target = self._find_statement(self.id_2_statement_map, include.refid, statement.namespace)
+                if target is not None:
+                    target_read_tables, target_write_tables = self.get_tables(target)
+                    read_tables |= target_read_tables
+                    write_tables |= target_write_tables
+            if statement.tag == "select" and not read_tables:
+                # FROM and JOIN clauses not understood; any write may change the result
+                read_tables.add(UNKNOWN_TABLE)
+            tables = (frozenset(read_tables), frozenset(write_tables))
+        self.tables_cache[statement.id] = tables
+        return tables
+
+    def _render(self, id: str, tag: str, params: dict, array_binding: bool) -> Tuple[str, list]:
+        statement = self.get_statement(id)
+        if statement.tag != tag:
+            raise Exception("Not a" + ("n " if tag[0] in "aeiou" else " ") + tag)
+        return self.render_statement(statement, params, array_binding)
+
+    def render_statement(self, statement: MappedStatement, params: dict, array_binding: bool=False) -> Tuple[str, list]:
+        context = DynamicContext(params, array_binding=array_binding)
+        shape = []
+        # read before rendering: a reload relinks the fragments first and renews the generation after
+        generation = statement.generation
+        statement.root.shape(context, shape)
+        cache_key = (statement.id, generation, tuple(shape))
+
+        entry = self.sql_cache.get(cache_key)
+        if entry is None:
+            statement.root.apply(context)
+            entry = (context.sql(), context.refs)
+            if self.sql_cache_size > 0:
+                self.sql_cache[cache_key] = entry
+                if len(self.sql_cache) > self.sql_cache_size:
+                    self.sql_cache.popitem(last=False)
+        else:
+            try:
+                self.sql_cache.move_to_end(cache_key)
+            except KeyError:
+                pass
+
+        sql, refs = entry
+        return (sql, bind_params(refs, params))
+
+    def split_params(self, id: str, params: dict, param_count: int, max_params: int) -> List[dict]:
+        '''
+        Splits the longest foreach collection of a statement so that every
+        piece renders to at most max_params parameters.
+        :param param_count: number of parameters the unsplit statement renders to
+        '''
+        statement_map = self.id_2_statement_map
+        statement = statement_map[id]
+        foreach_nodes = list(statement.foreach_nodes)
+        for include in statement.includes:
+            target = self._find_statement(statement_map, include.refid, statement.namespace)
+            if target is not None:
+                foreach_nodes.extend(target.foreach_nodes)
+
+        per_item = {}
+        padded = set()
+        for node in foreach_nodes:
+            name = node.collection.name
+            if name is None or node.params_per_item is None or not isinstance(params.get(name), list):
+                continue
+            per_item[name] = per_item.get(name, 0) + node.params_per_item
+            if node.bind == "array":
+                padded.add(name)
+
+        if not per_item:
+            raise Exception("No foreach collection to split")
+        name = max(per_item, key=lambda n: len(params[n]) * per_item[n])
+        l = params[name]
+
+        rendered_items = bucket_size(len(l)) if name in padded else len(l)
+        fixed = param_count - rendered_items * per_item[name]
+        chunk_size = (max_params - fixed) // per_item[name]
+        if chunk_size < 1:
+            raise Exception("Too many parameters")
+        if name in padded:
+            chunk_size = 1 << (chunk_size.bit_length() - 1)
+
+        ret = []
+        for start in range(0, len(l), chunk_size):
+            chunk_params = dict(params)
+            chunk_params[name] = l[start:start+chunk_size]
+            ret.append(chunk_params)
+        return ret
 
-    def delete(self, id: str, params: dict) -> Tuple[str, list]:
-        if id not in self.id_2_element_map:
-            raise Exception("Missing id")
-        element = self.id_2_element_map[id]
-        if element.tag != "delete":
-            raise Exception("Not a delete")
-
-        ret = ""
-        if element.text is not None:
-            ret += element.text
-        param0 = {'params': params}
-        for child in element:
-            ret += self.parse_element(child, param0)
-            ret += child.tail
+    def select(self, id: str, params: dict, array_binding: bool=False) -> Tuple[str, list]:
+        return self._render(id, "select", params, array_binding)
 
-        sql, sql_param = self._to_prepared_statement(ret, params)
-        sql = self._to_replace(sql, params)
-        return (sql, sql_param)
+    def update(self, id: str, params: dict, array_binding: bool=False) -> Tuple[str, list]:
+        return self._render(id, "update", params, array_binding)
 
-    def insert(self, id: str, params: dict, primary_key:str=None) -> Tuple[str, list]:
-        if id not in self.id_2_element_map:
-            raise Exception("Missing id")
-        element = self.id_2_element_map[id]
-        if element.tag != "insert":
-            raise Exception("Not an insert")
-
-        ret = ""
-        if element.text is not None:
-            ret += element.text
-        param0 = {'params': params}
-        for child in element:
-            ret += self.parse_element(child, param0)
-            ret += child.tail
+    def delete(self, id: str, params: dict, array_binding: bool=False) -> Tuple[str, list]:
+        return self._render(id, "delete", params, array_binding)
 
-        sql, sql_param = self._to_prepared_statement(ret, params)
-        sql = self._to_replace(sql, params)
+    def insert(self, id: str, params: dict, primary_key:str=None, array_binding: bool=False) -> Tuple[str, list]:
+        sql, sql_param = self._render(id, "insert", params, array_binding)
 
         if primary_key:
             sql += (" RETURNING "+str(primary_key))
 
-        return (sql, sql_param)
\ No newline at end of file
+        return (sql, sql_param)
@@ -1,13 +1,27 @@
-from typing import Optional, Dict, List
+import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional, Dict, List, Set, Tuple
 
 import mysql.connector.errors
 
 from .mapper_manager import MapperManager
-from .cache import Cache, CacheKey
+from .sql_node import DynamicContext, MappedStatement, bind_params
+from .sql_tables import UNKNOWN_TABLE
+from .cache import Cache, CacheKey, ShardedCache, EMPTY_RESULT
+from .cache_backend import CacheBackend
+from .cache_policy import EvictionPolicy
+from .codec import Codec
 from .connection import AbstractConnection, AbstractCursor
+from .disk_cache import DiskCache
 from .errors import DatabaseError
+from .single_flight import SingleFlight
+from .tiered_cache import TieredCache
 
-import os
 from pympler import asizeof
 
 def fetch_rows(cursor, batch_size=1000):
@@ -26,74 +40,404 @@ def fetch_rows(cursor, batch_size=1000):
         for ret in res_list:
             yield ret
 
+class DecoratorStatement(object):
+    '''
+    SQL of a decorator compiled when the function is decorated. Arguments are
+    matched to the function signature; when the SQL is static and every
+    parameter is passed, the parameter list is built from precomputed slots.
+    '''
+    def __init__(self, mapper_manager: MapperManager, unparsed_sql: str, tag: str, func,
+                 tables: Optional[List[str]]=None):
+        self.mapper_manager = mapper_manager
+        self.statement = mapper_manager.compile_sql(unparsed_sql, tag, tables)
+        # names the cached results of the function in the cache statistics
+        self.id = func.__module__ + "." + func.__qualname__
+        self.signature = inspect.signature(func)
+        parameters = list(self.signature.parameters.values())
+        self.names = [parameter.name for parameter in parameters]
+        self.var_keyword = None
+        for parameter in parameters:
+            if parameter.kind == inspect.Parameter.VAR_KEYWORD:
+                self.var_keyword = parameter.name
+        simple = all(parameter.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)
+                     for parameter in parameters)
+
+        self.sql = None
+        self.refs = None
+        self.slots = None
+        if not self.statement.root.dynamic:
+            context = DynamicContext({})
+            self.statement.root.apply(context)
+            self.sql = context.sql()
+            self.refs = context.refs
+            if simple:
+                self.slots = [self.names.index(name) if name in self.names else None for name in self.refs]
+
+    def bind(self, args: tuple, kwargs: dict, array_binding: bool) -> Tuple[str, list]:
+        if self.slots is not None and len(args) + len(kwargs) == len(self.names):
+            try:
+                values = args + tuple([kwargs[name] for name in self.names[len(args):]])
+            except KeyError:
+                values = None
+            if values is not None:
+                return self.sql, [None if slot is None else values[slot] for slot in self.slots]
+
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        if self.var_keyword is not None:
+            params.update(params.pop(self.var_keyword))
+        if self.sql is not None:
+            return self.sql, bind_params(self.refs, params)
+        return self.mapper_manager.render_statement(self.statement, params, array_binding)
+
 class Mybatis(object):
     def __init__(self, conn:AbstractConnection, mapper_path:str, cache_memory_limit:Optional[int]=None, cache_max_live_ms:int=5*1000,
-                 max_result_bytes:int=100*1024*1024):
+                 max_result_bytes:int=100*1024*1024, max_params_per_statement:Optional[int]=None,
+                 mapper_bundle_path:Optional[str]=None, mapper_reload_interval_ms:Optional[int]=None,
+                 cache_codec:Optional[Codec]=None, cache_shards:int=1,
+                 cache_expiry_interval_ms:Optional[int]=None, cache_wait_timeout_ms:Optional[int]=30*1000,
+                 cache_empty_max_live_ms:int=1000, cache_policy:Optional[Callable[[], EvictionPolicy]]=None,
+                 cache_shared_path:Optional[str]=None, cache_disk_path:Optional[str]=None,
+                 cache_disk_memory_limit:int=1024*1024*1024, cache:Optional[CacheBackend]=None,
+                 cache_refresh_after_ms:Optional[int]=None, cache_refresh_workers:int=2,
+                 cache_refresh_connection:Optional[Callable[[], AbstractConnection]]=None):
+        '''
+        :param max_params_per_statement: when set, select_many splits a foreach collection that would render
+            to more bind parameters than this into several statements and concatenates their results
+            (SQLite allows 32766 parameters, PostgreSQL 65535)
+        :param mapper_bundle_path: file in which the compiled mapper files are kept between runs, so that
+            only changed mapper files are parsed again at start-up
+        :param mapper_reload_interval_ms: when set, a daemon thread checks the mapper directory this often and
+            reloads changed files, see reload_mappers
+        :param cache_codec: how cached results are stored; BinaryCodec() (the default) returns a fresh copy with
+            the column types the driver returned, JsonCodec() a fresh copy faster but with datetime as strings and
+            without Decimal or bytes, FrozenCodec() read-only rows (mappingproxy) and tuples without copying
+        :param cache_shards: number of independently locked parts the cache is split into, each with an equal
+            share of cache_memory_limit, so that a result larger than one share is not cached; 1 (the default)
+            keeps a single LRU under one lock
+        :param cache_expiry_interval_ms: when set, a daemon thread drops expired cache entries this often;
+            otherwise they are dropped as cache lookups and stores move the expiry wheel forward
+        :param cache_wait_timeout_ms: callers that miss the cache while the same query is already running wait
+            for its result instead of running it again; after this long they get a FlightTimeoutError
+            (None waits as long as the query takes)
+        :param cache_empty_max_live_ms: lifetime of cached empty results (no row for select_one, no rows for
+            select_many), at most that of other results; 0 does not cache them
+        :param cache_policy: makes the eviction policy of the cache (of each shard), LRU by default;
+            WTinyLfuPolicy keeps results read often when large scans pass through the cache, GdsfPolicy
+            keeps the results of slow queries and drops large results of fast ones first
+        :param cache_shared_path: file, such as /dev/shm/myapp-cache, in which the cache is shared by all the
+            processes using the same path (see SharedMemoryCache); cache_memory_limit is the size of its arena
+            and cache_shards and cache_policy do not apply
+        :param cache_disk_path: SQLite file (see DiskCache) holding up to cache_disk_memory_limit bytes of the
+            results the in-memory cache drops for lack of room, which are read back from it before the query
+            is run again (see TieredCache)
+        :param cache: cache to use instead of the one the other cache_* parameters describe, any CacheBackend
+        :param cache_refresh_after_ms: when set, a cached result older than this is still returned until
+            cache_max_live_ms, but the first such hit runs the query again on a pool of cache_refresh_workers
+            threads, so that popular results are renewed before callers have to wait for them
+        :param cache_refresh_connection: makes the connection of each refresh thread, required with
+            cache_refresh_after_ms as driver connections cannot be shared between threads; without it, results
+            of statements with cacheRefreshAfterMs are refreshed on the thread of the caller that finds them stale
+        '''
         self.conn = conn
+        self.mapper_path = mapper_path
         self.mapper_manager = MapperManager()
         self.max_result_bytes = max_result_bytes
+        self.max_params_per_statement = max_params_per_statement
+        self.cache_empty_max_live_ms = cache_empty_max_live_ms
+        self.cache_refresh_after_ms = cache_refresh_after_ms
+        self.cache_refresh_workers = cache_refresh_workers
+        self.cache_refresh_connection = cache_refresh_connection
+
+        if cache is None and cache_disk_path is not None and \
+                (cache_memory_limit is None or cache_shared_path is not None):
+            raise Exception("Invalid cache_disk_path: it needs cache_memory_limit and an in-process cache")
+
+        if cache_refresh_after_ms is not None and cache_refresh_connection is None:
+            raise Exception("Invalid cache_refresh_after_ms: background refreshes need cache_refresh_connection")
+
+        if cache is not None:
+            self.cache = cache
+        elif cache_memory_limit is not None and cache_shared_path is not None:
+            # needs fcntl, which only POSIX systems have
+            from .shared_cache import SharedMemoryCache
+            self.cache = SharedMemoryCache(cache_shared_path, cache_memory_limit, cache_max_live_ms, cache_codec)
+        elif cache_memory_limit is not None and cache_shards > 1:
+            self.cache = ShardedCache(cache_memory_limit, cache_max_live_ms, cache_codec, cache_shards,
+                                      policy_factory=cache_policy)
+        elif cache_memory_limit is not None:
+            self.cache = Cache(cache_memory_limit, cache_max_live_ms, cache_codec,
+                               policy=None if cache_policy is None else cache_policy())
+        else:
+            self.cache = Cache(0, cache_max_live_ms, cache_codec)
+        if cache is None and cache_disk_path is not None:
+            self.cache = TieredCache(self.cache, DiskCache(cache_disk_path, cache_disk_memory_limit, cache_max_live_ms))
+
+        self.flights = SingleFlight(cache_wait_timeout_ms)
+
+        self._refresh_lock = threading.Lock()
+        self._refresh_pool: Optional[ThreadPoolExecutor] = None
+        self._refresh_local = threading.local()
+        # keys whose refresh is queued or running
+        self._refreshing: Set[CacheKey] = set()
+        self._refresh_stats = {"scheduled": 0, "errors": 0}
+
+        self.mapper_manager.read_mapper_dir(mapper_path, mapper_bundle_path)
+
+        self._watcher_stop = threading.Event()
+        self._watcher = None
+        if mapper_reload_interval_ms is not None:
+            self.start_mapper_watcher(mapper_reload_interval_ms)
 
-        if cache_memory_limit is not None:
-            self.cache = Cache(cache_memory_limit, cache_max_live_ms)
+        self._expiry_stop = threading.Event()
+        self._expiry = None
+        if cache_expiry_interval_ms is not None:
+            self.start_cache_expiry(cache_expiry_interval_ms)
+
+    def reload_mappers(self) -> List[str]:
+        '''
+        Parses again the mapper files that were added, modified or removed since they were read and drops the
+        cached results of the statements they affect; the rest of the cache stays warm. If a file fails to
+        parse nothing is replaced and the error is raised.
+        :return: ids of the affected statements
+        '''
+        ids = self.mapper_manager.reload_mapper_dir(self.mapper_path)
+        if ids:
+            self.cache.invalidate_tags(["id:" + id for id in ids])
+        return sorted(ids)
+
+    def cache_stats(self) -> Dict:
+        '''
+        :return: the counters of the cache as a plain dict: hits, stale_hits (hits past cache_refresh_after_ms),
+            misses, puts, rejected (results too large to cache), evictions by cause (evicted_capacity,
+            evicted_expired, evicted_invalidated), entries, memory_used, memory_limit and average_entry_size, the
+            same per statement id under "statements" (decorated functions are named module.function), the
+            single-flight counters under "flights" and the background refreshes under "refreshes"
+        '''
+        stats = self.cache.stats()
+        stats["flights"] = self.flights.stats()
+        with self._refresh_lock:
+            stats["refreshes"] = dict(self._refresh_stats, pending=len(self._refreshing))
+        return stats
+
+    def reset_cache_stats(self):
+        self.cache.reset_stats()
+        self.flights.reset_stats()
+        with self._refresh_lock:
+            self._refresh_stats = {"scheduled": 0, "errors": 0}
+
+    def stop_cache_refresh(self):
+        '''
+        Waits for the background refreshes in progress and stops their threads; later stale hits start them again.
+        '''
+        with self._refresh_lock:
+            pool = self._refresh_pool
+            self._refresh_pool = None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def _schedule_refresh(self, cache_key: CacheKey, refresh: Callable[[], Any]):
+        with self._refresh_lock:
+            if cache_key in self._refreshing:
+                return
+            if self._refresh_pool is None:
+                self._refresh_pool = ThreadPoolExecutor(self.cache_refresh_workers,
+                                                        thread_name_prefix="mybatis-cache-refresh")
+            self._refreshing.add(cache_key)
+            self._refresh_stats["scheduled"] += 1
+            self._refresh_pool.submit(self._refresh, cache_key, refresh)
+
+    def _refresh(self, cache_key: CacheKey, refresh: Callable[[], Any]):
+        try:
+            # callers missing the key meanwhile wait for this query instead of running their own
+            self.flights.do(cache_key, refresh)
+        except Exception:
+            # the stale result is served until it expires, then callers run the query themselves
+            with self._refresh_lock:
+                self._refresh_stats["errors"] += 1
+            logging.getLogger(__name__).exception("Failed to refresh a cached result of %s", cache_key.id)
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(cache_key)
+
+    def _refresh_conn(self) -> AbstractConnection:
+        conn = getattr(self._refresh_local, "conn", None)
+        if conn is None:
+            conn = self._refresh_local.conn = self.cache_refresh_connection()
+        return conn
+
+    def start_mapper_watcher(self, interval_ms:int=1000):
+        if self._watcher is not None:
+            return
+        self._watcher_stop.clear()
+        self._watcher = threading.Thread(target=self._watch_mappers, args=(interval_ms / 1000,),
+                                         name="mybatis-mapper-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_mapper_watcher(self):
+        if self._watcher is None:
+            return
+        self._watcher_stop.set()
+        self._watcher.join()
+        self._watcher = None
+
+    def _watch_mappers(self, interval_s:float):
+        while not self._watcher_stop.wait(interval_s):
+            try:
+                self.reload_mappers()
+            except Exception:
+                # most likely a file caught half written; it is retried on the next tick
+                logging.getLogger(__name__).exception("Failed to reload mapper files")
+
+    def start_cache_expiry(self, interval_ms:int=1000):
+        if self._expiry is not None:
+            return
+        self._expiry_stop.clear()
+        self._expiry = threading.Thread(target=self._expire_cache, args=(interval_ms / 1000,),
+                                        name="mybatis-cache-expiry", daemon=True)
+        self._expiry.start()
+
+    def stop_cache_expiry(self):
+        if self._expiry is None:
+            return
+        self._expiry_stop.set()
+        self._expiry.join()
+        self._expiry = None
+
+    def _expire_cache(self, interval_s:float):
+        while not self._expiry_stop.wait(interval_s):
+            self.cache.expire()
+
+    def _cache_tags(self, statement: MappedStatement) -> tuple:
+        read_tables = self.mapper_manager.get_tables(statement)[0]
+        return ("id:" + statement.id,) + tuple(["table:" + table for table in read_tables])
+
+    def _flush_cache(self, statement: MappedStatement):
+        if statement.flush_cache is not None:
+            if statement.flush_cache:
+                self.cache.clear()
+            return
+        if statement.tag == "select":
+            return
+
+        write_tables = self.mapper_manager.get_tables(statement)[1]
+        if not write_tables or UNKNOWN_TABLE in write_tables:
+            self.cache.clear()
         else:
-            self.cache = Cache(0, cache_max_live_ms)
+            # results of statements built with ${} table names depend on any table
+            self.cache.invalidate_tags(["table:" + table for table in write_tables] + ["table:" + UNKNOWN_TABLE])
 
-        mapper_file_name_l = [name for name in os.listdir(mapper_path) if name.endswith(".xml")]
-        for file_name in mapper_file_name_l:
-            full_path = os.path.join(mapper_path, file_name)
-            self.mapper_manager.read_mapper_xml_file(full_path)
+    def _array_binding(self) -> bool:
+        return self.conn is not None and self.conn.supports_array_binding()
 
     def select_one(self, id:str, params:dict) -> Optional[Dict]:
-        sql, param_list = self.mapper_manager.select(id, params)
+        statement = self.mapper_manager.get_statement(id)
+        sql, param_list = self.mapper_manager.select(id, params, array_binding=self._array_binding())
 
-        if self.cache.memory_limit > 0:
-            res = self.cache.get(CacheKey(sql, param_list))
-            if res is not None:
-                return res
+        self._flush_cache(statement)
 
-        with self.conn.cursor(prepared=True) as cursor:
-            cursor.execute(sql, param_list)
-            ret = cursor.fetchone()
-            self.conn.commit()
-
-            if ret is None:
-                return None
-            column_name = [item[0] for item in cursor.description()]
-            res = {}
-            for idx, item in enumerate(column_name):
-                res[item] = ret[idx]
+        def query(conn):
+            conn.set_statement_timeout(statement.timeout_ms)
+            with conn.cursor(prepared=True) as cursor:
+                cursor.execute(sql, param_list)
+                ret = cursor.fetchone()
+                conn.commit()
+
+                if ret is None:
+                    return None
+                column_name = [item[0] for item in cursor.description()]
+                res = {}
+                for idx, item in enumerate(column_name):
+                    res[item] = ret[idx]
+                return res
 
-            if self.cache.memory_limit > 0:
-                self.cache.put(CacheKey(sql, param_list), res)
-            return res
+        if self.cache.memory_limit > 0 and statement.use_cache:
+            return self._cached_query(CacheKey(sql, param_list, id), statement, query)
+        return query(self.conn)
 
     def select_many(self, id:str, params:dict) -> Optional[List[Dict]]:
-        sql, param_list = self.mapper_manager.select(id, params)
-        if self.cache.memory_limit > 0:
-            res = self.cache.get(CacheKey(sql, param_list))
-            if res is not None:
-                return res
-
-        with self.conn.cursor(prepared=True) as cursor:
-            cursor.execute(sql, param_list)
-            ret = None
-            res_list = []
-            memory_used = 0
-            for item in fetch_rows(cursor, batch_size=1000):
-                memory_used += asizeof.asizeof(item)
-                if memory_used > self.max_result_bytes:
-                    raise Exception("memory limit exceeded")
-                res_list.append(item)
+        statement = self.mapper_manager.get_statement(id)
+        array_binding = self._array_binding()
+        sql, param_list = self.mapper_manager.select(id, params, array_binding=array_binding)
+
+        self._flush_cache(statement)
+
+        def query(conn):
+            if self.max_params_per_statement is not None and len(param_list) > self.max_params_per_statement:
+                chunk_params_l = self.mapper_manager.split_params(id, params, len(param_list), self.max_params_per_statement)
+                statements = [self.mapper_manager.select(id, chunk_params, array_binding=array_binding)
+                              for chunk_params in chunk_params_l]
+            else:
+                statements = [(sql, param_list)]
+
+            conn.set_statement_timeout(statement.timeout_ms)
+            with conn.cursor(prepared=True) as cursor:
+                res_list = []
+                memory_used = 0
+                for chunk_sql, chunk_param_list in statements:
+                    cursor.execute(chunk_sql, chunk_param_list)
+                    for item in fetch_rows(cursor, batch_size=statement.fetch_size or 1000):
+                        memory_used += asizeof.asizeof(item)
+                        if memory_used > self.max_result_bytes:
+                            raise Exception("memory limit exceeded")
+                        res_list.append(item)
 
-            self.conn.commit()
+                conn.commit()
 
-            if len(res_list) == 0:
-                res_list = None
+                if len(res_list) == 0:
+                    return None
+                return res_list
 
-            if self.cache.memory_limit > 0:
-                self.cache.put(CacheKey(sql, param_list), res_list)
+        if self.cache.memory_limit > 0 and statement.use_cache:
+            return self._cached_query(CacheKey(sql, param_list, id), statement, query)
+        return query(self.conn)
 
-            return res_list
+    def _cached_query(self, cache_key: CacheKey, statement: MappedStatement,
+                      query: Callable[[AbstractConnection], Any]) -> Any:
+        '''
+        Looks the key up in the cache and on a miss runs the query and stores its result. Concurrent misses
+        on the same key run the query once; the other callers wait for it, see cache_wait_timeout_ms. A stale
+        hit returns the cached result and refreshes it in the background, see cache_refresh_after_ms, or
+        without cache_refresh_connection refreshes it first like a miss.
+        '''
+        res, stale = self.cache.get_stale(cache_key)
+        if res is not None and (not stale or self.cache_refresh_connection is not None):
+            if stale:
+                self._schedule_refresh(
+                    cache_key, lambda: self._run_cached_query(cache_key, statement, query, self._refresh_conn()))
+            return None if res is EMPTY_RESULT else res
+
+        def load():
+            # the previous query for this key may have finished after this caller missed
+            res, stale = self.cache.get_stale(cache_key, record_stats=False)
+            if res is not None and not stale:
+                return None if res is EMPTY_RESULT else res
+            return self._run_cached_query(cache_key, statement, query, self.conn)
+
+        res, shared = self.flights.do(cache_key, load)
+        if shared and res is not None and not self.cache.codec.shared:
+            # each caller gets its own copy, as it would from a hit
+            cached = self.cache.get(cache_key, record_stats=False)
+            res = copy.deepcopy(res) if cached is None or cached is EMPTY_RESULT else cached
+        return res
+
+    def _run_cached_query(self, cache_key: CacheKey, statement: MappedStatement,
+                          query: Callable[[AbstractConnection], Any], conn: AbstractConnection) -> Any:
+        start = time.perf_counter()
+        res = query(conn)
+        cost = (time.perf_counter() - start) * 1000
+        max_live_ms = self.cache.max_live_ms if statement.cache_max_live_ms is None else statement.cache_max_live_ms
+        refresh_after_ms = self.cache_refresh_after_ms if statement.cache_refresh_after_ms is None \
+            else statement.cache_refresh_after_ms
+        if res is not None:
+            res = self.cache.put(cache_key, res, tags=self._cache_tags(statement), max_live_ms=max_live_ms,
+                                 cost=cost, refresh_after_ms=refresh_after_ms)
+        elif self.cache_empty_max_live_ms > 0:
+            self.cache.put(cache_key, EMPTY_RESULT, tags=self._cache_tags(statement),
+                           max_live_ms=min(max_live_ms, self.cache_empty_max_live_ms), cost=cost,
+                           refresh_after_ms=refresh_after_ms)
+        return res
 
     def update(self, id:str, params:dict) -> int:
         '''
@@ -101,10 +445,12 @@ class Mybatis(object):
         :param params:
         :return: affected rows
         '''
-        sql, param_list = self.mapper_manager.update(id, params)
+        statement = self.mapper_manager.get_statement(id)
+        sql, param_list = self.mapper_manager.update(id, params, array_binding=self._array_binding())
 
-        res = self.cache.clear()
+        self._flush_cache(statement)
 
+        self.conn.set_statement_timeout(statement.timeout_ms)
         with self.conn.cursor(prepared=True) as cursor:
             try:
                 cursor.execute(sql, param_list)
@@ -121,10 +467,12 @@ class Mybatis(object):
         :param params:
         :return: affected rows
         '''
-        sql, param_list = self.mapper_manager.delete(id, params)
+        statement = self.mapper_manager.get_statement(id)
+        sql, param_list = self.mapper_manager.delete(id, params, array_binding=self._array_binding())
 
-        res = self.cache.clear()
+        self._flush_cache(statement)
 
+        self.conn.set_statement_timeout(statement.timeout_ms)
         with self.conn.cursor(prepared=True) as cursor:
             try:
                 cursor.execute(sql, param_list)
@@ -144,12 +492,14 @@ class Mybatis(object):
         if self.conn.need_returning_id() and primary_key:
             params['__need_returning_id__'] = str(primary_key)
 
-        sql, param_list = self.mapper_manager.insert(id, params, primary_key)
+        statement = self.mapper_manager.get_statement(id)
+        sql, param_list = self.mapper_manager.insert(id, params, primary_key, array_binding=self._array_binding())
 
         print("========>",sql,param_list)
 
-        res = self.cache.clear()
+        self._flush_cache(statement)
 
+        self.conn.set_statement_timeout(statement.timeout_ms)
         with self.conn.cursor(prepared=True) as cursor:
             try:
                 cursor.execute(sql, param_list)
@@ -161,93 +511,90 @@ class Mybatis(object):
                 raise e
 
 
-    def SelectOne(self, unparsed_sql:str) -> Optional[Dict]:
+    def SelectOne(self, unparsed_sql:str, tables:Optional[List[str]]=None) -> Optional[Dict]:
+        '''
+        :param tables: tables the statement reads, when they cannot be found in the SQL
+        '''
         def decorator(func):
-            def wrapper(*args, **kwargs):
-                params = {}
-                for key, value in kwargs.items():
-                    params[key] = value
+            statement = DecoratorStatement(self.mapper_manager, unparsed_sql, "select", func, tables)
 
-                sql, param_list = self.mapper_manager._to_prepared_statement(unparsed_sql, params)
-                sql = self.mapper_manager._to_replace(sql, params)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                sql, param_list = statement.bind(args, kwargs, self._array_binding())
 
-                if self.cache.memory_limit > 0:
-                    res = self.cache.get(CacheKey(sql, param_list))
-                    if res is not None:
+                def query(conn):
+                    conn.set_statement_timeout(None)
+                    with conn.cursor(prepared=True) as cursor:
+                        cursor.execute(sql, param_list)
+                        ret = cursor.fetchone()
+                        conn.commit()
+                        if ret is None:
+                            return None
+
+                        column_name = [item[0] for item in cursor.description()]
+                        res = {}
+                        for idx, item in enumerate(column_name):
+                            res[item] = ret[idx]
                         return res
 
-                with self.conn.cursor(prepared=True) as cursor:
-                    cursor.execute(sql, param_list)
-                    ret = cursor.fetchone()
-                    self.conn.commit()
-                    if ret is None:
-                        return None
-
-                    column_name = [item[0] for item in cursor.description()]
-                    res = {}
-                    for idx, item in enumerate(column_name):
-                        res[item] = ret[idx]
-
-                    if self.cache.memory_limit > 0:
-                        self.cache.put(CacheKey(sql, param_list), res)
-
-                    return res
+                if self.cache.memory_limit > 0:
+                    return self._cached_query(CacheKey(sql, param_list, statement.id), statement.statement, query)
+                return query(self.conn)
 
             return wrapper
         return decorator
 
-    def SelectMany(self, unparsed_sql:str) -> Optional[List[Dict]]:
+    def SelectMany(self, unparsed_sql:str, tables:Optional[List[str]]=None) -> Optional[List[Dict]]:
+        '''
+        :param tables: tables the statement reads, when they cannot be found in the SQL
+        '''
         def decorator(func):
+            statement = DecoratorStatement(self.mapper_manager, unparsed_sql, "select", func, tables)
+
+            @functools.wraps(func)
             def wrapper(*args, **kwargs):
-                params = {}
-                for key, value in kwargs.items():
-                    params[key] = value
+                sql, param_list = statement.bind(args, kwargs, self._array_binding())
 
-                sql, param_list = self.mapper_manager._to_prepared_statement(unparsed_sql, params)
-                sql = self.mapper_manager._to_replace(sql, params)
+                def query(conn):
+                    memory_used = 0
+                    conn.set_statement_timeout(None)
+                    with conn.cursor(prepared=True) as cursor:
+                        cursor.execute(sql, param_list)
+                        res_list = []
+                        for item in fetch_rows(cursor, batch_size=1000):
+                            memory_used += asizeof.asizeof(item)
+                            if memory_used > self.max_result_bytes:
+                                raise Exception("memory limit exceeded")
+                            res_list.append(item)
+                        conn.commit()
+
+                        if len(res_list) == 0:
+                            return None
+                        return res_list
 
                 if self.cache.memory_limit > 0:
-                    res = self.cache.get(CacheKey(sql, param_list))
-                    if res is not None:
-                        return res
-
-                memory_used = 0
-                with self.conn.cursor(prepared=True) as cursor:
-                    cursor.execute(sql, param_list)
-                    ret = None
-                    res_list = []
-                    for item in fetch_rows(cursor, batch_size=1000):
-                        memory_used += asizeof.asizeof(item)
-                        if memory_used > self.max_result_bytes:
-                            raise Exception("memory limit exceeded")
-                        res_list.append(item)
-                    self.conn.commit()
-
-                    if len(res_list) == 0:
-                        res_list = None
-
-                    if self.cache.memory_limit > 0:
-                        self.cache.put(CacheKey(sql, param_list), res_list)
-
-                    return res_list
+                    return self._cached_query(CacheKey(sql, param_list, statement.id), statement.statement, query)
+                return query(self.conn)
             return wrapper
         return decorator
 
-    def Insert(self, unparsed_sql:str, primary_key:str=None) -> int:
+    def Insert(self, unparsed_sql:str, primary_key:str=None, tables:Optional[List[str]]=None) -> int:
+        '''
+        :param tables: tables the statement writes, when they cannot be found in the SQL
+        '''
         def decorator(func):
-            def wrapper(*args, **kwargs):
-                params = {}
-                for key, value in kwargs.items():
-                    params[key] = value
+            statement = DecoratorStatement(self.mapper_manager, unparsed_sql, "insert", func, tables)
 
-                sql, param_list = self.mapper_manager._to_prepared_statement(unparsed_sql, params)
-                sql = self.mapper_manager._to_replace(sql, params)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                sql, param_list = statement.bind(args, kwargs, self._array_binding())
 
                 if self.conn.need_returning_id() and primary_key:
                     sql += (" RETURNING " + str(primary_key))
 
-                res = self.cache.clear()
+                self._flush_cache(statement.statement)
 
+                self.conn.set_statement_timeout(None)
                 with self.conn.cursor(prepared=True) as cursor:
                     try:
                         cursor.execute(sql, param_list)
@@ -260,18 +607,20 @@ class Mybatis(object):
             return wrapper
         return decorator
 
-    def Delete(self, unparsed_sql:str) -> int:
+    def Delete(self, unparsed_sql:str, tables:Optional[List[str]]=None) -> int:
+        '''
+        :param tables: tables the statement writes, when they cannot be found in the SQL
+        '''
         def decorator(func):
-            def wrapper(*args, **kwargs):
-                params = {}
-                for key, value in kwargs.items():
-                    params[key] = value
+            statement = DecoratorStatement(self.mapper_manager, unparsed_sql, "delete", func, tables)
 
-                sql, param_list = self.mapper_manager._to_prepared_statement(unparsed_sql, params)
-                sql = self.mapper_manager._to_replace(sql, params)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                sql, param_list = statement.bind(args, kwargs, self._array_binding())
 
-                res = self.cache.clear()
+                self._flush_cache(statement.statement)
 
+                self.conn.set_statement_timeout(None)
                 with self.conn.cursor(prepared=True) as cursor:
                     try:
                         cursor.execute(sql, param_list)
@@ -285,18 +634,20 @@ class Mybatis(object):
             return wrapper
         return decorator
 
-    def Update(self, unparsed_sql:str) -> int:
+    def Update(self, unparsed_sql:str, tables:Optional[List[str]]=None) -> int:
+        '''
+        :param tables: tables the statement writes, when they cannot be found in the SQL
+        '''
         def decorator(func):
-            def wrapper(*args, **kwargs):
-                params = {}
-                for key, value in kwargs.items():
-                    params[key] = value
+            statement = DecoratorStatement(self.mapper_manager, unparsed_sql, "update", func, tables)
 
-                sql, param_list = self.mapper_manager._to_prepared_statement(unparsed_sql, params)
-                sql = self.mapper_manager._to_replace(sql, params)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                sql, param_list = statement.bind(args, kwargs, self._array_binding())
 
-                res = self.cache.clear()
+                self._flush_cache(statement.statement)
 
+                self.conn.set_statement_timeout(None)
                 with self.conn.cursor(prepared=True) as cursor:
                     try:
                         cursor.execute(sql, param_list)
@@ -309,4 +660,4 @@ class Mybatis(object):
 
             return wrapper
 
-        return decorator
\ No newline at end of file
+        return decorator
@@ -0,0 +1,403 @@
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional
+
+from .cache import CacheKey, EMPTY_RESULT, key_digest, HITS, MISSES, PUTS, REJECTED, STAT_NAMES, stats_snapshot
+from .cache_backend import CacheBackend
+from .binary_codec import BinaryCodec
+from .codec import Codec
+
+SHARED_MAGIC = b"MYBATISS"
+# bump whenever the layout or the default codec changes
+SHARED_VERSION = 3
+# magic, version, slot count, tag slot count, arena size, arena head, clear generation, arena tail,
+# entries, memory used
+HEADER = struct.Struct("<8sIIIxxxxQQQQQQ")
+HEAD_OFFSET = 32
+GENERATION_OFFSET = 40
+# values before the tail have been taken off the entries and memory used counters
+TAIL_OFFSET = 48
+ENTRIES_OFFSET = 56
+MEMORY_USED_OFFSET = 64
+# sequence, key digest, arena position, length, crc32, expires at (ms since the epoch), clear generation
+SLOT = struct.Struct("<Q16sQIIqQ")
+# tag digest, generation
+TAG_SLOT = struct.Struct("<QQ")
+# length, key digest (EMPTY_DIGEST for the padding before the end of the arena) and number of tags,
+# then a (tag digest, generation) pair per tag in front of the value
+BLOB_HEADER = struct.Struct("<I16sH")
+SEQUENCE = struct.Struct("<Q")
+MAX_PROBES = 16
+READ_RETRIES = 8
+EMPTY_DIGEST = bytes(16)
+# stored instead of the codec bytes for EMPTY_RESULT
+EMPTY_VALUE = b"\x00EMPTY_RESULT"
+
+
+def _key_digest(key: CacheKey) -> bytes:
+    # the hash of a CacheKey differs between processes, the digest of its text does not
+    digest = key_digest(key)
+    return b"\x01" + digest[1:] if digest == EMPTY_DIGEST else digest
+
+
+def _tag_digest(tag: str) -> int:
+    return int.from_bytes(hashlib.blake2b(tag.encode(), digest_size=8).digest(), "little") or 1
+
+
+class SharedMemoryCache(CacheBackend):
+    '''
+    Cache kept in a memory-mapped file, such as one under /dev/shm, that all
+    processes opening the same path share: worker processes of a pre-fork
+    server hold one copy of each result, and a restarted worker finds the
+    cache warm.
+
+    The file holds a fixed table of slots addressed by a digest of the key
+    (linear probing over at most MAX_PROBES slots) and an arena the encoded
+    values are appended to as a ring, so the oldest values are overwritten
+    first. Writers take an flock on the file; readers take no lock and retry
+    when the sequence counter of the slot shows it changed while they read
+    it. Tags are invalidated by bumping a generation counter of the tag that
+    the entries carrying it recorded when they were stored.
+
+    The codec must encode to bytes. Hit and miss counters are kept per
+    process; the entries and memory used counters are kept in the file and
+    include expired and invalidated values until the arena overwrites them.
+
+    :param path: file of the cache, created when missing; every process must use the same sizes
+    :param memory_limit: size of the arena in bytes
+    :param slots: number of slots, by default one per 512 bytes of arena
+    '''
+    def __init__(self, path: str, memory_limit: int, max_live_ms: int, codec: Optional[Codec]=None,
+                 slots: Optional[int]=None, tag_slots: int=4096):
+        self.path = path
+        self.codec = BinaryCodec() if codec is None else codec
+        if not isinstance(self.codec.encode([{"id": 1}]), bytes):
+            raise Exception("Invalid codec: SharedMemoryCache needs a codec that encodes to bytes")
+        self.memory_limit = memory_limit
+        self.max_live_ms = max_live_ms
+        self.slot_count = 1 << max(10, ((slots or memory_limit // 512) - 1).bit_length())
+        self.tag_slot_count = 1 << max(6, (tag_slots - 1).bit_length())
+        self.slots_offset = HEADER.size
+        self.tags_offset = self.slots_offset + self.slot_count * SLOT.size
+        self.arena_offset = self.tags_offset + self.tag_slot_count * TAG_SLOT.size
+        size = self.arena_offset + memory_limit
+
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.pid = os.getpid()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size == 0:
+                    os.ftruncate(self.fd, size)
+                    self.mm = mmap.mmap(self.fd, size)
+                    HEADER.pack_into(self.mm, 0, SHARED_MAGIC, SHARED_VERSION, self.slot_count,
+                                     self.tag_slot_count, memory_limit, 0, 1, 0, 0, 0)
+                else:
+                    self.mm = mmap.mmap(self.fd, 0)
+                    header = HEADER.unpack_from(self.mm, 0) if len(self.mm) >= HEADER.size else None
+                    if header is None or header[:5] != (SHARED_MAGIC, SHARED_VERSION, self.slot_count,
+                                                         self.tag_slot_count, memory_limit):
+                        self.mm.close()
+                        raise Exception("Invalid shared cache file: %s was created with other sizes or by another version" % path)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        # statement id -> counters of this process, see STAT_NAMES
+        self.statement_stats: Dict[Optional[str], List[int]] = {}
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # processes sharing a descriptor share its flock, so a forked worker opens its own
+                inherited = self.fd
+                self.fd = os.open(self.path, os.O_RDWR)
+                self.pid = os.getpid()
+                os.close(inherited)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _head(self) -> int:
+        return SEQUENCE.unpack_from(self.mm, HEAD_OFFSET)[0]
+
+    def _generation(self) -> int:
+        return SEQUENCE.unpack_from(self.mm, GENERATION_OFFSET)[0]
+
+    def _probe(self, digest: bytes) -> Iterable[int]:
+        start = int.from_bytes(digest[:8], "little") & (self.slot_count - 1)
+        for i in range(MAX_PROBES):
+            yield self.slots_offset + ((start + i) & (self.slot_count - 1)) * SLOT.size
+
+    def _tag_offset(self, tag_digest: int, insert: bool) -> Optional[int]:
+        start = tag_digest & (self.tag_slot_count - 1)
+        for i in range(MAX_PROBES):
+            offset = self.tags_offset + ((start + i) & (self.tag_slot_count - 1)) * TAG_SLOT.size
+            digest = SEQUENCE.unpack_from(self.mm, offset)[0]
+            if digest == tag_digest:
+                return offset
+            if digest == 0:
+                if insert:
+                    TAG_SLOT.pack_into(self.mm, offset, tag_digest, 0)
+                    return offset
+                return None
+        return None
+
+    def _tag_generation(self, tag_digest: int) -> int:
+        offset = self._tag_offset(tag_digest, False)
+        return 0 if offset is None else SEQUENCE.unpack_from(self.mm, offset + 8)[0]
+
+    def _counters(self, id: Optional[str]) -> List[int]:
+        counters = self.statement_stats.get(id)
+        if counters is None:
+            counters = self.statement_stats[id] = [0] * len(STAT_NAMES)
+        return counters
+
+    def _live(self, position: int, length: int, expires_at: int, generation: int, head: int, now: int) -> bool:
+        return position + length <= head and position >= head - self.memory_limit and expires_at >= now \
+            and generation == self._generation()
+
+    def _read(self, digest: bytes) -> Optional[bytes]:
+        now = int(time.time() * 1000)
+        for offset in self._probe(digest):
+            for _ in range(READ_RETRIES):
+                sequence, slot_digest, position, length, crc, expires_at, generation = SLOT.unpack_from(self.mm, offset)
+                if sequence & 1:
+                    # a writer is updating the slot
+                    time.sleep(0)
+                    continue
+                if slot_digest == EMPTY_DIGEST:
+                    return None
+                if slot_digest != digest:
+                    break
+                if not self._live(position, length, expires_at, generation, self._head(), now):
+                    return None
+                start = self.arena_offset + position % self.memory_limit
+                data = self.mm[start:start + length]
+                # the value may have been overwritten while it was copied
+                if SEQUENCE.unpack_from(self.mm, offset)[0] != sequence:
+                    continue
+                if position < self._head() - self.memory_limit or zlib.crc32(data) != crc:
+                    return None
+                return data
+            else:
+                return None
+        return None
+
+    def get(self, key: CacheKey, record_stats: bool=True) -> Optional[Any]:
+        '''
+        :return: the value, EMPTY_RESULT when it was stored for an empty result, or None when the key is not cached
+        '''
+        data = self._read(_key_digest(key))
+        value = None
+        if data is not None:
+            count = BLOB_HEADER.unpack_from(data, 0)[2]
+            offset = BLOB_HEADER.size
+            for _ in range(count):
+                tag_digest, generation = TAG_SLOT.unpack_from(data, offset)
+                offset += TAG_SLOT.size
+                if self._tag_generation(tag_digest) != generation:
+                    break
+            else:
+                value = data[offset:]
+        if record_stats:
+            with self.lock:
+                self._counters(key.id)[MISSES if value is None else HITS] += 1
+        if value is None:
+            return None
+        if value == EMPTY_VALUE:
+            return EMPTY_RESULT
+        return self.codec.decode(value)
+
+    def put(self, key: CacheKey, value: Any, tags: Iterable[str]=(), max_live_ms: Optional[int]=None,
+            cost: Optional[float]=None, refresh_after_ms: Optional[int]=None) -> Any:
+        '''
+        :param cost: ignored; values are dropped oldest first
+        :param refresh_after_ms: ignored; values are served until they expire
+        :return: value
+        '''
+        if value is EMPTY_RESULT:
+            encoded = EMPTY_VALUE
+        else:
+            encoded = self.codec.encode(value)
+        digest = _key_digest(key)
+        tag_digests = [_tag_digest(tag) for tag in tags]
+        expires_at = int(time.time() * 1000) + (self.max_live_ms if max_live_ms is None else max_live_ms)
+        length = BLOB_HEADER.size + len(tag_digests) * TAG_SLOT.size + len(encoded)
+
+        if length > self.memory_limit:
+            with self.lock:
+                self._counters(key.id)[REJECTED] += 1
+            return value
+
+        with self._locked():
+            blob = bytearray(BLOB_HEADER.pack(length, digest, len(tag_digests)))
+            for tag_digest in tag_digests:
+                blob += TAG_SLOT.pack(tag_digest, self._tag_generation(tag_digest))
+            blob += encoded
+            self._write(digest, bytes(blob), expires_at)
+            self._counters(key.id)[PUTS] += 1
+        return value
+
+    def _write(self, digest: bytes, blob: bytes, expires_at: int):
+        mm = self.mm
+        head = self._head()
+        generation = self._generation()
+        now = int(time.time() * 1000)
+        target = None
+        oldest = None
+        for offset in self._probe(digest):
+            sequence, slot_digest, position, length, _, slot_expires_at, slot_generation = SLOT.unpack_from(mm, offset)
+            if slot_digest == digest or slot_digest == EMPTY_DIGEST:
+                target = offset
+                break
+            if target is None and not self._live(position, length, slot_expires_at, slot_generation, head, now):
+                target = offset
+            if oldest is None or position < oldest[0]:
+                oldest = (position, offset)
+        if target is None:
+            target = oldest[1]
+
+        # values do not wrap around the end of the arena
+        position = head
+        gap = 0
+        if position % self.memory_limit + len(blob) > self.memory_limit:
+            gap = self.memory_limit - position % self.memory_limit
+            position += gap
+        self._release(position + len(blob) - self.memory_limit)
+        # the head moves first, so that readers of the values about to be
+        # overwritten see them as gone
+        SEQUENCE.pack_into(mm, HEAD_OFFSET, position + len(blob))
+        if gap >= BLOB_HEADER.size:
+            BLOB_HEADER.pack_into(mm, self.arena_offset + head % self.memory_limit, gap, EMPTY_DIGEST, 0)
+        start = self.arena_offset + position % self.memory_limit
+        mm[start:start + len(blob)] = blob
+
+        sequence, slot_digest, slot_position, slot_length, _, _, slot_generation = SLOT.unpack_from(mm, target)
+        entries, memory_used = self._counts()
+        if slot_digest != EMPTY_DIGEST and slot_generation == generation \
+                and slot_position >= SEQUENCE.unpack_from(mm, TAIL_OFFSET)[0]:
+            # the value replaced was still counted
+            entries -= 1
+            memory_used -= slot_length
+        self._set_counts(entries + 1, memory_used + len(blob))
+        SEQUENCE.pack_into(mm, target, sequence + 1)
+        SLOT.pack_into(mm, target, sequence + 1, digest, position, len(blob), zlib.crc32(blob), expires_at,
+                       generation)
+        SEQUENCE.pack_into(mm, target, sequence + 2)
+
+    def _release(self, start: int):
+        # takes the values starting before start, which the arena is about to
+        # overwrite, off the counters; each value is visited once
+        mm = self.mm
+        tail = SEQUENCE.unpack_from(mm, TAIL_OFFSET)[0]
+        head = self._head()
+        generation = self._generation()
+        entries, memory_used = self._counts()
+        while tail < start and tail < head:
+            offset = tail % self.memory_limit
+            if offset + BLOB_HEADER.size > self.memory_limit:
+                tail += self.memory_limit - offset
+                continue
+            length, digest, _ = BLOB_HEADER.unpack_from(mm, self.arena_offset + offset)
+            if length < BLOB_HEADER.size:
+                # not a value header; nothing more can be accounted for
+                tail = head
+                break
+            if digest != EMPTY_DIGEST:
+                for slot_offset in self._probe(digest):
+                    _, slot_digest, position, slot_length, _, _, slot_generation = SLOT.unpack_from(mm, slot_offset)
+                    if slot_digest == digest:
+                        if position == tail and slot_generation == generation:
+                            entries -= 1
+                            memory_used -= slot_length
+                        break
+                    if slot_digest == EMPTY_DIGEST:
+                        break
+            tail += length
+        SEQUENCE.pack_into(mm, TAIL_OFFSET, tail)
+        self._set_counts(entries, memory_used)
+
+    def _counts(self):
+        return SEQUENCE.unpack_from(self.mm, ENTRIES_OFFSET)[0], SEQUENCE.unpack_from(self.mm, MEMORY_USED_OFFSET)[0]
+
+    def _set_counts(self, entries: int, memory_used: int):
+        SEQUENCE.pack_into(self.mm, ENTRIES_OFFSET, entries)
+        SEQUENCE.pack_into(self.mm, MEMORY_USED_OFFSET, memory_used)
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        '''
+        Drops every entry carrying one of the tags, in all processes.
+        :return: 0, the entries dropped are not counted
+        '''
+        tag_digests = [_tag_digest(tag) for tag in tags]
+        with self._locked():
+            for tag_digest in tag_digests:
+                offset = self._tag_offset(tag_digest, True)
+                if offset is None:
+                    # no room left for the tag
+                    self._clear()
+                    break
+                generation = SEQUENCE.unpack_from(self.mm, offset + 8)[0]
+                SEQUENCE.pack_into(self.mm, offset + 8, generation + 1)
+        return 0
+
+    def clear(self):
+        with self._locked():
+            self._clear()
+
+    def _clear(self):
+        # entries of older generations are dead; the tag table starts over
+        SEQUENCE.pack_into(self.mm, GENERATION_OFFSET, self._generation() + 1)
+        SEQUENCE.pack_into(self.mm, TAIL_OFFSET, self._head())
+        self._set_counts(0, 0)
+        start = self.tags_offset
+        self.mm[start:start + self.tag_slot_count * TAG_SLOT.size] = bytes(self.tag_slot_count * TAG_SLOT.size)
+
+    def expire(self) -> int:
+        '''
+        Expired values are overwritten as the arena wraps around; nothing to do.
+        '''
+        return 0
+
+    def __len__(self):
+        return self._counts()[0]
+
+    def empty(self):
+        return len(self) == 0
+
+    @property
+    def memory_used(self) -> int:
+        return self._counts()[1]
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        :return: a snapshot as for Cache; entries and memory_used count the values of all processes
+            that the arena has not overwritten, the other counters this process only
+        '''
+        with self.lock:
+            statement_stats = {id: list(counters) for id, counters in self.statement_stats.items()}
+        snapshot = stats_snapshot([statement_stats], self.memory_limit)
+        snapshot["entries"], snapshot["memory_used"] = self._counts()
+        snapshot["average_entry_size"] = snapshot["memory_used"] // snapshot["entries"] if snapshot["entries"] else 0
+        return snapshot
+
+    def reset_stats(self):
+        with self.lock:
+            self.statement_stats.clear()
@@ -0,0 +1,88 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from .errors import FlightTimeoutError
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    '''
+    Runs one call per key at a time: a caller arriving while the call for
+    its key is in progress waits for that call and gets its result or its
+    exception instead of running it again.
+
+    :param timeout_ms: how long a caller waits before FlightTimeoutError is
+        raised, None to wait as long as the call takes
+    '''
+    def __init__(self, timeout_ms: Optional[int]=None):
+        self.timeout_ms = timeout_ms
+        self.flights: Dict[Hashable, _Flight] = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        '''
+        :return: (result, shared), shared being True when the result came from the call of another caller
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self.flights[key] = flight
+                self.calls += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            if not flight.done.wait(None if self.timeout_ms is None else self.timeout_ms / 1000):
+                with self.lock:
+                    self.timeouts += 1
+                raise FlightTimeoutError("Timed out after %sms waiting for a query in progress" % self.timeout_ms)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            with self.lock:
+                if flight.waiters:
+                    self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = 0
+            self.coalesced = 0
+            self.timeouts = 0
+            self.errors = 0
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        :return: calls run, callers that waited for one instead, waits that timed out,
+            and calls that failed while callers were waiting
+        '''
+        with self.lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "timeouts": self.timeouts,
+                    "errors": self.errors, "in_flight": len(self.flights)}
@@ -0,0 +1,515 @@
+import re
+from typing import List, Optional, Set, Tuple
+
+from .expression import Expression, SAFE_BUILTINS
+
+TEXT = 0
+PARAM = 1
+REPLACE = 2
+
+token_pattern = re.compile(r"#{([a-zA-Z0-9_\-]+)}|\${([a-zA-Z0-9_\-]+)}")
+where_prefix_pattern = re.compile(r"(?:(?:AND|OR)(?: |$))+", re.IGNORECASE)
+
+
+def normalize_text(text: str) -> str:
+    # Collapses every whitespace run to a single space, keeping one space at
+    # each end if the original text had whitespace there.
+    if not text:
+        return ""
+    body = " ".join(text.split())
+    if body == "":
+        return " "
+    if text[0].isspace():
+        body = " " + body
+    if text[-1].isspace():
+        body = body + " "
+    return body
+
+
+def tokenize(text: str) -> List[Tuple[int, str]]:
+    # Splits text into normalized TEXT runs, #{} PARAM and ${} REPLACE tokens
+    # in a single pass.
+    text = normalize_text(text)
+    tokens = []
+    pos = 0
+    for match in token_pattern.finditer(text):
+        if match.start() > pos:
+            tokens.append((TEXT, text[pos:match.start()]))
+        if match.group(1) is not None:
+            tokens.append((PARAM, match.group(1)))
+        else:
+            tokens.append((REPLACE, match.group(2)))
+        pos = match.end()
+    if pos < len(text):
+        tokens.append((TEXT, text[pos:]))
+    return tokens
+
+
+class DynamicContext:
+    '''
+    Collects SQL pieces and parameter references for one render. Text handed
+    to text() is already normalized, so whitespace only has to be merged at
+    the boundaries between pieces.
+    '''
+    __slots__ = ('params', 'namespace', 'array_binding', 'parts', 'refs', 'space')
+
+    def __init__(self, params: dict, namespace: Optional[dict]=None, array_binding: bool=False):
+        self.params = params
+        if namespace is None:
+            namespace = {'__builtins__': SAFE_BUILTINS, 'params': params}
+        self.namespace = namespace
+        # whether the driver can bind a list as one array parameter
+        self.array_binding = array_binding
+        self.parts: List[str] = []
+        self.refs: list = []
+        # whether the SQL so far ends with a space (or is empty)
+        self.space = True
+
+    def child(self) -> "DynamicContext":
+        return DynamicContext(self.params, self.namespace, self.array_binding)
+
+    def text(self, s: str):
+        if self.space and s[:1] == " ":
+            s = s[1:]
+        if s:
+            self.parts.append(s)
+            self.space = s[-1] == " "
+
+    def param(self, ref):
+        self.parts.append("?")
+        self.refs.append(ref)
+        self.space = False
+
+    def replace(self, s: str):
+        # ${} values go in verbatim
+        self.parts.append(s)
+        self.space = False
+
+    def fragment(self, s: str, refs: list):
+        if s:
+            self.text(s)
+            self.space = False
+        self.refs.extend(refs)
+
+    def sql(self) -> str:
+        if self.space and self.parts:
+            self.parts[-1] = self.parts[-1][:-1]
+            self.space = False
+        return "".join(self.parts)
+
+
+class SqlNode:
+    # True when the output depends on the parameters
+    dynamic = True
+
+    def apply(self, context: DynamicContext):
+        raise NotImplementedError # pragma: no cover
+
+    def shape(self, context: DynamicContext, key: list):
+        # Appends every decision that changes the rendered text (branches
+        # taken, collection lengths, ${} values) without rendering anything.
+        pass
+
+
+class StaticTextSqlNode(SqlNode):
+    dynamic = False
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def apply(self, context: DynamicContext):
+        context.text(self.text)
+
+
+class TextSqlNode(SqlNode):
+    def __init__(self, tokens: List[Tuple[int, str]]):
+        self.tokens = tokens
+        self.replace_names = [value for kind, value in tokens if kind == REPLACE]
+        self.dynamic = len(self.replace_names) > 0
+
+    def apply(self, context: DynamicContext):
+        for kind, value in self.tokens:
+            if kind == TEXT:
+                context.text(value)
+            elif kind == PARAM:
+                context.param(value)
+            else:
+                context.replace(str(context.params.get(value, "")))
+
+    def shape(self, context: DynamicContext, key: list):
+        params = context.params
+        for name in self.replace_names:
+            key.append(str(params.get(name, "")))
+
+
+def text_node(text: str) -> SqlNode:
+    tokens = tokenize(text)
+    if len(tokens) == 1 and tokens[0][0] == TEXT:
+        return StaticTextSqlNode(tokens[0][1])
+    return TextSqlNode(tokens)
+
+
+class MixedSqlNode(SqlNode):
+    def __init__(self, contents: List[SqlNode]):
+        self.contents = contents
+        self.dynamic_contents = [node for node in contents if node.dynamic]
+        self.dynamic = len(self.dynamic_contents) > 0
+
+    def apply(self, context: DynamicContext):
+        for node in self.contents:
+            node.apply(context)
+
+    def shape(self, context: DynamicContext, key: list):
+        for node in self.dynamic_contents:
+            node.shape(context, key)
+
+
+class IncludeSqlNode(SqlNode):
+    def __init__(self, refid: str):
+        self.refid = refid
+        self.target: Optional[SqlNode] = None
+
+    def apply(self, context: DynamicContext):
+        if self.target is None:
+            raise Exception("Missing refid: " + self.refid)
+        self.target.apply(context)
+
+    def shape(self, context: DynamicContext, key: list):
+        if self.target is None:
+            raise Exception("Missing refid: " + self.refid)
+        self.target.shape(context, key)
+
+    def __getstate__(self):
+        # the target may live in another mapper file; it is linked again on load
+        return {'refid': self.refid, 'target': None}
+
+
+class IfSqlNode(SqlNode):
+    def __init__(self, test: Expression, contents: MixedSqlNode):
+        self.test = test
+        self.contents = contents
+
+    def evaluate(self, context: DynamicContext) -> bool:
+        return self.test.evaluate(context.namespace)
+
+    def apply(self, context: DynamicContext):
+        if self.evaluate(context):
+            self.contents.apply(context)
+
+    def shape(self, context: DynamicContext, key: list):
+        if self.evaluate(context):
+            key.append(True)
+            self.contents.shape(context, key)
+        else:
+            key.append(False)
+
+
+class ChooseSqlNode(SqlNode):
+    def __init__(self, whens: List[IfSqlNode], otherwise: Optional[MixedSqlNode]):
+        self.whens = whens
+        self.otherwise = otherwise
+
+    def apply(self, context: DynamicContext):
+        for when in self.whens:
+            if when.evaluate(context):
+                when.contents.apply(context)
+                return
+
+        if self.otherwise is None:
+            raise Exception("Missing otherwise element")
+        self.otherwise.apply(context)
+
+    def shape(self, context: DynamicContext, key: list):
+        for index, when in enumerate(self.whens):
+            if when.evaluate(context):
+                key.append(index)
+                when.contents.shape(context, key)
+                return
+
+        if self.otherwise is None:
+            raise Exception("Missing otherwise element")
+        key.append(-1)
+        self.otherwise.shape(context, key)
+
+
+class TrimSqlNode(SqlNode):
+    def __init__(self, contents: MixedSqlNode, prefix: str, suffix: str,
+                 prefix_overrides: List[str], suffix_overrides: List[str]):
+        self.contents = contents
+        self.dynamic = contents.dynamic
+        self.prefix = normalize_text(prefix + " ")
+        self.suffix = normalize_text(" " + suffix)
+        # longest first, so that "AND NOT" wins over "AND"
+        self.prefix_overrides = sorted(prefix_overrides, key=len, reverse=True)
+        self.suffix_overrides = sorted(suffix_overrides, key=len, reverse=True)
+
+    @staticmethod
+    def trim_prefix(s: str, prefixes: List[str]) -> str:
+        while True:
+            for prefix in prefixes:
+                if s.startswith(prefix):
+                    s = s[len(prefix):].lstrip(" ")
+                    break
+            else:
+                return s
+
+    @staticmethod
+    def trim_suffix(s: str, suffixes: List[str]) -> str:
+        while True:
+            for suffix in suffixes:
+                if s.endswith(suffix):
+                    s = s[:-1*len(suffix)].rstrip(" ")
+                    break
+            else:
+                return s
+
+    def shape(self, context: DynamicContext, key: list):
+        self.contents.shape(context, key)
+
+    def apply(self, context: DynamicContext):
+        sub = context.child()
+        self.contents.apply(sub)
+        ret = sub.sql()
+        if self.prefix_overrides:
+            ret = TrimSqlNode.trim_prefix(ret, self.prefix_overrides)
+        if self.suffix_overrides:
+            ret = TrimSqlNode.trim_suffix(ret, self.suffix_overrides)
+        context.text(self.prefix)
+        context.fragment(ret, sub.refs)
+        context.text(self.suffix)
+
+
+class SetSqlNode(TrimSqlNode):
+    def __init__(self, contents: MixedSqlNode):
+        super().__init__(contents, "SET", "", [","], [])
+
+    def apply(self, context: DynamicContext):
+        sub = context.child()
+        self.contents.apply(sub)
+        context.text("SET ")
+        context.fragment(TrimSqlNode.trim_prefix(sub.sql(), self.prefix_overrides), sub.refs)
+
+
+class WhereSqlNode(SqlNode):
+    def __init__(self, contents: MixedSqlNode):
+        self.contents = contents
+        self.dynamic = contents.dynamic
+
+    def shape(self, context: DynamicContext, key: list):
+        self.contents.shape(context, key)
+
+    def apply(self, context: DynamicContext):
+        sub = context.child()
+        self.contents.apply(sub)
+        ret = sub.sql()
+        match = where_prefix_pattern.match(ret)
+        if match is not None:
+            ret = ret[match.end():]
+        if ret:
+            context.text("WHERE ")
+            context.fragment(ret, sub.refs)
+
+
+class ItemsRef:
+    '''
+    Parameter reference covering a whole foreach collection whose body has
+    no dynamic parts, e.g. the "#{name}" of an IN list.
+    '''
+    __slots__ = ('collection', 'item', 'item_refs', 'pad_to')
+
+    def __init__(self, collection: Expression, item: str, item_refs: list, pad_to: int=0):
+        self.collection = collection
+        self.item = item
+        self.item_refs = item_refs
+        # repeat the last item up to this many values
+        self.pad_to = pad_to
+
+    def bind(self, params: dict, values: list):
+        l = self.collection.evaluate_in(params)
+        if len(self.item_refs) == 1 and self.item_refs[0] == self.item:
+            values.extend(l)
+            if len(l) < self.pad_to:
+                values.extend([l[-1]] * (self.pad_to - len(l)))
+            return
+        for value in l:
+            for ref in self.item_refs:
+                values.append(value if ref == self.item else params.get(ref))
+
+
+class ArrayRef:
+    __slots__ = ('collection',)
+
+    def __init__(self, collection: Expression):
+        self.collection = collection
+
+    def bind(self, params: dict, values: list):
+        values.append(list(self.collection.evaluate_in(params)))
+
+
+def bucket_size(n: int) -> int:
+    # next power of two, so a collection only renders to a few distinct texts
+    if n <= 1:
+        return n
+    return 1 << (n - 1).bit_length()
+
+
+def bind_params(refs: list, params: dict) -> list:
+    values = []
+    for ref in refs:
+        if ref.__class__ is str:
+            values.append(params.get(ref))
+        elif ref.__class__ is tuple:
+            collection, index = ref
+            values.append(collection.evaluate_in(params)[index])
+        else:
+            ref.bind(params, values)
+    return values
+
+
+class ForEachSqlNode(SqlNode):
+    def __init__(self, contents: MixedSqlNode, collection: Expression, item: str,
+                 open: str, close: str, separator: str, bind: Optional[str]=None):
+        self.contents = contents
+        self.collection = collection
+        self.item = item
+        self.bind = bind
+        self.open = normalize_text(open)
+        self.close = normalize_text(close)
+        self.separator = normalize_text(separator)
+
+        # A body without dynamic parts renders the same for every item, so it
+        # is rendered once here; apply() then only repeats the text.
+        self.body = None
+        if not contents.dynamic:
+            body = DynamicContext({})
+            body.space = False
+            contents.apply(body)
+            body_text = "".join(body.parts)
+            if body_text.strip() != "":
+                following = DynamicContext({})
+                following.space = body.space
+                following.text(self.separator)
+                following.text(body_text)
+                self.body = body_text
+                self.body_space = body.space
+                self.following = "".join(following.parts)
+                self.body_refs = body.refs
+
+        if bind not in (None, "array"):
+            raise Exception("Unknown foreach bind: " + bind)
+        if bind == "array" and (self.body is None or self.body_refs != [item]):
+            raise Exception("foreach with bind=\"array\" must contain exactly #{" + item + "}")
+
+    @property
+    def params_per_item(self) -> Optional[int]:
+        if self.body is None:
+            return None
+        return len(self.body_refs)
+
+    def apply(self, context: DynamicContext):
+        l = self.collection.evaluate_in(context.params)
+        if not isinstance(l, list):
+            raise Exception("Collection must be a list")
+
+        if self.bind == "array":
+            self.apply_array(context, l)
+            return
+
+        context.text(self.open)
+        if self.body is not None:
+            if len(l) > 0:
+                context.text(self.body)
+                if len(l) > 1:
+                    context.parts.append(self.following * (len(l) - 1))
+                context.space = self.body_space
+                if self.body_refs:
+                    context.refs.append(ItemsRef(self.collection, self.item, self.body_refs))
+        else:
+            refs = context.refs
+            for index in range(len(l)):
+                if index > 0:
+                    context.text(self.separator)
+                start = len(refs)
+                self.contents.apply(context)
+                for i in range(start, len(refs)):
+                    if refs[i] == self.item:
+                        refs[i] = (self.collection, index)
+        context.text(self.close)
+
+    def shape(self, context: DynamicContext, key: list):
+        l = self.collection.evaluate_in(context.params)
+        if not isinstance(l, list):
+            raise Exception("Collection must be a list")
+
+        if self.bind == "array":
+            key.append("array" if context.array_binding else bucket_size(len(l)))
+            return
+
+        key.append(len(l))
+        if self.contents.dynamic:
+            for _ in range(len(l)):
+                self.contents.shape(context, key)
+
+
+    def apply_array(self, context: DynamicContext, l: list):
+        # The whole collection is bound as one array where the driver allows
+        # it and padded to a power of two elsewhere, so the statement text
+        # stays the same for most collection lengths.
+        if context.array_binding:
+            context.text(" = ANY(")
+            context.param(ArrayRef(self.collection))
+            context.text(") ")
+            return
+
+        context.text(" IN (")
+        if len(l) == 0:
+            context.text("NULL")
+        else:
+            size = bucket_size(len(l))
+            context.parts.append("?" + ", ?" * (size - 1))
+            context.space = False
+            context.refs.append(ItemsRef(self.collection, self.item, self.body_refs, size))
+        context.text(") ")
+
+
+def iter_nodes(node: SqlNode):
+    # Walks a compiled tree without following <include> targets.
+    yield node
+    if isinstance(node, MixedSqlNode):
+        for child in node.contents:
+            yield from iter_nodes(child)
+    elif isinstance(node, ChooseSqlNode):
+        for when in node.whens:
+            yield from iter_nodes(when)
+        if node.otherwise is not None:
+            yield from iter_nodes(node.otherwise)
+    elif hasattr(node, 'contents'):
+        yield from iter_nodes(node.contents)
+
+
+class MappedStatement:
+    def __init__(self, id: str, namespace: str, tag: str, root: MixedSqlNode,
+                 includes: List[IncludeSqlNode], fetch_size: Optional[int]=None, timeout_ms: Optional[int]=None,
+                 use_cache: Optional[bool]=None, flush_cache: Optional[bool]=None,
+                 cache_max_live_ms: Optional[int]=None, cache_refresh_after_ms: Optional[int]=None,
+                 tables: Optional[List[str]]=None, read_tables: Optional[Set[str]]=None, write_tables: Optional[Set[str]]=None):
+        self.id = id
+        self.namespace = namespace
+        self.tag = tag
+        self.root = root
+        self.includes = includes
+        self.fetch_size = fetch_size
+        self.timeout_ms = timeout_ms
+        # selects are cached unless told otherwise; when flush_cache is None
+        # writes only evict the cached results of the tables they write
+        self.use_cache = tag == "select" if use_cache is None else use_cache
+        self.flush_cache = flush_cache
+        self.cache_max_live_ms = cache_max_live_ms
+        self.cache_refresh_after_ms = cache_refresh_after_ms
+        # explicit tables attribute, overriding the tables found in the text
+        self.tables = tables
+        self.read_tables = read_tables or set()
+        self.write_tables = write_tables or set()
+        self.foreach_nodes = [node for node in iter_nodes(root) if isinstance(node, ForEachSqlNode)]
+        # part of the SQL cache key, renewed by MapperManager whenever the text may have changed
+        self.generation = 0
@@ -0,0 +1,45 @@
+import re
+from typing import Set, Tuple
+
+# stands for a table name that is only known at runtime, e.g. fruits_${date}
+UNKNOWN_TABLE = "*"
+
+_clause_end = r"(?=\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING|UNION|EXCEPT|INTERSECT|JOIN|STRAIGHT_JOIN|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL|ON|USING|SET|VALUES|RETURNING|OFFSET|FOR|WINDOW)\b|[();]|$)"
+from_pattern = re.compile(r"\bFROM\s+(.*?)" + _clause_end, re.IGNORECASE | re.DOTALL)
+join_pattern = re.compile(r"\b(?:STRAIGHT_)?JOIN\s+([^\s(),;]+)", re.IGNORECASE)
+write_pattern = re.compile(r"\b(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM|MERGE\s+INTO|TRUNCATE(?:\s+TABLE)?)\s+([^\s(),;]+)",
+                           re.IGNORECASE)
+
+
+def normalize_table(name: str) -> str:
+    '''
+    :return: the lower case name without quotes and without schema, so that main.fruits and fruits
+        invalidate each other; UNKNOWN_TABLE for a name built with ${}
+    '''
+    name = name.replace('`', '').replace('"', '').lower()
+    if "${" in name or "#{" in name:
+        return UNKNOWN_TABLE
+    return name.rsplit(".", 1)[-1]
+
+
+def extract_tables(text: str) -> Tuple[Set[str], Set[str]]:
+    '''
+    Finds the tables a statement reads and writes by scanning its text,
+    including the text of its dynamic elements.
+    :return: (read tables, written tables); UNKNOWN_TABLE stands for names built with ${}
+    '''
+    reads = set()
+    for match in from_pattern.finditer(text):
+        for item in match.group(1).split(","):
+            words = item.split()
+            if words and not words[0].startswith("("):
+                reads.add(normalize_table(words[0]))
+    for match in join_pattern.finditer(text):
+        reads.add(normalize_table(match.group(1)))
+
+    writes = set()
+    for match in write_pattern.finditer(text):
+        writes.add(normalize_table(match.group(1)))
+    # the target of DELETE FROM is matched by the FROM pattern too
+    reads -= writes
+    return reads, writes
@@ -0,0 +1,120 @@
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from .cache import CacheEntry, CacheKey, EMPTY_RESULT, now_ms
+from .cache_backend import CacheBackend
+from .codec import thaw
+
+
+class TieredCache(CacheBackend):
+    '''
+    Two caches in front of each other: results are stored in the first tier,
+    usually a Cache in memory, and the entries it drops for lack of room move
+    to the second tier, usually a DiskCache, with what is left of their
+    lifetime and their tags. A miss in the first tier looks in the second one
+    and moves the entry found back up.
+
+    :param l1: cache that reports its evictions, see CacheBackend.set_on_evict
+    :param l2: cache with a lookup method returning (value, tags, remaining ms, encoded size), such as DiskCache;
+        when it also has put_encoded and the codec class of l1, values spill without being decoded
+    '''
+    def __init__(self, l1: CacheBackend, l2: CacheBackend):
+        self.l1 = l1
+        self.l2 = l2
+        self.memory_limit = l1.memory_limit
+        self.max_live_ms = l1.max_live_ms
+        self.codec = l1.codec
+        # the values of l1 are stored in the form l2 keeps, and spill as they are
+        self.same_codec = l1.codec.__class__ is l2.codec.__class__ and hasattr(l2, "put_encoded")
+        # held while spilling and invalidating, so that a spill cannot bring back an invalidated entry
+        self.lock = threading.Lock()
+        # tag -> when it was last invalidated, and when both tiers were last cleared (now_ms)
+        self.invalidated_at: Dict[str, int] = {}
+        self.cleared_at = -1
+        # key being moved up from l2 by this thread, which l1 may turn down
+        self.promoting = threading.local()
+        l1.set_on_evict(self._spill)
+
+    def _spill(self, key: CacheKey, entry: CacheEntry):
+        if getattr(self.promoting, "key", None) == key:
+            # turned down by l1 while moving up from l2, which still has it
+            return
+        remaining = entry.expires_at - now_ms()
+        if remaining <= 0:
+            return
+        value = entry.value
+        encoded = self.same_codec and isinstance(value, bytes)
+        if value is not EMPTY_RESULT and not encoded:
+            # read-only structures of FrozenCodec become plain rows again for the codec of l2
+            value = thaw(self.l1.codec.decode(value))
+        with self.lock:
+            # l1 evicts outside its lock, an invalidation may have passed both tiers since
+            created_at = entry.created_at
+            if created_at <= self.cleared_at or \
+                    any(self.invalidated_at.get(tag, -1) >= created_at for tag in entry.tags):
+                return
+            if encoded:
+                self.l2.put_encoded(key, value, entry.tags, remaining)
+            else:
+                self.l2.put(key, value, entry.tags, remaining, entry.cost)
+
+    def get(self, key: CacheKey, record_stats: bool=True) -> Optional[Any]:
+        return self.get_stale(key, record_stats)[0]
+
+    def get_stale(self, key: CacheKey, record_stats: bool=True) -> Tuple[Optional[Any], bool]:
+        value, stale = self.l1.get_stale(key, record_stats)
+        if value is not None:
+            return value, stale
+        found = self.l2.lookup(key, record_stats)
+        if found is None:
+            return None, False
+        value, tags, remaining, size = found
+        if size > self.l1.max_entry_size:
+            # l1 would turn it down, and encoding it again for nothing is what l2 spares
+            return value, False
+        # l1 hands back the value as a hit on it would
+        self.promoting.key = key
+        try:
+            return self.l1.put(key, value, tags, remaining), False
+        finally:
+            self.promoting.key = None
+
+    def put(self, key: CacheKey, value: Any, tags: Iterable[str]=(), max_live_ms: Optional[int]=None,
+            cost: Optional[float]=None, refresh_after_ms: Optional[int]=None) -> Any:
+        return self.l1.put(key, value, tags, max_live_ms, cost, refresh_after_ms)
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        tags = list(tags)
+        with self.lock:
+            now = now_ms()
+            for tag in tags:
+                self.invalidated_at[tag] = now
+            return self.l1.invalidate_tags(tags) + self.l2.invalidate_tags(tags)
+
+    def clear(self):
+        with self.lock:
+            self.cleared_at = now_ms()
+            self.invalidated_at.clear()
+            self.l1.clear()
+            self.l2.clear()
+
+    def expire(self) -> int:
+        return self.l1.expire() + self.l2.expire()
+
+    def __len__(self):
+        return len(self.l1) + len(self.l2)
+
+    def empty(self) -> bool:
+        return self.l1.empty() and self.l2.empty()
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        :return: the stats of the first tier, with those of the second one under "l2"
+        '''
+        stats = self.l1.stats()
+        stats["l2"] = self.l2.stats()
+        return stats
+
+    def reset_stats(self):
+        self.l1.reset_stats()
+        self.l2.reset_stats()
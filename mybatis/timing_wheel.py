@@ -0,0 +1,119 @@
+from typing import Dict, Hashable, List, Set, Tuple
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+
+
+class TimingWheel(object):
+    '''
+    Hierarchical timing wheel of expiry deadlines. Level 0 has one slot per
+    tick; each slot of level n spans a whole turn of level n - 1. A key sits
+    in the coarsest level its deadline allows and moves down a level each
+    time its slot comes up, so scheduling, cancelling and expiring a key cost
+    O(levels) whatever the number of keys. Keys expire on the first tick at
+    or after their deadline, never before it.
+
+    :param tick_ms: resolution of the wheel
+    :param levels: number of levels; deadlines further away than
+        tick_ms * 64 ** levels are parked in the last level and moved again
+    '''
+    def __init__(self, tick_ms:int=100, levels:int=4, now_ms:int=0):
+        if tick_ms <= 0:
+            raise Exception("Invalid tick_ms: %s" % tick_ms)
+        self.tick_ms = tick_ms
+        self.levels = levels
+        self.wheels : List[List[Set[Hashable]]] = [[set() for _ in range(SLOTS)] for _ in range(levels)]
+        # key -> deadline in ticks
+        self.deadlines : Dict[Hashable, int] = {}
+        # key -> level and slot holding it
+        self.slots : Dict[Hashable, Tuple[int, Set[Hashable]]] = {}
+        # keys per level, to skip the ticks on which nothing can happen
+        self.counts = [0] * levels
+        self.current = now_ms // tick_ms
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def clear(self):
+        for wheel in self.wheels:
+            for slot in wheel:
+                slot.clear()
+        self.deadlines.clear()
+        self.slots.clear()
+        self.counts = [0] * self.levels
+
+    def schedule(self, key: Hashable, deadline_ms: int):
+        '''
+        Sets the deadline of a key, replacing the one it had.
+        '''
+        self.cancel(key)
+        # rounded up and at least the next tick, as the current one has fired already
+        tick = max(-(-deadline_ms // self.tick_ms), self.current + 1)
+        self.deadlines[key] = tick
+        self._place(key, tick)
+
+    def cancel(self, key: Hashable):
+        placed = self.slots.pop(key, None)
+        if placed is not None:
+            level, slot = placed
+            slot.discard(key)
+            self.counts[level] -= 1
+            del self.deadlines[key]
+
+    def advance(self, now_ms: int) -> List[Hashable]:
+        '''
+        Moves the wheel up to now_ms.
+        :return: the keys whose deadline has passed; they are no longer scheduled
+        '''
+        target = now_ms // self.tick_ms
+        expired: List[Hashable] = []
+        while self.current < target:
+            if not self.deadlines:
+                self.current = target
+                break
+            # with the finer levels empty nothing happens before the next turn
+            # of the finest level holding keys
+            level = 0
+            while not self.counts[level]:
+                level += 1
+            if level:
+                span = 1 << (SLOT_BITS * level)
+                self.current = min(target - 1, (self.current | (span - 1)))
+            self.current += 1
+            tick = self.current
+            # coarse levels first, so that keys they hand down fire in this same tick
+            for level in range(self.levels - 1, -1, -1):
+                shift = SLOT_BITS * level
+                if tick & ((1 << shift) - 1) == 0:
+                    slot = self.wheels[level][(tick >> shift) & SLOT_MASK]
+                    if not slot:
+                        continue
+                    keys = list(slot)
+                    slot.clear()
+                    self.counts[level] -= len(keys)
+                    for key in keys:
+                        deadline = self.deadlines[key]
+                        if deadline <= tick:
+                            self._expire(key, expired)
+                        else:
+                            self._place(key, deadline)
+        return expired
+
+    def _expire(self, key: Hashable, expired: List[Hashable]):
+        del self.deadlines[key]
+        del self.slots[key]
+        expired.append(key)
+
+    def _place(self, key: Hashable, tick: int):
+        # the last level takes everything further away; such keys are placed
+        # again instead of expiring when their slot comes up
+        tick = min(tick, self.current + (1 << (SLOT_BITS * self.levels)) - 1)
+        delta = tick - self.current
+        level = 0
+        while level < self.levels - 1 and delta >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        slot = self.wheels[level][(tick >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot.add(key)
+        self.slots[key] = (level, slot)
+        self.counts[level] += 1
@@ -1,8 +1,10 @@
+import re
+
 from setuptools import setup, find_packages
 
 setup(
     name='mybatis',
-    version='0.0.17',
+    version=re.search(r'__version__ = "(.*)"', open('mybatis/version.py').read()).group(1),
     description='A python ORM like mybatis.',
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',  # 如果你使用的是Markdown格式的README
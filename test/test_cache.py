@@ -1,10 +1,23 @@
+import datetime
+import multiprocessing
+import os
+import threading
 import time
+import uuid
+from decimal import Decimal
 
+import orjson as json
 import pytest
-from mybatis import Cache, CacheKey
+from mybatis import BinaryCodec, Cache, CacheKey, DiskCache, FrozenCodec, JsonCodec, ShardedCache, TieredCache, \
+    WTinyLfuPolicy, GdsfPolicy
+from mybatis.cache import EMPTY_RESULT, key_digest
+from mybatis.errors import FlightTimeoutError
+from mybatis.shared_cache import SharedMemoryCache
+from mybatis.single_flight import SingleFlight
+from mybatis.timing_wheel import TimingWheel
 
 def test_basic():
-    cache = Cache(memory_limit=400, max_live_ms=10*1000)  # 50MB, 10sec
+    cache = Cache(memory_limit=1200, max_live_ms=10*1000)  # 50MB, 10sec
     cache.put(CacheKey("a", [1, 'a', None]), [{"a1": 1}, {"a2": 2}])
     cache.put(CacheKey("b", [2, 'b', None]), "2")
     cache.put(CacheKey("c", [3, 'c', None]), "3")
@@ -20,13 +33,13 @@ def test_basic():
         l.append((key, value, memory_usage, type(value)))
 
     assert len(l) == 3
-    assert l[0][0] == b'{"sql":"b","param_list":[2,"b",null]}'
+    assert l[0][0] == CacheKey("b", [2, 'b', None])
     assert l[0][1] == '2'
 
-    assert l[1][0] == b'{"sql":"d","param_list":[4,"d",null]}'
+    assert l[1][0] == CacheKey("d", [4, 'd', None])
     assert l[1][1] == None
 
-    assert l[2][0] == b'{"sql":"c","param_list":[3,"c",null]}'
+    assert l[2][0] == CacheKey("c", [3, 'c', None])
     assert l[2][1] == '3'
 
     cache.put(CacheKey("e", [5, 'e', None]), "5")
@@ -38,17 +51,17 @@ def test_basic():
 
     assert len(l) == 3
 
-    assert l[0][0] == b'{"sql":"e","param_list":[5,"e",null]}'
+    assert l[0][0] == CacheKey("e", [5, 'e', None])
     assert l[0][1] == '5'
 
-    assert l[1][0] == b'{"sql":"b","param_list":[2,"b",null]}'
+    assert l[1][0] == CacheKey("b", [2, 'b', None])
     assert l[1][1] == '2'
 
-    assert l[2][0] == b'{"sql":"d","param_list":[4,"d",null]}'
+    assert l[2][0] == CacheKey("d", [4, 'd', None])
     assert l[2][1] == None
 
 def test_timeout():
-    cache = Cache(memory_limit=400, max_live_ms=1 * 1000)  # 50MB, 10sec
+    cache = Cache(memory_limit=1200, max_live_ms=1 * 1000)  # 50MB, 10sec
     cache.put(CacheKey("a", [1, 'a', None]), [{"a1": 1}, {"a2": 2}])
     cache.put(CacheKey("b", [2, 'b', None]), "2")
     cache.put(CacheKey("c", [3, 'c', None]), "3")
@@ -77,3 +90,494 @@ def test_overwrite():
     assert cache.get(CacheKey("a", [1, 'a', None])) != None
 
     #print("====>", cache.memory_used)
+
+def test_invalidate_tags():
+    cache = Cache(memory_limit=2000, max_live_ms=10 * 1000)
+    cache.put(CacheKey("a", [1]), "1", tags=("id:a",))
+    cache.put(CacheKey("b", [2]), "2", tags=("id:b",))
+    cache.put(CacheKey("c", [3]), "3")
+
+    assert cache.invalidate_tags(["id:a", "id:x"]) == 1
+    assert cache.get(CacheKey("a", [1])) == None
+    assert cache.get(CacheKey("b", [2])) == '2'
+    assert cache.get(CacheKey("c", [3])) == '3'
+    assert "id:a" not in cache.tag_index
+
+    cache.clear()
+    assert cache.memory_used == 0
+    assert cache.tag_index == {}
+
+def test_cache_key():
+    assert CacheKey("a", [1, [2, 3], {'x': 4}], "s") == CacheKey("a", (1, (2, 3), {'x': 4}), "s")
+    assert hash(CacheKey("a", [1, [2, 3]], "s")) == hash(CacheKey("a", [1, [2, 3]], "s"))
+    assert CacheKey("a", [1], "s") != CacheKey("a", [1], "t")
+    assert CacheKey("a", [1]) != CacheKey("a", [2])
+
+    large = CacheKey("a", list(range(1000)))
+    assert large.params[0] == "__fingerprint__"
+    assert large == CacheKey("a", list(range(1000)))
+    assert large != CacheKey("a", list(range(1, 1001)))
+
+    # values orjson writes alike still make different keys in other processes
+    day = datetime.datetime(2024, 1, 1)
+    id = uuid.uuid4()
+    for a, b in [(day, day.isoformat()), (id, str(id)), (float("nan"), None)]:
+        assert key_digest(CacheKey("a", [a])) != key_digest(CacheKey("a", [b]))
+        assert CacheKey("a", [a] * 100) != CacheKey("a", [b] * 100)
+    assert key_digest(CacheKey("a", [1, "x"], "s")) == key_digest(CacheKey("a", (1, "x"), "s"))
+
+    cache = Cache(memory_limit=2000, max_live_ms=10 * 1000)
+    cache.put(CacheKey("a", [Decimal("1.50")]), "1")
+    assert cache.get(CacheKey("a", [Decimal("1.50")])) == '1'
+
+def test_frozen_codec():
+    cache = Cache(memory_limit=1024*1024, max_live_ms=10 * 1000, codec=FrozenCodec())
+    rows = [{'id': 1, 'created': datetime.datetime(2024, 12, 4)}, {'id': 2, 'created': None}]
+    returned = cache.put(CacheKey("a", []), rows)
+    rows[0]['id'] = 3
+
+    hit = cache.get(CacheKey("a", []))
+    assert hit is returned
+    assert hit == ({'id': 1, 'created': datetime.datetime(2024, 12, 4)}, {'id': 2, 'created': None})
+    with pytest.raises(TypeError):
+        hit[0]['id'] = 4
+
+    cache = Cache(memory_limit=1024*1024, max_live_ms=10 * 1000, codec=FrozenCodec(copy_on_read=True))
+    assert cache.put(CacheKey("a", []), rows) is rows
+    hit = cache.get(CacheKey("a", []))
+    assert hit == [{'id': 3, 'created': datetime.datetime(2024, 12, 4)}, {'id': 2, 'created': None}]
+    hit[0]['id'] = 5
+    assert cache.get(CacheKey("a", []))[0]['id'] == 3
+
+def test_binary_codec():
+    codec = BinaryCodec()
+    rows = [{'id': i, 'name': 'fruit%d' % i, 'price': Decimal('%d.25' % i), 'ratio': i / 7,
+             'created': datetime.datetime(2024, 12, 4, 10, i), 'day': datetime.date(2024, 12, i + 1),
+             'at': datetime.time(10, i), 'wait': datetime.timedelta(seconds=i), 'ref': uuid.UUID(int=i),
+             'data': None if i == 1 else bytes([i]), 'view': memoryview(b'x' * i), 'flag': i % 2 == 0,
+             'note': None if i else 'first', 'tags': ['a', i], 'big': 2 ** 70 + i} for i in range(3)]
+    hit = codec.decode(codec.encode(rows))
+    assert hit == rows
+    assert [[type(value) for value in row.values()] for row in hit] == \
+        [[type(value) for value in row.values()] for row in rows]
+    assert codec.decode(codec.encode(rows[0])) == rows[0]
+
+    for value in ([], {}, "1", [1, -2 ** 80], ({"a": 1}, {1, 2}), [{"a": 1}, {"b": 2}], [{"a": float("inf")}],
+                  [{"a": "\ud800"}], range(3)):
+        assert codec.decode(codec.encode(value)) == value
+
+    # the column names are stored once, not once per row
+    plain = [{'id': i, 'name': 'fruit%d' % i, 'category': 'A', 'price': i * 10} for i in range(100)]
+    assert len(codec.encode(plain)) < len(json.dumps(plain)) // 2
+
+    cache = Cache(memory_limit=1024 * 1024, max_live_ms=10 * 1000)
+    cache.put(CacheKey("a", []), rows)
+    assert cache.get(CacheKey("a", [])) == rows
+
+def test_size_accounting():
+    cache = Cache(memory_limit=10000, max_live_ms=10 * 1000, codec=JsonCodec())
+    cache.put(CacheKey("select", [1, 'ab']), [{"a": 1}])
+    cache.put(CacheKey("select", [2, 'cd']), [{"a": 2}])
+    (_, _, usage2), (_, _, usage1) = list(cache.traverse())
+    assert usage1 == Cache.ENTRY_OVERHEAD + len("select") + 8 + (2 + 8) + len(b'[{"a":1}]')
+    assert cache.memory_used == usage1 + usage2
+
+    cache.put(CacheKey("select", [1, 'ab']), [{"a": 1}, {"a": 3}])
+    assert cache.memory_used == usage1 + usage2 + len(b',{"a":3}')
+    cache.clear()
+    assert cache.memory_used == 0 and cache.empty()
+
+def test_sharded_cache():
+    cache = ShardedCache(memory_limit=4 * 10000, max_live_ms=10 * 1000, shards=4)
+    assert all([shard.memory_limit == 10000 for shard in cache.shards])
+    for i in range(20):
+        cache.put(CacheKey("select", [i]), [{"a": i}], tags=("table:t%d" % (i % 2),))
+    assert len(cache) == 20
+    assert cache.get(CacheKey("select", [3])) == [{"a": 3}]
+    assert cache.get(CacheKey("select", [30])) is None
+    assert cache.invalidate_tags(["table:t1"]) == 10
+    assert len(cache) == 10 and len(list(cache.traverse())) == 10
+
+    stats = cache.stats()
+    assert stats["entries"] == 10 and stats["puts"] == 20
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["memory_used"] == cache.memory_used
+
+    cache.clear()
+    assert cache.empty() and cache.memory_used == 0
+
+def test_concurrent_access():
+    cache = ShardedCache(memory_limit=20000, max_live_ms=10 * 1000, shards=4)
+    errors = []
+
+    def work(n):
+        try:
+            for i in range(2000):
+                key = CacheKey("select", [(n * 7 + i) % 50])
+                if cache.get(key) is None:
+                    cache.put(key, [{"a": i}], tags=("table:t%d" % (i % 3),))
+                if i % 100 == 0:
+                    cache.invalidate_tags(["table:t0"])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for shard in cache.shards:
+        assert shard.memory_used == sum([entry.memory_usage for entry in shard.table.values()])
+        assert shard.memory_used <= shard.memory_limit
+        assert set(shard.table) == set().union(*shard.tag_index.values())
+
+def test_timing_wheel():
+    wheel = TimingWheel(tick_ms=10, levels=3, now_ms=0)
+    wheel.schedule("a", 25)
+    wheel.schedule("b", 700)
+    wheel.schedule("c", 50000)
+    wheel.schedule("d", 10 * 64 ** 3 * 3)  # beyond the span of the wheel
+    wheel.schedule("e", 40)
+    wheel.cancel("e")
+    assert len(wheel) == 4
+
+    assert wheel.advance(29) == []
+    assert wheel.advance(30) == ["a"]
+    assert wheel.advance(699) == []
+    assert wheel.advance(700) == ["b"]
+    assert wheel.advance(49999) == []
+    assert wheel.advance(50000) == ["c"]
+    assert wheel.advance(10 * 64 ** 3 * 3 - 1) == []
+    assert wheel.advance(10 * 64 ** 3 * 3) == ["d"]
+    assert len(wheel) == 0
+
+def test_expire_unread_entries():
+    cache = Cache(memory_limit=10000, max_live_ms=10 * 1000, expiry_tick_ms=10)
+    cache.put(CacheKey("a", []), [1], max_live_ms=50)
+    cache.put(CacheKey("b", []), [2], max_live_ms=50)
+    cache.put(CacheKey("c", []), [3])
+    time.sleep(0.1)
+    # the entries are dropped without being looked up
+    assert cache.expire() == 2
+    assert len(cache) == 1 and len(cache.wheel) == 1
+    assert cache.memory_used == next(cache.traverse())[2]
+    assert cache.stats()["evicted_expired"] == 2
+
+def test_single_flight():
+    flights = SingleFlight(timeout_ms=5000)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def query():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return [{"a": 1}]
+
+    def work():
+        results.append(flights.do("key", query))
+
+    leader = threading.Thread(target=work)
+    leader.start()
+    started.wait()
+    waiters = [threading.Thread(target=work) for _ in range(5)]
+    for thread in waiters:
+        thread.start()
+    while flights.stats()["coalesced"] < 5:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted([shared for _, shared in results]) == [False] + [True] * 5
+    assert all([res == [{"a": 1}] for res, _ in results])
+    assert flights.stats() == {"calls": 1, "coalesced": 5, "timeouts": 0, "errors": 0, "in_flight": 0}
+
+def test_single_flight_error_and_timeout():
+    flights = SingleFlight(timeout_ms=50)
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def query():
+        started.set()
+        release.wait()
+        raise ValueError("broken")
+
+    def work():
+        try:
+            flights.do("key", query)
+        except Exception as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=work)
+    leader.start()
+    started.wait()
+    with pytest.raises(FlightTimeoutError):
+        flights.do("key", query)
+
+    flights.timeout_ms = 5000
+    waiter = threading.Thread(target=work)
+    waiter.start()
+    while flights.stats()["coalesced"] < 2:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    waiter.join()
+    assert [str(e) for e in errors] == ["broken", "broken"]
+    assert flights.stats()["timeouts"] == 1 and flights.stats()["errors"] == 1
+    # the failed call is not remembered
+    assert flights.do("key", lambda: 1) == (1, False)
+
+def test_empty_result():
+    cache = Cache(memory_limit=10000, max_live_ms=10 * 1000, codec=JsonCodec())
+    cache.put(CacheKey("a", [1]), EMPTY_RESULT)
+    cache.put(CacheKey("b", [1]), None)
+    assert cache.get(CacheKey("a", [1])) is EMPTY_RESULT
+    assert cache.get(CacheKey("c", [1])) is None
+    assert cache.memory_used == 2 * Cache.ENTRY_OVERHEAD + 2 * (len("a") + 8) + len(b"null")
+    assert [value for _, value, _ in cache.traverse()] == [EMPTY_RESULT, None]
+
+def test_stats():
+    cache = Cache(memory_limit=2000, max_live_ms=10 * 1000)
+    cache.put(CacheKey("select a", [1], id="a"), [{"a": 1}], tags=("t",))
+    cache.put(CacheKey("select a", [2], id="a"), [{"a": 2}], max_live_ms=0)
+    cache.put(CacheKey("select b", [1], id="b"), [{"b": 1}])
+    cache.put(CacheKey("select b", [2], id="b"), ["x" * 5000])
+    assert cache.get(CacheKey("select a", [1], id="a")) == [{"a": 1}]
+    time.sleep(0.01)
+    assert cache.get(CacheKey("select a", [2], id="a")) is None
+    assert cache.get(CacheKey("select b", [3], id="b")) is None
+    assert cache.invalidate_tags(["t"]) == 1
+    for i in range(6):
+        cache.put(CacheKey("select c", [i], id="c"), [i])
+
+    stats = cache.stats()
+    a, b, c = stats["statements"]["a"], stats["statements"]["b"], stats["statements"]["c"]
+    assert (a["hits"], a["misses"], a["puts"], a["evicted_expired"], a["evicted_invalidated"]) == (1, 1, 2, 1, 1)
+    assert a["entries"] == 0 and a["memory_used"] == 0
+    assert (b["misses"], b["puts"], b["rejected"]) == (1, 1, 1)
+    assert b["evicted_capacity"] == 1 and c["entries"] == 5 and c["evicted_capacity"] == 1
+    assert stats["entries"] == len(cache) == 5
+    assert stats["memory_used"] == cache.memory_used == c["memory_used"]
+    assert stats["average_entry_size"] == cache.memory_used // 5
+    assert stats["evictions"] == 4 and stats["memory_limit"] == 2000
+
+    cache.reset_stats()
+    stats = cache.stats()
+    assert stats["hits"] == stats["puts"] == stats["evictions"] == 0
+    assert list(stats["statements"]) == ["c"] and stats["entries"] == 5
+
+    cache.clear()
+    assert cache.stats()["evicted_invalidated"] == 5 and cache.stats()["memory_used"] == 0
+
+def test_tiny_lfu_policy():
+    entry_size = Cache.ENTRY_OVERHEAD + len("hot") + 8 + len(b"[1]")
+    cache = Cache(memory_limit=20 * entry_size + 1, max_live_ms=10 * 1000, codec=JsonCodec(),
+                  policy=WTinyLfuPolicy(window_ratio=0.1))
+    hot = [CacheKey("hot", [i]) for i in range(10)]
+    for _ in range(5):
+        for key in hot:
+            if cache.get(key) is None:
+                cache.put(key, [1])
+    # a scan of keys read once does not push out the keys read again and again
+    for i in range(200):
+        key = CacheKey("scn", [i])
+        if cache.get(key) is None:
+            cache.put(key, [1])
+    assert all([cache.get(key) == [1] for key in hot])
+    assert len(cache) == 20
+    assert cache.stats()["evicted_capacity"] == 190
+
+def test_gdsf_policy():
+    cache = Cache(memory_limit=10000, max_live_ms=10 * 1000, policy=GdsfPolicy())
+    for i in range(40):
+        # slow queries with small results, then fast queries with large ones
+        cache.put(CacheKey("slow", [i]), [i], cost=50.0)
+        cache.put(CacheKey("fast", [i]), ["x" * 200], cost=1.0)
+    kept = [key.sql for key, _, _ in cache.traverse()]
+    assert kept.count("slow") > 3 * kept.count("fast")
+    assert cache.memory_used < cache.memory_limit
+    stats = cache.stats()
+    assert stats["puts"] + stats["rejected"] == 80
+
+def _shared_put(path, count):
+    cache = SharedMemoryCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000)
+    for i in range(count):
+        cache.put(CacheKey("select", [i], id="s"), [{"i": i, "name": "x" * (i % 50)}], tags=("table:t%d" % (i % 2),))
+    cache.close()
+
+def _shared_put_large(path):
+    cache = SharedMemoryCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000)
+    cache.put(CacheKey("select", list(range(100)), id="large"), [{"i": 100}])
+    cache.close()
+
+def test_shared_memory_cache(tmp_path):
+    path = str(tmp_path / "cache")
+    cache = SharedMemoryCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000)
+    assert cache.get(CacheKey("select", [1], id="s")) is None
+
+    # another process fills the cache, this one reads it
+    process = multiprocessing.get_context("spawn").Process(target=_shared_put, args=(path, 20))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert cache.get(CacheKey("select", [3], id="s")) == [{"i": 3, "name": "xxx"}]
+    assert len(cache) == 20
+
+    # keys with many parameters are fingerprinted alike in every process
+    process = multiprocessing.get_context("spawn").Process(target=_shared_put_large, args=(path,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert cache.get(CacheKey("select", list(range(100)), id="large")) == [{"i": 100}]
+    assert cache.get(CacheKey("select", list(range(1, 101)), id="large")) is None
+
+    cache.put(CacheKey("select", [100]), EMPTY_RESULT, max_live_ms=50)
+    assert cache.get(CacheKey("select", [100])) is EMPTY_RESULT
+    time.sleep(0.1)
+    assert cache.get(CacheKey("select", [100])) is None
+
+    cache.invalidate_tags(["table:t1"])
+    assert cache.get(CacheKey("select", [3], id="s")) is None
+    assert cache.get(CacheKey("select", [4], id="s")) == [{"i": 4, "name": "xxxx"}]
+    # expired and invalidated values count until the arena overwrites them
+    assert len(cache) == 22
+
+    stats = cache.stats()
+    assert stats["entries"] == 22 and stats["statements"]["s"]["hits"] == 2
+    cache.put(CacheKey("select", [4], id="s"), [{"i": 4}])
+    assert len(cache) == 22
+    cache.clear()
+    assert cache.empty() and cache.memory_used == 0
+
+    # a forked worker opens its own descriptor and closes the inherited one
+    inherited = cache.fd
+    cache.pid = -1
+    cache.put(CacheKey("select", [1]), [{"i": 1}])
+    assert cache.fd != inherited
+    with pytest.raises(OSError):
+        os.fstat(inherited)
+
+    with pytest.raises(Exception, match="other sizes"):
+        SharedMemoryCache(path, memory_limit=32 * 1024, max_live_ms=10 * 1000)
+    with pytest.raises(Exception, match="encodes to bytes"):
+        SharedMemoryCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000, codec=FrozenCodec())
+    cache.close()
+
+def test_shared_memory_cache_wraps_around(tmp_path):
+    cache = SharedMemoryCache(str(tmp_path / "cache"), memory_limit=4096, max_live_ms=10 * 1000)
+    for i in range(100):
+        cache.put(CacheKey("select", [i]), ["x" * 100])
+    # the arena keeps the newest values, older ones are overwritten
+    assert cache.get(CacheKey("select", [99])) == ["x" * 100]
+    assert cache.get(CacheKey("select", [0])) is None
+    assert 0 < len(cache) <= 4096 // 100
+    assert cache.memory_used <= 4096
+    # the counters follow the values the arena keeps
+    for i in range(1000):
+        cache.put(CacheKey("select", [i % 50]), ["x" * (i % 300)])
+    live = [i for i in range(50) if cache.get(CacheKey("select", [i])) is not None]
+    assert len(cache) == len(live)
+    assert cache.put(CacheKey("select", [0]), ["x" * 5000]) == ["x" * 5000]
+    assert cache.stats()["rejected"] == 1
+    cache.close()
+
+def test_disk_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = DiskCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000)
+    for i in range(10):
+        cache.put(CacheKey("select", [i], id="s"), [{"i": i}], tags=["table:t%d" % (i % 2)])
+    cache.put(CacheKey("select", [100]), EMPTY_RESULT, max_live_ms=50)
+    assert cache.get(CacheKey("select", [3], id="s")) == [{"i": 3}]
+    assert cache.get(CacheKey("select", [100])) is EMPTY_RESULT
+    time.sleep(0.1)
+    assert cache.get(CacheKey("select", [100])) is None
+
+    assert cache.invalidate_tags(["table:t1"]) == 5
+    assert cache.get(CacheKey("select", [3], id="s")) is None
+    cache.close()
+
+    # the entries outlive the process
+    cache = DiskCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000)
+    assert len(cache) == 5
+    assert cache.get(CacheKey("select", [4], id="s")) == [{"i": 4}]
+    stats = cache.stats()
+    assert stats["entries"] == 5 and stats["statements"]["s"]["hits"] == 1
+
+    # least recently used first
+    for i in range(100):
+        cache.put(CacheKey("select", [1000 + i]), ["x" * 1000])
+    assert cache.get(CacheKey("select", [1099])) == ["x" * 1000]
+    assert cache.get(CacheKey("select", [4], id="s")) is None
+    assert cache.memory_used <= 64 * 1024
+    assert cache.stats()["evicted_capacity"] > 0
+    cache.clear()
+    assert cache.empty()
+    cache.close()
+    with pytest.raises(Exception, match="encodes to bytes"):
+        DiskCache(path, memory_limit=64 * 1024, max_live_ms=10 * 1000, codec=FrozenCodec())
+
+def test_tiered_cache(tmp_path):
+    l1 = Cache(memory_limit=4 * 1024, max_live_ms=10 * 1000, codec=FrozenCodec())
+    l2 = DiskCache(str(tmp_path / "cache.db"), memory_limit=1024 * 1024, max_live_ms=10 * 1000)
+    cache = TieredCache(l1, l2)
+    for i in range(50):
+        cache.put(CacheKey("select", [i], id="s"), [{"i": i, "name": "x" * 100}], tags=["table:t1"])
+    # what the first tier dropped is in the second one
+    assert len(l1) < 50 and len(l1) + len(l2) == 50
+    assert cache.get(CacheKey("select", [0], id="s")) == ({"i": 0, "name": "x" * 100},)
+    assert l1.get(CacheKey("select", [0], id="s"), record_stats=False) is not None
+    stats = cache.stats()
+    assert stats["l2"]["hits"] == 1 and stats["l2"]["puts"] > 0
+
+    # an entry evicted before an invalidation and spilled after it stays out
+    entry = l1.table[next(iter(l1.table))]
+    cache.invalidate_tags(["table:t1"])
+    assert cache.empty()
+    cache._spill(CacheKey("select", [1], id="s"), entry)
+    assert cache.get(CacheKey("select", [1], id="s")) is None
+
+    # an entry too large for l1 is served from l2 without being written again
+    cache.put(CacheKey("select", [1000], id="s"), [{"i": 1000, "name": "x" * 8000}])
+    puts = l2.stats()["puts"]
+    assert cache.get(CacheKey("select", [1000], id="s")) == [{"i": 1000, "name": "x" * 8000}]
+    assert cache.get(CacheKey("select", [1000], id="s")) is not None
+    assert l2.stats()["puts"] == puts and len(l1) == 0
+    l2.close()
+
+    # with the same codec in both tiers the encoded values move down as they are
+    l1 = Cache(memory_limit=4 * 1024, max_live_ms=10 * 1000)
+    l2 = DiskCache(str(tmp_path / "cache2.db"), memory_limit=1024 * 1024, max_live_ms=10 * 1000)
+    cache = TieredCache(l1, l2)
+    decoded = []
+    decode = l1.codec.decode
+    l1.codec.decode = lambda stored: decoded.append(stored) or decode(stored)
+    for i in range(50):
+        cache.put(CacheKey("select", [i], id="s"), [{"i": i, "day": datetime.date(2024, 1, 1)}])
+    assert len(l2) > 0 and decoded == []
+    assert cache.get(CacheKey("select", [0], id="s")) == [{"i": 0, "day": datetime.date(2024, 1, 1)}]
+    l2.close()
+
+def test_stale_entries():
+    cache = Cache(memory_limit=1024 * 1024, max_live_ms=10 * 1000)
+    key = CacheKey("select", [1], id="s")
+    cache.put(key, [{"i": 1}], refresh_after_ms=50)
+    cache.put(CacheKey("select", [2]), [{"i": 2}])
+    assert cache.get_stale(key) == ([{"i": 1}], False)
+    time.sleep(0.1)
+    # past refresh_after_ms the value is still served, marked stale
+    assert cache.get_stale(key) == ([{"i": 1}], True)
+    assert cache.get(key) == [{"i": 1}]
+    assert cache.get_stale(CacheKey("select", [2])) == ([{"i": 2}], False)
+    stats = cache.stats()
+    assert stats["statements"]["s"]["hits"] == 3 and stats["statements"]["s"]["stale_hits"] == 2
+
+    cache.put(key, [{"i": 1}], max_live_ms=50, refresh_after_ms=10)
+    time.sleep(0.1)
+    assert cache.get_stale(key) == (None, False)
@@ -0,0 +1,25 @@
+import pytest
+
+from mybatis.expression import compile_expression
+
+
+def test_compile_cached():
+    assert compile_expression("'name' in params") is compile_expression("'name' in params")
+
+def test_evaluate():
+    params = {'price': 500, 'names': [1, 2]}
+    namespace = {'params': params}
+    assert compile_expression("'price' in params and params['price'] >= 400").evaluate(namespace) is True
+    assert compile_expression("len(params.get('names', [])) > 1").evaluate(namespace) is True
+    assert compile_expression("names").evaluate_in(params) == [1, 2]
+    assert compile_expression("names[1:]").evaluate_in(params) == [2]
+
+def test_reject_unsafe():
+    for source in ["__import__('os').system('ls')",
+                   "params.__class__",
+                   "open('/etc/passwd')",
+                   "[x for x in params]",
+                   "lambda: 1",
+                   "params.pop('price')"]:
+        with pytest.raises(Exception, match="Unsupported expression"):
+            compile_expression(source)
@@ -1,4 +1,10 @@
+import os
+
+import pytest
+
 from mybatis import MapperManager
+from mybatis import mapper_bundle
+from mybatis.mapper_bundle import MapperBundle
 
 
 def test_include():
@@ -103,4 +109,309 @@ def test_insert_returning_id():
     sql, param_list = mm.insert("test_returning_id.insert",
                                 {'name': 'Candy', 'category': "C", 'price': 500, '__need_returning_id__': 'fid'})
     assert sql == "INSERT INTO fruits (name, category, price) VALUES (?, ?, ?) RETURNING fid"
-    assert param_list == ['Candy', 'C', 500]
\ No newline at end of file
+    assert param_list == ['Candy', 'C', 500]
+
+def test_include_across_files(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="testCrossInclude">
+        SELECT * FROM <include refid="crossTable"/> WHERE id = #{id}
+    </select>
+</mapper>''')
+    (tmp_path / "b.xml").write_text('''<mapper>
+    <sql id="crossTable">
+        fruits
+    </sql>
+</mapper>''')
+
+    mm = MapperManager()
+    mm.read_mapper_xml_file(str(tmp_path / "a.xml"))
+    with pytest.raises(Exception, match="Missing refid"):
+        mm.select("testCrossInclude", {'id': 1})
+
+    mm.read_mapper_xml_file(str(tmp_path / "b.xml"))
+    sql, param_list = mm.select("testCrossInclude", {'id': 1})
+    assert sql == "SELECT * FROM fruits WHERE id = ?"
+    assert param_list == [1]
+
+def test_include_circular(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <sql id="first">
+        <include refid="second"/>
+    </sql>
+    <sql id="second">
+        <include refid="first"/>
+    </sql>
+</mapper>''')
+
+    mm = MapperManager()
+    with pytest.raises(Exception, match="Circular include"):
+        mm.read_mapper_xml_file(str(tmp_path / "a.xml"))
+
+def test_sql_cache_by_shape():
+    mm = MapperManager()
+    mm.read_mapper_xml_file("mapper/test.xml")
+
+    sql1, param_list1 = mm.select("testIf", {'category': "A", "price": 500})
+    sql2, param_list2 = mm.select("testIf", {'category': "B", "price": 600})
+    assert sql1 is sql2
+    assert param_list1 == ["A", 500]
+    assert param_list2 == ["B", 600]
+    assert len(mm.sql_cache) == 1
+
+    sql3, param_list3 = mm.select("testIf", {'category': "B", "price": 100})
+    assert sql3 == "SELECT name, category, price FROM fruits WHERE 1=1 AND category = ? AND price = ? AND 1=1"
+    assert param_list3 == ["B", 100]
+    assert len(mm.sql_cache) == 2
+
+    sql, param_list = mm.select("testForeach", {'names': [1, 2]})
+    assert sql == "SELECT name, category, price FROM fruits WHERE category = 'apple' AND name IN ( ? , ? )"
+    assert param_list == [1, 2]
+    sql, param_list = mm.select("testForeach", {'names': [3, 4, 5]})
+    assert sql == "SELECT name, category, price FROM fruits WHERE category = 'apple' AND name IN ( ? , ? , ? )"
+    assert param_list == [3, 4, 5]
+
+    sql, param_list = mm.select("testStringReplace", {'id': 1, 'date': "20241204"})
+    assert sql == "SELECT * from fruits_20241204 where id=?"
+    sql, param_list = mm.select("testStringReplace", {'id': 1, 'date': "20241205"})
+    assert sql == "SELECT * from fruits_20241205 where id=?"
+    # values equal in Python but rendered differently do not share the cached SQL
+    for date, table in [(1, "fruits_1"), (True, "fruits_True"), (1.0, "fruits_1.0"), (None, "fruits_None")]:
+        assert mm.select("testStringReplace", {'id': 1, 'date': date})[0] == "SELECT * from %s where id=?" % table
+    assert mm.select("testStringReplace", {'id': 1})[0] == "SELECT * from fruits_ where id=?"
+
+def test_sql_cache_bounded():
+    mm = MapperManager(sql_cache_size=2)
+    mm.read_mapper_xml_file("mapper/test.xml")
+
+    for date in ["20241201", "20241202", "20241203"]:
+        sql, param_list = mm.select("testStringReplace", {'id': 1, 'date': date})
+        assert sql == "SELECT * from fruits_" + date + " where id=?"
+    assert len(mm.sql_cache) == 2
+
+def test_whitespace_and_replace():
+    mm = MapperManager()
+    statement = mm.compile_sql("SELECT *\n   FROM  fruits_${date}\n WHERE id = #{id}\n AND name = #{name} ", "select")
+    sql, param_list = mm.render_statement(statement, {'id': 1, 'date': "20241204"})
+    assert sql == "SELECT * FROM fruits_20241204 WHERE id = ? AND name = ?"
+    assert param_list == [1, None]
+
+def test_foreach_large():
+    mm = MapperManager()
+    mm.read_mapper_xml_file("mapper/test2.xml")
+
+    ids = list(range(50000))
+    sql, param_list = mm.select("testForeachIds", {'category': 'A', 'ids': ids})
+    assert sql.startswith("SELECT id, name FROM fruits WHERE category = ? AND id IN ( ? , ? , ")
+    assert sql.endswith(" ? , ? ) ORDER BY id")
+    assert sql.count("?") == 50001
+    assert param_list == ['A'] + ids
+
+def test_split_params():
+    mm = MapperManager()
+    mm.read_mapper_xml_file("mapper/test2.xml")
+
+    params = {'category': 'A', 'ids': list(range(10))}
+    chunks = mm.split_params("testForeachIds", params, 11, 5)
+    assert [chunk['ids'] for chunk in chunks] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert all(chunk['category'] == 'A' for chunk in chunks)
+    assert params['ids'] == list(range(10))
+
+def test_foreach_bind_array():
+    mm = MapperManager()
+    mm.read_mapper_xml_file("mapper/test2.xml")
+
+    sql, param_list = mm.select("testForeachArray", {'ids': [1, 2, 3]}, array_binding=True)
+    assert sql == "SELECT id, name FROM fruits WHERE id = ANY(?) ORDER BY id"
+    assert param_list == [[1, 2, 3]]
+
+    sql1, param_list = mm.select("testForeachArray", {'ids': [1, 2, 3]})
+    assert sql1 == "SELECT id, name FROM fruits WHERE id IN (?, ?, ?, ?) ORDER BY id"
+    assert param_list == [1, 2, 3, 3]
+
+    sql2, param_list = mm.select("testForeachArray", {'ids': [5, 6, 7, 8]})
+    assert sql2 is sql1
+    assert param_list == [5, 6, 7, 8]
+
+    sql, param_list = mm.select("testForeachArray", {'ids': [1]})
+    assert sql == "SELECT id, name FROM fruits WHERE id IN (?) ORDER BY id"
+    assert param_list == [1]
+
+    sql, param_list = mm.select("testForeachArray", {'ids': []})
+    assert sql == "SELECT id, name FROM fruits WHERE id IN (NULL) ORDER BY id"
+    assert param_list == []
+
+def test_foreach_bind_array_body(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="testBadArray">
+        SELECT * FROM fruits WHERE (id, name)
+        <foreach collection="ids" item="id" bind="array">(#{id}, #{name})</foreach>
+    </select>
+</mapper>''')
+
+    mm = MapperManager()
+    with pytest.raises(Exception, match="must contain exactly"):
+        mm.read_mapper_xml_file(str(tmp_path / "a.xml"))
+
+def test_redefined_fragment(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <sql id="frag">fruits</sql>
+    <select id="s">SELECT * FROM <include refid="frag"/></select>
+</mapper>''')
+    (tmp_path / "b.xml").write_text('<mapper><sql id="frag">apples</sql></mapper>')
+    mm = MapperManager()
+    mm.read_mapper_xml_file(str(tmp_path / "a.xml"))
+    assert mm.select("s", {}) == ("SELECT * FROM fruits", [])
+    # the last definition wins, as for statements read after it
+    mm.read_mapper_xml_file(str(tmp_path / "b.xml"))
+    assert mm.select("s", {}) == ("SELECT * FROM apples", [])
+
+def test_mapper_bundle(tmp_path):
+    mapper_dir = tmp_path / "mapper"
+    mapper_dir.mkdir()
+    for name in ("test.xml", "test2.xml"):
+        (mapper_dir / name).write_text(open("mapper/" + name).read())
+    bundle_path = str(tmp_path / "mapper.bundle")
+
+    mm = MapperManager()
+    mm.read_mapper_dir(str(mapper_dir))
+    expected = mm.select("testForeachIds", {'category': 'A', 'ids': [1, 2]})
+
+    mm1 = MapperManager()
+    mm1.read_mapper_dir(str(mapper_dir), bundle_path)
+    assert os.path.exists(bundle_path)
+    assert mm1.select("testForeachIds", {'category': 'A', 'ids': [1, 2]}) == expected
+
+    mm2 = MapperManager()
+    mm2.read_mapper_dir(str(mapper_dir), bundle_path)
+    assert mm2.select("testForeachIds", {'category': 'A', 'ids': [1, 2]}) == expected
+    assert mm2.select("testInclude", {'category': 'A', 'price': 100}) == mm.select("testInclude", {'category': 'A', 'price': 100})
+
+def test_mapper_bundle_reparse(tmp_path):
+    mapper_dir = tmp_path / "mapper"
+    mapper_dir.mkdir()
+    (mapper_dir / "a.xml").write_text('<mapper><select id="a">SELECT 1</select></mapper>')
+    bundle_path = str(tmp_path / "mapper.bundle")
+
+    MapperManager().read_mapper_dir(str(mapper_dir), bundle_path)
+    (mapper_dir / "a.xml").write_text('<mapper><select id="a">SELECT 22</select></mapper>')
+    mm = MapperManager()
+    mm.read_mapper_dir(str(mapper_dir), bundle_path)
+    assert mm.select("a", {}) == ("SELECT 22", [])
+
+    with open(bundle_path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\0')
+    mm = MapperManager()
+    mm.read_mapper_dir(str(mapper_dir), bundle_path)
+    assert mm.select("a", {}) == ("SELECT 22", [])
+
+def test_mapper_bundle_package_version(tmp_path, monkeypatch):
+    mapper_dir = tmp_path / "mapper"
+    mapper_dir.mkdir()
+    (mapper_dir / "a.xml").write_text('<mapper><select id="a">SELECT 1</select></mapper>')
+    bundle_path = str(tmp_path / "mapper.bundle")
+    MapperManager().read_mapper_dir(str(mapper_dir), bundle_path)
+    assert set(MapperBundle(bundle_path).load()) == {"a.xml"}
+
+    # another release of the package does not trust the compiled statements
+    monkeypatch.setattr(mapper_bundle, "__version__", "0.0.0")
+    assert MapperBundle(bundle_path).load() == {}
+    mm = MapperManager()
+    mm.read_mapper_dir(str(mapper_dir), bundle_path)
+    assert mm.select("a", {}) == ("SELECT 1", [])
+    assert set(MapperBundle(bundle_path).load()) == {"a.xml"}
+
+def test_reload_mapper_dir(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper namespace="a">
+    <sql id="cond">price > #{price}</sql>
+    <select id="cheap">SELECT * FROM fruits WHERE price &lt; #{price}</select>
+</mapper>''')
+    (tmp_path / "b.xml").write_text('''<mapper namespace="b">
+    <select id="expensive">SELECT * FROM fruits WHERE <include refid="a.cond"/></select>
+    <select id="all">SELECT * FROM fruits</select>
+</mapper>''')
+
+    mm = MapperManager()
+    mm.read_mapper_dir(str(tmp_path))
+    mm.select("b.all", {})
+    assert mm.reload_mapper_dir(str(tmp_path)) == set()
+
+    (tmp_path / "a.xml").write_text('''<mapper namespace="a">
+    <sql id="cond">price >= #{price}</sql>
+    <select id="cheap">SELECT * FROM fruits WHERE price &lt; #{price}</select>
+</mapper>''')
+    assert mm.reload_mapper_dir(str(tmp_path)) == {"a.cond", "a.cheap", "b.expensive"}
+    assert mm.select("b.expensive", {'price': 1}) == ("SELECT * FROM fruits WHERE price >= ?", [1])
+    assert [key[0] for key in mm.sql_cache] == ["b.all", "b.expensive"]
+
+    # SQL rendered from a statement fetched before the reload does not serve the new one
+    old = mm.get_statement("a.cheap")
+    (tmp_path / "a.xml").write_text('''<mapper namespace="a">
+    <sql id="cond">price >= #{price}</sql>
+    <select id="cheap">SELECT * FROM fruits WHERE price &lt;= #{price}</select>
+</mapper>''')
+    mm.reload_mapper_dir(str(tmp_path))
+    assert mm.render_statement(old, {'price': 1}) == ("SELECT * FROM fruits WHERE price < ?", [1])
+    assert mm.select("a.cheap", {'price': 1}) == ("SELECT * FROM fruits WHERE price <= ?", [1])
+
+    # a broken file leaves the loaded statements alone
+    (tmp_path / "a.xml").write_text('<mapper namespace="a"><sql id="cond">')
+    with pytest.raises(Exception):
+        mm.reload_mapper_dir(str(tmp_path))
+    assert mm.select("b.expensive", {'price': 1}) == ("SELECT * FROM fruits WHERE price >= ?", [1])
+
+    os.remove(tmp_path / "a.xml")
+    assert mm.reload_mapper_dir(str(tmp_path)) == {"a.cond", "a.cheap", "b.expensive"}
+    with pytest.raises(Exception, match="Missing id"):
+        mm.select("a.cheap", {})
+    with pytest.raises(Exception, match="Missing refid"):
+        mm.select("b.expensive", {'price': 1})
+
+def test_statement_options(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="export" fetchSize="5000" timeout="2.5" useCache="false">SELECT * FROM fruits</select>
+    <select id="lookup" cacheMaxLiveMs="60000" cacheRefreshAfterMs="50000">SELECT * FROM fruits WHERE id = #{id}</select>
+    <update id="touch" flushCache="false">UPDATE fruits SET price = price</update>
+    <delete id="remove">DELETE FROM fruits</delete>
+</mapper>''')
+    mm = MapperManager()
+    mm.read_mapper_xml_file(str(tmp_path / "a.xml"))
+
+    export = mm.get_statement("export")
+    assert (export.fetch_size, export.timeout_ms, export.use_cache, export.flush_cache) == (5000, 2500, False, None)
+    lookup = mm.get_statement("lookup")
+    assert (lookup.use_cache, lookup.cache_max_live_ms, lookup.timeout_ms) == (True, 60000, None)
+    assert lookup.cache_refresh_after_ms == 50000
+    assert mm.get_statement("touch").flush_cache is False
+    assert mm.get_statement("remove").flush_cache is None
+
+    (tmp_path / "b.xml").write_text('<mapper><select id="bad" fetchSize="many">SELECT 1</select></mapper>')
+    with pytest.raises(Exception, match="Invalid fetchSize"):
+        mm.read_mapper_xml_file(str(tmp_path / "b.xml"))
+
+def test_statement_tables(tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper namespace="a">
+    <sql id="joins">JOIN prices p ON p.fruit_id = f.id</sql>
+    <select id="list">
+        SELECT * FROM fruits f <include refid="joins"/>
+        <where><if test="'tag' in params">f.id IN (SELECT fruit_id FROM tags WHERE tag = #{tag})</if></where>
+    </select>
+    <select id="daily">SELECT * FROM fruits_${date}</select>
+    <select id="view" tables="Fruits, prices">SELECT * FROM fruit_view</select>
+    <delete id="remove">DELETE FROM fruits WHERE id = #{id}</delete>
+    <insert id="copy">INSERT INTO archive (id) SELECT id FROM fruits</insert>
+    <select id="qualified">SELECT * FROM main.fruits f STRAIGHT_JOIN `main`.`prices` p ON p.fruit_id = f.id</select>
+    <update id="rename">UPDATE main.fruits SET name = #{name}</update>
+    <select id="constant">SELECT #{value}</select>
+</mapper>''')
+    mm = MapperManager()
+    mm.read_mapper_xml_file(str(tmp_path / "a.xml"))
+
+    assert mm.get_tables(mm.get_statement("a.list")) == ({"fruits", "prices", "tags"}, set())
+    assert mm.get_tables(mm.get_statement("a.daily")) == ({"*"}, set())
+    assert mm.get_tables(mm.get_statement("a.view")) == ({"fruits", "prices"}, set())
+    assert mm.get_tables(mm.get_statement("a.remove")) == (set(), {"fruits"})
+    assert mm.get_tables(mm.get_statement("a.copy")) == ({"fruits"}, {"archive"})
+    assert mm.get_tables(mm.get_statement("a.qualified")) == ({"fruits", "prices"}, set())
+    assert mm.get_tables(mm.get_statement("a.rename")) == (set(), {"fruits"})
+    assert mm.get_tables(mm.get_statement("a.constant")) == ({"*"}, set())
@@ -178,4 +178,9 @@ def test_insert(db_connection):
     assert ret[2]['id'] == 3
     assert ret[2]['name'] == 'Candy'
     assert ret[2]['category'] == 'B'
-    assert ret[2]['price'] == 200
\ No newline at end of file
+    assert ret[2]['price'] == 200
+
+def test_select_many_foreach_bind_array(db_connection):
+    mb = Mybatis(db_connection, "mapper")
+    ret = mb.select_many('testForeachArray', {'ids': [2, 1, 5]})
+    assert ret == [{'id': 1, 'name': 'Alice'}, {'id': 2, 'name': 'Bob'}]
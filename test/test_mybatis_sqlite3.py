@@ -1,7 +1,10 @@
+import time
+
 import pytest
 
-from mybatis import Mybatis
+from mybatis import Cache, Mybatis, FrozenCodec, GdsfPolicy, WTinyLfuPolicy
 from mybatis import ConnectionFactory
+from mybatis.errors import DatabaseError
 
 @pytest.fixture(scope="function")
 def db_connection():
@@ -174,4 +177,320 @@ def test_insert(db_connection):
     assert ret[2]['id'] == 3
     assert ret[2]['name'] == 'Candy'
     assert ret[2]['category'] == 'B'
-    assert ret[2]['price'] == 200
\ No newline at end of file
+    assert ret[2]['price'] == 200
+
+def test_select_many_split_params(db_connection):
+    mb = Mybatis(db_connection, "mapper", max_params_per_statement=3)
+    ret = mb.select_many('testForeachIds', {'category': 'B', 'ids': [1, 2, 3, 4, 5]})
+    assert ret == [{'id': 2, 'name': 'Bob'}]
+
+    mb.insert("testInsert", {"name": "Candy", "category": "B", "price": 200})
+    ret = mb.select_many('testForeachIds', {'category': 'B', 'ids': [1, 2, 3, 4, 5]})
+    assert ret == [{'id': 2, 'name': 'Bob'}, {'id': 3, 'name': 'Candy'}]
+
+    mb = Mybatis(db_connection, "mapper", max_params_per_statement=1)
+    with pytest.raises(Exception, match="Too many parameters"):
+        mb.select_many('testForeachIds', {'category': 'B', 'ids': [1, 2, 3, 4, 5]})
+
+def test_select_many_foreach_bind_array(db_connection):
+    mb = Mybatis(db_connection, "mapper")
+    ret = mb.select_many('testForeachArray', {'ids': [2, 1, 5]})
+    assert ret == [{'id': 1, 'name': 'Alice'}, {'id': 2, 'name': 'Bob'}]
+
+def test_reload_mappers(db_connection, tmp_path):
+    (tmp_path / "a.xml").write_text('<mapper><select id="names">SELECT name FROM fruits ORDER BY id</select></mapper>')
+    (tmp_path / "b.xml").write_text('<mapper><select id="prices">SELECT price FROM fruits ORDER BY id</select></mapper>')
+    mb = Mybatis(db_connection, str(tmp_path), cache_memory_limit=50*1024*1024)
+    assert mb.select_many('names', {}) == [{'name': 'Alice'}, {'name': 'Bob'}]
+    assert mb.select_many('prices', {}) == [{'price': 100}, {'price': 200}]
+
+    (tmp_path / "a.xml").write_text('<mapper><select id="names">SELECT name FROM fruits ORDER BY id DESC</select></mapper>')
+    assert mb.reload_mappers() == ['names']
+    assert len(mb.cache) == 1
+    assert mb.select_many('names', {}) == [{'name': 'Bob'}, {'name': 'Alice'}]
+
+def test_statement_options(db_connection, tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="names" useCache="false">SELECT name FROM fruits ORDER BY id</select>
+    <select id="prices" fetchSize="1">SELECT price FROM fruits ORDER BY id</select>
+    <update id="touch" flushCache="false">UPDATE fruits SET price = price</update>
+    <select id="slow" timeout="0.05">
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT count(*) AS c FROM n
+    </select>
+    <select id="bounded" timeout="0.05" useCache="false">
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x &lt; 10) SELECT count(*) AS c FROM n
+    </select>
+</mapper>''')
+    mb = Mybatis(db_connection, str(tmp_path), cache_memory_limit=50*1024*1024)
+    assert mb.select_many('names', {}) == [{'name': 'Alice'}, {'name': 'Bob'}]
+    assert mb.select_many('prices', {}) == [{'price': 100}, {'price': 200}]
+    assert len(mb.cache) == 1
+
+    assert mb.update('touch', {}) == 2
+    assert len(mb.cache) == 1
+
+    with pytest.raises(DatabaseError, match="interrupted"):
+        mb.select_one('slow', {})
+    assert mb.select_many('names', {}) == [{'name': 'Alice'}, {'name': 'Bob'}]
+
+    # the deadline of a statement does not outlive it
+    assert mb.select_one('bounded', {}) == {'c': 10}
+    time.sleep(0.1)
+    with db_connection.cursor() as cursor:
+        cursor.execute("WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 1000) "
+                       "SELECT count(*) FROM n")
+        assert cursor.fetchone() == (1000,)
+
+def test_decorator_arguments(db_connection):
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=50*1024*1024)
+
+    @mb.SelectMany("SELECT name FROM fruits WHERE category = #{category} AND price >= #{price} ORDER BY id")
+    def select_by_category(category, price=0):
+        pass
+
+    assert select_by_category.__name__ == "select_by_category"
+    assert select_by_category('A') == [{'name': 'Alice'}]
+    assert select_by_category('B', 150) == [{'name': 'Bob'}]
+    assert select_by_category(price=300, category='B') is None
+    with pytest.raises(TypeError):
+        select_by_category(color='red')
+
+    @mb.SelectOne("SELECT ${column} FROM fruits WHERE id = #{id}")
+    def select_column(id, column):
+        pass
+
+    assert select_column(2, 'name') == {'name': 'Bob'}
+    assert select_column(1, column='price') == {'price': 100}
+
+    @mb.Update("UPDATE fruits SET price = #{price} WHERE id = #{id}")
+    def update_price(id, **kwargs):
+        pass
+
+    assert update_price(1, price=150) == 1
+    assert select_column(1, 'price') == {'price': 150}
+
+def test_decorator_script(db_connection, tmp_path):
+    (tmp_path / "a.xml").write_text('<mapper namespace="f"><sql id="columns">name, price</sql></mapper>')
+    mb = Mybatis(db_connection, str(tmp_path))
+
+    @mb.SelectMany("""<script>
+        SELECT <include refid="f.columns"/> FROM fruits
+        <where>
+            <if test="params['category'] is not None">category = #{category}</if>
+            <if test="params['ids']">
+                AND id IN <foreach collection="ids" item="id" open="(" separator="," close=")">#{id}</foreach>
+            </if>
+        </where>
+        ORDER BY id
+    </script>""")
+    def select_fruits(category=None, ids=()):
+        pass
+
+    assert select_fruits() == [{'name': 'Alice', 'price': 100}, {'name': 'Bob', 'price': 200}]
+    assert select_fruits('B') == [{'name': 'Bob', 'price': 200}]
+    assert select_fruits(ids=[1]) == [{'name': 'Alice', 'price': 100}]
+    assert select_fruits('B', [1]) is None
+
+    (tmp_path / "a.xml").write_text('<mapper namespace="f"><sql id="columns">name</sql></mapper>')
+    mb.reload_mappers()
+    assert select_fruits('B') == [{'name': 'Bob'}]
+
+    with pytest.raises(Exception, match="Invalid script"):
+        @mb.SelectOne("<script>SELECT * FROM fruits WHERE price < #{price}</script>")
+        def select_cheap(price):
+            pass
+
+def test_frozen_cache(db_connection):
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=50*1024*1024, cache_codec=FrozenCodec())
+    ret = mb.select_many('testBasicMany', {})
+    assert isinstance(ret, tuple)
+    assert mb.select_many('testBasicMany', {}) is ret
+    assert ret[0]['name'] == 'Alice'
+    with pytest.raises(TypeError):
+        ret[0]['name'] = 'Carol'
+
+def test_table_invalidation(db_connection, tmp_path):
+    db_connection.cursor().execute("DROP TABLE IF EXISTS audit")
+    db_connection.cursor().execute("CREATE TABLE audit (message VARCHAR)")
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="names">SELECT name FROM fruits ORDER BY id</select>
+    <select id="messages">SELECT message FROM audit</select>
+    <insert id="log">INSERT INTO audit (message) VALUES (#{message})</insert>
+    <update id="rename">UPDATE fruits SET name = #{name} WHERE id = #{id}</update>
+</mapper>''')
+    mb = Mybatis(db_connection, str(tmp_path), cache_memory_limit=50*1024*1024)
+
+    @mb.SelectMany("SELECT price FROM fruits ORDER BY id")
+    def prices():
+        pass
+
+    assert mb.select_many('names', {}) == [{'name': 'Alice'}, {'name': 'Bob'}]
+    assert mb.select_many('messages', {}) is None
+    assert prices() == [{'price': 100}, {'price': 200}]
+    assert len(mb.cache) == 3
+
+    mb.insert('log', {'message': 'hello'})
+    assert len(mb.cache) == 2
+    assert mb.select_many('messages', {}) == [{'message': 'hello'}]
+
+    mb.update('rename', {'id': 1, 'name': 'Carol'})
+    assert len(mb.cache) == 1
+    assert mb.select_many('names', {}) == [{'name': 'Carol'}, {'name': 'Bob'}]
+
+def test_empty_result_caching(db_connection, tmp_path):
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="byName">SELECT * FROM fruits WHERE name = #{name}</select>
+    <select id="allByName">SELECT * FROM fruits WHERE name = #{name}</select>
+    <insert id="add">INSERT INTO fruits (name, category, price) VALUES (#{name}, 'C', 300)</insert>
+</mapper>''')
+    mb = Mybatis(db_connection, str(tmp_path), cache_memory_limit=50*1024*1024, cache_empty_max_live_ms=300)
+    assert mb.select_one('byName', {'name': 'Carol'}) is None
+    assert mb.select_many('allByName', {'name': 'Carol'}) is None
+    assert len(mb.cache) == 2
+
+    # a row added behind the back of the cache is not seen while the empty result lives
+    db_connection.cursor().execute("INSERT INTO fruits (name, category, price) VALUES ('Carol', 'C', 300)")
+    db_connection.commit()
+    assert mb.select_one('byName', {'name': 'Carol'}) is None
+    assert mb.cache.stats()["hits"] == 1
+
+    time.sleep(0.4)
+    assert mb.select_one('byName', {'name': 'Carol'})['price'] == 300
+
+    # writes drop cached empty results like any other
+    assert mb.select_one('byName', {'name': 'Dave'}) is None
+    mb.insert('add', {'name': 'Dave'})
+    assert mb.select_one('byName', {'name': 'Dave'})['price'] == 300
+
+    mb = Mybatis(db_connection, str(tmp_path), cache_memory_limit=50*1024*1024, cache_empty_max_live_ms=0)
+    assert mb.select_one('byName', {'name': 'Erin'}) is None
+    assert mb.cache.empty()
+
+def test_cache_stats(db_connection):
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=50*1024*1024)
+
+    @mb.SelectOne("SELECT * FROM fruits WHERE id = #{id}")
+    def get_fruit(id):
+        pass
+
+    mb.select_one('testBasic', {})
+    mb.select_one('testBasic', {})
+    get_fruit(2)
+
+    stats = mb.cache_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["entries"] == 2
+    assert stats["statements"]["testBasic"]["hits"] == 1
+    assert stats["statements"][__name__ + ".test_cache_stats.<locals>.get_fruit"]["puts"] == 1
+    assert stats["flights"]["calls"] == 2
+
+    mb.reset_cache_stats()
+    stats = mb.cache_stats()
+    assert stats["hits"] == stats["misses"] == stats["flights"]["calls"] == 0
+    assert stats["entries"] == 2
+
+@pytest.mark.parametrize("policy, shards", [(WTinyLfuPolicy, 1), (GdsfPolicy, 4)])
+def test_cache_policy(db_connection, policy, shards):
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=50*1024*1024, cache_policy=policy, cache_shards=shards)
+    shard_policies = [mb.cache.policy] if shards == 1 else [shard.policy for shard in mb.cache.shards]
+    assert all([isinstance(shard_policy, policy) for shard_policy in shard_policies])
+    assert len(set(map(id, shard_policies))) == shards
+
+    assert mb.select_one('testBasic', {})['name'] == 'Alice'
+    assert mb.select_one('testBasic', {})['name'] == 'Alice'
+    assert mb.cache_stats()["hits"] == 1
+    entry = [entry for shard in ([mb.cache] if shards == 1 else mb.cache.shards) for entry in shard.table.values()][0]
+    assert entry.cost > 0
+
+def test_shared_cache(db_connection, tmp_path):
+    path = str(tmp_path / "cache")
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=1024*1024, cache_shared_path=path)
+    assert mb.select_one('testBasic', {})['name'] == 'Alice'
+
+    # a second instance, as in another worker process, finds the result cached
+    other = Mybatis(db_connection, "mapper", cache_memory_limit=1024*1024, cache_shared_path=path)
+    assert other.select_one('testBasic', {})['name'] == 'Alice'
+    assert other.cache_stats()["hits"] == 1
+
+    mb.update('testUpdate', {'name': 'Carol', 'id': 1})
+    assert other.select_one('testBasic', {})['name'] == 'Carol'
+
+def test_disk_cache_tier(db_connection, tmp_path):
+    # room for one result in memory
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=600, cache_shards=1,
+                 cache_disk_path=str(tmp_path / "cache.db"))
+    assert mb.select_one('testBasicById', {'id': 1})['name'] == 'Alice'
+    assert mb.select_one('testBasicById', {'id': 2})['name'] == 'Bob'
+    assert len(mb.cache.l1) == 1 and len(mb.cache.l2) == 1
+
+    # the result dropped from memory is read back from the disk tier
+    assert mb.select_one('testBasicById', {'id': 1})['name'] == 'Alice'
+    stats = mb.cache_stats()
+    assert stats["misses"] == 3 and stats["l2"]["hits"] == 1
+
+    mb.update('testUpdate', {'name': 'Carol', 'id': 1})
+    assert mb.cache.empty()
+    assert mb.select_one('testBasicById', {'id': 1})['name'] == 'Carol'
+
+def test_custom_cache(db_connection):
+    cache = Cache(1024*1024, 5*1000)
+    mb = Mybatis(db_connection, "mapper", cache=cache)
+    assert mb.select_one('testBasic', {})['name'] == 'Alice'
+    assert len(cache) == 1
+
+def test_cache_single_shard_by_default(db_connection):
+    # a result larger than 1/16 of the limit is cached all the same
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=4*1024)
+    assert isinstance(mb.cache, Cache)
+    mb.select_many('testBasicMany', {})
+    mb.select_many('testBasicMany', {})
+    assert mb.cache_stats()["hits"] == 1
+
+def test_cache_refresh(db_connection):
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=1024*1024, cache_refresh_after_ms=50,
+                 cache_refresh_connection=lambda: ConnectionFactory.get_connection(dbms_name='sqlite3',
+                                                                                  db_path='./test.db'))
+    assert mb.select_one('testBasicById', {'id': 1})['name'] == 'Alice'
+    # changed behind the back of the cache, so that only a refresh sees it
+    db_connection.cursor().execute("UPDATE fruits SET name = 'Carol' WHERE id = 1")
+    db_connection.commit()
+
+    time.sleep(0.1)
+    # the stale result comes back at once and the query runs again in the background
+    assert mb.select_one('testBasicById', {'id': 1})['name'] == 'Alice'
+    mb.stop_cache_refresh()
+    assert mb.select_one('testBasicById', {'id': 1})['name'] == 'Carol'
+    stats = mb.cache_stats()
+    assert stats["refreshes"] == {"scheduled": 1, "errors": 0, "pending": 0}
+    assert stats["stale_hits"] == 1 and stats["misses"] == 1
+
+def test_cache_refresh_without_connection(db_connection, tmp_path):
+    with pytest.raises(Exception, match="cache_refresh_connection"):
+        Mybatis(db_connection, "mapper", cache_memory_limit=1024*1024, cache_refresh_after_ms=50)
+
+    (tmp_path / "a.xml").write_text('''<mapper>
+    <select id="name" cacheRefreshAfterMs="50">SELECT name FROM fruits WHERE id = #{id}</select>
+</mapper>''')
+    mb = Mybatis(db_connection, str(tmp_path), cache_memory_limit=1024*1024)
+    assert mb.select_one('name', {'id': 1})['name'] == 'Alice'
+    db_connection.cursor().execute("UPDATE fruits SET name = 'Carol' WHERE id = 1")
+    db_connection.commit()
+
+    time.sleep(0.1)
+    # no connection for a background thread: the caller refreshes the result before getting it
+    assert mb.select_one('name', {'id': 1})['name'] == 'Carol'
+    assert mb.cache_stats()["refreshes"]["scheduled"] == 0
+    assert mb.select_one('name', {'id': 1})['name'] == 'Carol'
+    assert mb.cache_stats()["hits"] == 2
+
+def test_cache_keeps_column_types(db_connection):
+    mb = Mybatis(db_connection, "mapper", cache_memory_limit=1024*1024)
+
+    @mb.SelectOne("SELECT id, x'00ff' AS data, price * 1.5 AS total FROM fruits WHERE id = #{id}")
+    def select_data(id: int):
+        pass
+
+    expected = {'id': 1, 'data': b'\x00\xff', 'total': 150.0}
+    assert select_data(1) == expected
+    hit = select_data(1)
+    assert hit == expected and type(hit['data']) is bytes
+    assert mb.cache_stats()["hits"] == 1